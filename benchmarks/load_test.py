@@ -0,0 +1,467 @@
+# Нагрузочный тест без сети: синтетический поток апдейтов идет через настоящий вебхук (handle_telegram_webhook),
+# очередь, обработчики и persistence, а Bot API, Gemini и Postgres заменены локальными заглушками.
+# Настройки бота берутся из переменных окружения, как в проде (UPDATE_WORKERS, GEMINI_RPM, STREAM_RESPONSES...).
+# Запуск из корня репозитория: python benchmarks/load_test.py [--updates 500] [--rate 20] [--chats 50] [--json result.json]
+# С настоящим Postgres вместо заглушки: --database-url postgresql://... (или postgresql+asyncpg://...)
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py завершает работу без этих переменных; сеть и ключи для теста не нужны
+for var in ("TELEGRAM_BOT_TOKEN", "GOOGLE_API_KEY", "WEBHOOK_HOST", "GEMINI_WEBHOOK_PATH"):
+    os.environ.setdefault(var, "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+# Квота Gemini по умолчанию (150 RPM) ограничила бы поток ~2.5 запроса/с, и задержку определял бы лимитер, а не
+# заглушки; тест меряет сам бот. Чтобы проверить поведение под квотой, задайте GEMINI_RPM явно
+os.environ.setdefault("GEMINI_RPM", "0")
+
+import aiohttp
+import aiohttp.web
+from google.genai import errors as genai_errors
+from google.genai import types
+from telegram.ext import Application
+
+import main
+
+BOT_ID = 100
+WORDS = "бот ответ модель запрос история файл видео текст вопрос смысл пример данные контекст the model answer file video text question".split()
+DEFAULT_MIX = "text=50,reply=15,photo=15,document=10,youtube=10"
+
+def random_text(rng: random.Random, min_words: int, max_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words)))
+
+def percentile(values: list[float], q: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+def rss_mb() -> float | None:
+    try:
+        with open("/proc/self/statm") as statm: return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError): return None
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == "darwin" else peak / 1024 # На macOS ru_maxrss в байтах, на Linux — в КБ
+
+# --- Заглушка Bot API ---
+class FakeBotApi:
+    # HTTP-сервер с методами Bot API, которые вызывает бот, и раздачей файлов. PTB ходит сюда через base_url,
+    # MediaDownloader скачивает файлы по file_path — путь запросов тот же, что с api.telegram.org.
+    def __init__(self, rng: random.Random, latency_ms: float):
+        self.rng, self.latency = rng, latency_ms / 1000
+        self.calls: dict[str, int] = {}
+        self.reply_kinds = {"rate_limited": 0, "error": 0}
+        self.files: dict[str, int] = {} # file_id -> размер
+        self.last_bot_message: dict[int, dict] = {}
+        self._message_ids = itertools.count(10**6)
+        self._chats: dict[int, dict] = {}
+        self.app = aiohttp.web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle_method)
+        self.app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+
+    def register_chat(self, chat: dict) -> None: self._chats[chat["id"]] = chat
+
+    async def handle_method(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        method = request.match_info["method"]
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.content_type != "application/json" else await request.json()
+        if self.latency: await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+        return aiohttp.web.json_response({"ok": True, "result": self.result(method, params)})
+
+    def result(self, method: str, params: dict) -> object:
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot", "can_join_groups": True,
+                    "can_read_all_group_messages": True, "supports_inline_queries": False}
+        if method == "getFile":
+            file_id = params["file_id"]
+            return {"file_id": file_id, "file_unique_id": file_id, "file_size": self.files.get(file_id, 0), "file_path": f"media/{file_id}"}
+        if method in ("sendMessage", "editMessageText"):
+            chat_id, text = int(params["chat_id"]), params.get("text", "")
+            if text.startswith("⏳"): self.reply_kinds["rate_limited"] += 1
+            elif text.startswith("❌"): self.reply_kinds["error"] += 1
+            message_id = int(params["message_id"]) if method == "editMessageText" else next(self._message_ids)
+            message = {"message_id": message_id, "date": int(time.time()), "chat": self._chats.get(chat_id, {"id": chat_id, "type": "private"}),
+                       "from": {"id": BOT_ID, "is_bot": True, "first_name": "Benchmark"}, "text": text}
+            self.last_bot_message[chat_id] = message
+            return message
+        return True # sendChatAction, deleteMessage, setMyCommands и прочее
+
+    async def handle_file(self, request: aiohttp.web.Request) -> aiohttp.web.StreamResponse:
+        file_id = request.match_info["path"].rsplit("/", 1)[-1]
+        size = self.files.get(file_id)
+        if size is None: raise aiohttp.web.HTTPNotFound()
+        response = aiohttp.web.StreamResponse(headers={"Content-Length": str(size)})
+        await response.prepare(request)
+        # Начало файла уникально, чтобы sha256 разных файлов не совпадал и FileUploadCache не склеивал их
+        head, block = file_id.encode().ljust(64, b"\0"), bytes(256 * 1024)
+        await response.write(head[:size])
+        for offset in range(len(head), size, len(block)): await response.write(block[:size - offset])
+        await response.write_eof()
+        return response
+
+# --- Заглушка Gemini ---
+class FakeModels:
+    def __init__(self, owner: "FakeGenaiClient"): self.owner = owner
+
+    async def generate_content(self, model: str, contents, config=None) -> types.GenerateContentResponse:
+        self.owner.count("generate_content")
+        await asyncio.sleep(self.owner.latency())
+        self.owner.maybe_fail()
+        return self.owner.response(self.owner.answer(), contents)
+
+    async def generate_content_stream(self, model: str, contents, config=None):
+        # Как и настоящий клиент, запрос уходит (и ошибка всплывает) при чтении первого фрагмента
+        self.owner.count("generate_content_stream")
+        async def stream():
+            chunks, total = self.owner.stream_chunks, self.owner.latency()
+            self.owner.maybe_fail()
+            words = self.owner.answer().split(" ")
+            step = max(1, len(words) // chunks)
+            for i in range(0, len(words), step):
+                await asyncio.sleep(total / chunks)
+                yield self.owner.response(" ".join(words[i:i + step]) + " ", contents if i + step >= len(words) else None)
+        return stream()
+
+class FakeFiles:
+    def __init__(self, owner: "FakeGenaiClient"):
+        self.owner = owner
+        self._ready_at: dict[str, float] = {}
+
+    async def upload(self, file, config=None) -> types.File:
+        self.owner.count("files.upload")
+        size = 0
+        while chunk := file.read(main.MediaDownloader.GENAI_UPLOAD_CHUNK_BYTES): size += len(chunk)
+        await asyncio.sleep(self.owner.latency_base / 4 + size / (self.owner.upload_mbps * 2**20))
+        self.owner.maybe_fail()
+        name = f"files/{next(self.owner.ids)}"
+        mime_type = config.mime_type if config else "application/octet-stream"
+        self._ready_at[name] = time.monotonic() + (0 if mime_type.startswith("image/") else self.owner.processing)
+        return self.get_state(name, mime_type, size)
+
+    async def get(self, name: str) -> types.File:
+        self.owner.count("files.get")
+        await asyncio.sleep(self.owner.latency_base / 10)
+        return self.get_state(name)
+
+    def get_state(self, name: str, mime_type: str | None = None, size: int | None = None) -> types.File:
+        state = "ACTIVE" if time.monotonic() >= self._ready_at.get(name, 0) else "PROCESSING"
+        return types.File(name=name, uri=f"https://generativelanguage.googleapis.com/v1beta/{name}", mime_type=mime_type, size_bytes=size, state=state)
+
+class FakeCaches:
+    def __init__(self, owner: "FakeGenaiClient"): self.owner = owner
+
+    async def create(self, model: str, config=None) -> types.CachedContent:
+        self.owner.count("caches.create")
+        await asyncio.sleep(self.owner.latency_base / 2)
+        return types.CachedContent(name=f"cachedContents/{next(self.owner.ids)}", model=model)
+
+    async def delete(self, name: str, config=None) -> None: self.owner.count("caches.delete")
+
+def prompt_chars(contents) -> int:
+    # contents, как и в SDK, — строка, Part, Content или список из них (HistoryCompactor передает строку)
+    if isinstance(contents, str): return len(contents)
+    if isinstance(contents, types.Part): return len(contents.text or "")
+    if isinstance(contents, types.Content): return sum(len(part.text or "") for part in contents.parts or [])
+    if isinstance(contents, (list, tuple)): return sum(prompt_chars(item) for item in contents)
+    return 0
+
+class FakeGenaiClient:
+    # Повторяет используемую ботом часть genai.Client.aio: задержка ответа с разбросом, доля ошибок 503/429,
+    # стрим частями, загрузка файлов с заданной скоростью и обработкой (PROCESSING -> ACTIVE) для не-картинок.
+    def __init__(self, rng: random.Random, latency_ms: float, jitter: float, error_rate: float, error_code: int, stream_chunks: int,
+                 answer_words: int, upload_mbps: float, processing_ms: float):
+        self.rng, self.latency_base, self.jitter = rng, latency_ms / 1000, jitter
+        self.error_rate, self.error_code = error_rate, error_code
+        self.stream_chunks, self.answer_words = stream_chunks, answer_words
+        self.upload_mbps, self.processing = upload_mbps, processing_ms / 1000
+        self.calls: dict[str, int] = {}
+        self.injected_errors = 0
+        self.ids = itertools.count(1)
+        self.aio = type("AsyncClient", (), {})()
+        self.aio.models, self.aio.files, self.aio.caches = FakeModels(self), FakeFiles(self), FakeCaches(self)
+
+    def count(self, method: str) -> None: self.calls[method] = self.calls.get(method, 0) + 1
+
+    def latency(self) -> float: return self.latency_base * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def maybe_fail(self) -> None:
+        if self.rng.random() >= self.error_rate: return
+        self.injected_errors += 1
+        status = "RESOURCE_EXHAUSTED" if self.error_code == 429 else "UNAVAILABLE"
+        raise genai_errors.APIError(self.error_code, {"error": {"code": self.error_code, "message": "Injected by load_test", "status": status}})
+
+    def answer(self) -> str: return random_text(self.rng, self.answer_words // 2, self.answer_words * 3 // 2)
+
+    @staticmethod
+    def response(text: str, contents) -> types.GenerateContentResponse:
+        # usage_metadata — только у последнего фрагмента, как у настоящего стрима; число токенов — грубая оценка по длине
+        usage = None
+        if contents is not None:
+            usage = types.GenerateContentResponseUsageMetadata(prompt_token_count=prompt_chars(contents) // 4 + 1, candidates_token_count=len(text) // 4 + 1)
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=text)]),
+                                                                         finish_reason=types.FinishReason.STOP)], usage_metadata=usage)
+
+# --- Заглушка Postgres ---
+class InMemoryPersistence(main.PostgresPersistence):
+    # Вся логика PostgresPersistence (сериализация, write-behind, склейка инструкций) настоящая, подменены только
+    # драйвер-зависимые операции: запись лишь ждет --db-latency-ms, чтение отвечает, что данных нет (новые чаты).
+    def __init__(self, latency_ms: float):
+        self.latency = latency_ms / 1000
+        super().__init__("in-memory")
+
+    def _connect_with_retry(self, retries=5, delay=5): pass
+    async def _load_chat(self, chat_id: int) -> dict | None:
+        await asyncio.sleep(self.latency)
+        return None
+    async def _write(self, statements: list[tuple[str, list[tuple]]]) -> None: await asyncio.sleep(self.latency)
+    async def _fetch_one(self, query: str, params: tuple) -> tuple | None:
+        await asyncio.sleep(self.latency)
+        return (params[0],) if "RETURNING" in query else None
+    async def close(self): self._cancel_flush_task()
+
+def count_db_operations(persistence: main.PostgresPersistence) -> dict:
+    # Счетчики транзакций, строк и байт оборачивают методы экземпляра — работает и с настоящей БД
+    stats = {"write_transactions": 0, "write_statements": 0, "written_rows": 0, "written_bytes": 0, "reads": 0}
+    write, fetch_one, load_chat = persistence._write, persistence._fetch_one, persistence._load_chat
+    async def counted_write(statements):
+        stats["write_transactions"] += 1
+        for _, params_list in statements:
+            if not params_list: continue
+            stats["write_statements"] += 1
+            stats["written_rows"] += len(params_list)
+            stats["written_bytes"] += sum(len(value) for params in params_list for value in params if isinstance(value, (bytes, bytearray, memoryview)))
+        return await write(statements)
+    async def counted_fetch_one(query, params):
+        # INSERT ... RETURNING (захват update_id дедупликатором) — запись, хотя и идет через _fetch_one
+        if not query.startswith("INSERT"): stats["reads"] += 1
+        else:
+            for key in ("write_transactions", "write_statements", "written_rows"): stats[key] += 1
+        return await fetch_one(query, params)
+    async def counted_load_chat(chat_id):
+        stats["reads"] += 1
+        return await load_chat(chat_id)
+    persistence._write, persistence._fetch_one, persistence._load_chat = counted_write, counted_fetch_one, counted_load_chat
+    return stats
+
+# --- Приложение с отметкой завершения апдейтов ---
+class TimedApplication(Application):
+    # process_update возвращается, когда обработчик закончил (ответ отправлен, история сохранена) — это конец
+    # сквозной задержки. Сообщения, склеенные MessageCoalescer с первым, завершаются вместе с ним.
+    on_done = None
+
+    async def process_update(self, update: object) -> None:
+        followers = self.bot_data['coalescer']._followers.get(getattr(update, "update_id", None), [])
+        try: await super().process_update(update)
+        finally:
+            if self.on_done:
+                self.on_done(update.effective_chat.id, update.effective_message.message_id)
+                for message in followers: self.on_done(message.chat_id, message.message_id)
+
+# --- Генератор нагрузки ---
+class Scenario:
+    # Чаты (личные и группы) с несколькими авторами; вид каждого апдейта выбирается по весам --mix
+    def __init__(self, rng: random.Random, bot_api: FakeBotApi, chats: int, group_share: float, mix: dict[str, float], photo_kb: int, document_kb: int):
+        self.rng, self.bot_api, self.mix = rng, bot_api, mix
+        self.photo_bytes, self.document_bytes = photo_kb * 1024, document_kb * 1024
+        self.chats = []
+        for i in range(chats):
+            if rng.random() < group_share:
+                chat = {"id": -10**12 - i, "type": "supergroup", "title": f"Группа {i}"}
+                users = [{"id": 10**9 + i * 10 + j, "is_bot": False, "first_name": f"User{j}"} for j in range(rng.randint(2, 6))]
+            else:
+                users = [{"id": 10**9 + i * 10, "is_bot": False, "first_name": f"User{i}"}]
+                chat = {"id": users[0]["id"], "type": "private", "first_name": users[0]["first_name"]}
+            bot_api.register_chat(chat)
+            self.chats.append((chat, users))
+        self.update_ids = itertools.count(1)
+        self.message_ids: dict[int, itertools.count] = {}
+
+    def next_update(self) -> tuple[str, dict]:
+        chat, users = self.rng.choice(self.chats)
+        kind = self.rng.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        message_id = next(self.message_ids.setdefault(chat["id"], itertools.count(1)))
+        message = {"message_id": message_id, "date": int(time.time()), "chat": chat, "from": self.rng.choice(users)}
+        file_id = f"{kind}-{chat['id']}-{message_id}"
+        if kind == "reply" and chat["id"] in self.bot_api.last_bot_message:
+            message.update(text=random_text(self.rng, 3, 20), reply_to_message=self.bot_api.last_bot_message[chat["id"]])
+        elif kind == "photo":
+            size = int(self.photo_bytes * self.rng.uniform(0.5, 1.5))
+            self.bot_api.files[file_id] = size
+            message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960, "file_size": size}]
+            if self.rng.random() < 0.5: message["caption"] = random_text(self.rng, 2, 12)
+        elif kind == "document":
+            size = int(self.document_bytes * self.rng.uniform(0.5, 1.5))
+            self.bot_api.files[file_id] = size
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id, "file_name": f"report-{message_id}.pdf", "mime_type": "application/pdf", "file_size": size}
+        elif kind == "youtube":
+            url = "https://youtu.be/" + "".join(self.rng.choices("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-", k=11))
+            prefix = random_text(self.rng, 0, 8)
+            message["text"] = f"{prefix} {url}".strip()
+            message["entities"] = [{"type": "url", "offset": len(message["text"]) - len(url), "length": len(url)}]
+        else:
+            kind = "text" # reply без ответа бота в чате — обычный текст
+            message["text"] = random_text(self.rng, 3, 40)
+        return kind, {"update_id": next(self.update_ids), "message": message}
+
+async def start_site(app: aiohttp.web.Application) -> tuple[aiohttp.web.AppRunner, str]:
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+async def run_load(args: argparse.Namespace) -> dict:
+    rng = random.Random(args.seed)
+    mix = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+    bot_api = FakeBotApi(rng, args.telegram_latency_ms)
+    api_runner, api_url = await start_site(bot_api.app)
+    gemini = FakeGenaiClient(rng, args.gemini_latency_ms, args.gemini_jitter, args.gemini_error_rate, args.gemini_error_code,
+                             args.stream_chunks, args.answer_words, args.upload_mbps, args.file_processing_ms)
+
+    persistence = await main.create_persistence(args.database_url) if args.database_url else InMemoryPersistence(args.db_latency_ms)
+    db_stats = count_db_operations(persistence)
+    application = (Application.builder().token(main.TELEGRAM_BOT_TOKEN).application_class(TimedApplication)
+                   .base_url(f"{api_url}/bot").base_file_url(f"{api_url}/file/bot").persistence(persistence).build())
+    persistence.evict_callback = lambda chat_id: main.unload_chat_data(application, chat_id)
+    await application.initialize()
+    main.setup_bot_data(application, persistence, gemini)
+    main.add_handlers(application)
+    dispatcher = main.UpdateDispatcher(application, coalescer=application.bot_data['coalescer'])
+    dispatcher.start()
+    deduplicator = main.UpdateDeduplicator(persistence if main.UPDATE_DEDUP_BACKEND == "postgres" else None)
+    webhook_runner, webhook_url = await start_site(main.create_web_app(application, dispatcher, deduplicator))
+    webhook_url += "/" + main.GEMINI_WEBHOOK_PATH.strip("/")
+
+    scenario = Scenario(rng, bot_api, args.chats, args.group_share, mix, args.photo_kb, args.document_kb)
+    sent_at: dict[tuple[int, int], float] = {}
+    latencies: dict[str, list[float]] = {kind: [] for kind in mix}
+    kinds: dict[tuple[int, int], str] = {}
+    ack_latencies, statuses, finished = [], {}, asyncio.Event()
+    accepted = completed = 0
+    first_sent = last_done = None
+
+    def on_done(chat_id: int, message_id: int) -> None:
+        nonlocal completed, last_done
+        started = sent_at.pop((chat_id, message_id), None)
+        if started is None: return
+        last_done = time.perf_counter()
+        latencies[kinds.pop((chat_id, message_id))].append(last_done - started)
+        completed += 1
+        if completed >= accepted and sending_done: finished.set()
+    application.on_done = on_done
+
+    async def post(session: aiohttp.ClientSession, kind: str, update: dict) -> None:
+        nonlocal accepted
+        key = (update["message"]["chat"]["id"], update["message"]["message_id"])
+        sent_at[key] = posted = time.perf_counter()
+        kinds[key] = kind
+        try:
+            async with session.post(webhook_url, json=update) as response: status = response.status
+        except aiohttp.ClientError: status = "error"
+        ack_latencies.append(time.perf_counter() - posted)
+        statuses[status] = statuses.get(status, 0) + 1
+        if status == 200: accepted += 1
+        else: sent_at.pop(key, None); kinds.pop(key, None)
+
+    sending_done = False
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        posts = []
+        for _ in range(args.updates):
+            first_sent = first_sent or time.perf_counter()
+            posts.append(asyncio.create_task(post(session, *scenario.next_update())))
+            if args.rate > 0: await asyncio.sleep(rng.expovariate(args.rate)) # Пуассоновский поток: открытая нагрузка, не ждет ответов
+        await asyncio.gather(*posts)
+    sending_done = True
+    send_seconds = time.perf_counter() - started
+    if completed >= accepted: finished.set()
+    try: await asyncio.wait_for(finished.wait(), args.drain_timeout)
+    except asyncio.TimeoutError: pass
+    rss_after = rss_mb()
+
+    await webhook_runner.cleanup()
+    await dispatcher.stop(timeout=1)
+    await application.bot_data['media_downloader'].close()
+    await persistence.flush()
+    await persistence.close()
+    await application.bot.shutdown() # Как и main(), без Application.shutdown: бот сам пишет chat_data, а bot_data не сохраняется
+    await api_runner.cleanup()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    busy_seconds = (last_done - first_sent) if last_done and first_sent else 0.0
+    return {
+        "updates": args.updates, "accepted": accepted, "completed": completed, "unfinished": accepted - completed,
+        "webhook_statuses": {str(status): count for status, count in statuses.items()},
+        "send_seconds": round(send_seconds, 3), "updates_per_second": round(completed / busy_seconds, 2) if busy_seconds else 0.0,
+        "latency_seconds": {kind: summarize(values) for kind, values in [("all", all_latencies), *latencies.items()] if values},
+        "webhook_ack_seconds": summarize(ack_latencies),
+        "rss_mb": {"before": round(rss_before, 1) if rss_before else None, "after": round(rss_after, 1) if rss_after else None, "peak": round(peak_rss_mb(), 1)},
+        "db": {"backend": "postgres" if args.database_url else "in-memory", **db_stats},
+        "telegram_calls": bot_api.calls, "telegram_replies": bot_api.reply_kinds,
+        "gemini_calls": gemini.calls, "gemini_injected_errors": gemini.injected_errors,
+        "settings": {name: getattr(main, name) for name in ("GEMINI_RPM", "GEMINI_MAX_CONCURRENCY", "UPDATE_WORKERS", "TELEGRAM_GLOBAL_RATE",
+                                                            "TELEGRAM_PRIVATE_RATE", "TELEGRAM_GROUP_RATE_PER_MINUTE", "STREAM_RESPONSES", "HISTORY_SUMMARY")},
+        "dispatcher": dispatcher.stats(), "admission": application.bot_data['admission'].stats(), "outbound": application.bot_data['sender'].stats(),
+    }
+
+def summarize(values: list[float]) -> dict:
+    return {"count": len(values), "p50": round(percentile(values, 50), 4), "p95": round(percentile(values, 95), 4),
+            "p99": round(percentile(values, 99), 4), "max": round(max(values), 4) if values else 0.0}
+
+def print_report(result: dict) -> None:
+    print(f"Настройки бота: {', '.join(f'{k}={v}' for k, v in result['settings'].items())}")
+    print(f"Апдейтов: {result['updates']}, принято: {result['accepted']}, обработано: {result['completed']}, не дождались: {result['unfinished']}")
+    print(f"Ответы вебхука: {result['webhook_statuses']}, отправка заняла {result['send_seconds']} с, пропускная способность {result['updates_per_second']} апдейт/с\n")
+    print(f"{'задержка, с':<14} {'кол-во':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}")
+    print("-" * 58)
+    for label, s in [*result["latency_seconds"].items(), ("ack вебхука", result["webhook_ack_seconds"])]:
+        print(f"{label:<14} {s['count']:>7} {s['p50']:>8.3f} {s['p95']:>8.3f} {s['p99']:>8.3f} {s['max']:>8.3f}")
+    rss = result["rss_mb"]
+    print(f"\nRSS, МБ: до {rss['before']}, после {rss['after']}, пик {rss['peak']}")
+    print(f"БД ({result['db']['backend']}): {', '.join(f'{k}={v}' for k, v in result['db'].items() if k != 'backend')}")
+    print(f"Bot API: {result['telegram_calls']}, ответы-отказы: {result['telegram_replies']}")
+    print(f"Gemini: {result['gemini_calls']}, внесено ошибок: {result['gemini_injected_errors']}")
+
+def main_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=20, help="апдейтов в секунду (пуассоновский поток); 0 — все сразу")
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--group-share", type=float, default=0.3, help="доля групповых чатов")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="веса видов апдейтов: text, reply, photo, document, youtube")
+    parser.add_argument("--photo-kb", type=int, default=200)
+    parser.add_argument("--document-kb", type=int, default=1024)
+    parser.add_argument("--telegram-latency-ms", type=float, default=30)
+    parser.add_argument("--gemini-latency-ms", type=float, default=1500)
+    parser.add_argument("--gemini-jitter", type=float, default=0.4, help="разброс задержки Gemini, доля от среднего")
+    parser.add_argument("--gemini-error-rate", type=float, default=0.0)
+    parser.add_argument("--gemini-error-code", type=int, default=503, choices=(429, 503))
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--answer-words", type=int, default=150)
+    parser.add_argument("--upload-mbps", type=float, default=50)
+    parser.add_argument("--file-processing-ms", type=float, default=2000, help="через сколько файл (не картинка) становится ACTIVE")
+    parser.add_argument("--database-url", default=None, help="настоящий Postgres вместо заглушки в памяти")
+    parser.add_argument("--db-latency-ms", type=float, default=2)
+    parser.add_argument("--drain-timeout", type=float, default=120, help="сколько ждать обработки после отправки последнего апдейта, с")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", default=None, help="записать результат в файл для сравнения версий")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load(args))
+    print_report(result)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f: json.dump({"args": vars(args), **result}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main_benchmark()
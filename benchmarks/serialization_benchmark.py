@@ -0,0 +1,87 @@
+# Сравнение форматов хранения chat_data: байты на строку и время кодирования/декодирования.
+# Запуск из корня репозитория: python benchmarks/serialization_benchmark.py [--chats 200] [--repeat 5]
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main.py завершает работу без этих переменных; для бенчмарка сеть и ключи не нужны
+for var in ("TELEGRAM_BOT_TOKEN", "GOOGLE_API_KEY", "WEBHOOK_HOST", "GEMINI_WEBHOOK_PATH"):
+    os.environ.setdefault(var, "benchmark")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import main
+
+SYLLABLES_RU = "ка ро ми на те ли по ва ст ль ны ко ре да ше лю бо зо ги ту ть ем ой".split()
+SYLLABLES_EN = "the ing er an re on at en nd ti es or te of ed is it al ar st to nt".split()
+
+def make_vocabulary(rng: random.Random, syllables: list[str], size: int) -> list[str]:
+    # Словарь из нескольких тысяч «слов» дает сжимаемость, близкую к живой переписке, в отличие от пары десятков повторов
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(1, 4))) for _ in range(size)]
+
+def random_text(rng: random.Random, min_len: int, max_len: int) -> str:
+    target, words, length = rng.randint(min_len, max_len), [], 0
+    while length < target:
+        word = rng.choice(VOCAB_RU if rng.random() < 0.7 else VOCAB_EN)
+        if rng.random() < 0.08: word += rng.choice(".,!?:") + ("\n" if rng.random() < 0.3 else "")
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)
+
+def make_chat_data(rng: random.Random, chat_id: int) -> dict:
+    # 50 записей (MAX_HISTORY_ITEMS) в том виде, в каком их сохраняет add_to_history
+    history, message_id = [], 1000
+    for seq in range(1, main.MAX_HISTORY_ITEMS + 1):
+        if seq % 2:
+            message_id += rng.randint(1, 5)
+            history.append({"role": "user", "parts": [{"type": "text", "content": random_text(rng, 20, 400)}], "seq": seq,
+                            "original_message_id": message_id, "user_id": rng.randint(10**8, 10**10), "user_name": rng.choice(["Денис", "Alex", "Мария"])})
+        else:
+            text = random_text(rng, 300, main.MAX_HISTORY_RESPONSE_LEN)
+            history.append({"role": "model", "parts": [{"type": "text", "content": text}], "seq": seq,
+                            "original_message_id": message_id, "bot_message_id": message_id + 1})
+    return {"id": chat_id, "history_seq": len(history), "history": history}
+
+def measure(serializer, chats: list[dict], repeat: int) -> dict:
+    entries = [entry for chat in chats for entry in chat["history"]]
+    results = {}
+    for label, objects in (("entry", entries), ("chat", chats)):
+        blobs = [serializer.dumps(obj) for obj in objects]
+        encode = min(timed(lambda: [serializer.dumps(obj) for obj in objects]) for _ in range(repeat))
+        decode = min(timed(lambda: [serializer.loads(blob) for blob in blobs]) for _ in range(repeat))
+        assert serializer.loads(blobs[0]) == objects[0], f"{serializer.name}: данные не совпали после декодирования"
+        results[label] = (sum(map(len, blobs)) / len(blobs), encode / len(objects) * 1e6, decode / len(objects) * 1e6)
+    return results
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def main_benchmark():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    global VOCAB_RU, VOCAB_EN
+    VOCAB_RU, VOCAB_EN = make_vocabulary(rng, SYLLABLES_RU, 5000), make_vocabulary(rng, SYLLABLES_EN, 3000)
+    chats = [make_chat_data(rng, -100_000 - i) for i in range(args.chats)]
+    candidates = [("pickle (текущий)", main.PickleSerializer())]
+    candidates += [(f"msgpack+{c}", main.MsgpackSerializer(c)) for c in ("none", "zlib", "zstd") if c != "zstd" or main.zstandard]
+
+    print(f"{args.chats} чатов по {main.MAX_HISTORY_ITEMS} записей, лучший из {args.repeat} прогонов\n")
+    print(f"{'формат':<18} | {'запись: байт':>12} {'enc мкс':>8} {'dec мкс':>8} | {'чат: байт':>10} {'enc мкс':>8} {'dec мкс':>8}")
+    print("-" * 86)
+    for label, serializer in candidates:
+        r = measure(serializer, chats, args.repeat)
+        (eb, ee, ed), (cb, ce, cd) = r["entry"], r["chat"]
+        print(f"{label:<18} | {eb:>12.0f} {ee:>8.1f} {ed:>8.1f} | {cb:>10.0f} {ce:>8.1f} {cd:>8.1f}")
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -2,26 +2,43 @@
 
 import logging
 import os
+import sys
 import asyncio
 import signal
 import re
 import pickle
-from collections import defaultdict, OrderedDict
+import zlib
+import random
+import hashlib
+import itertools
+import heapq
+import json
+import bisect
+from collections import defaultdict, OrderedDict, deque
 import psycopg2
 from psycopg2 import pool
+import psycopg2.extras
+import asyncpg
+import msgpack
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 import io
+import tempfile
 import time
 import datetime
 import pytz
 import html
-from functools import wraps
+from functools import wraps, lru_cache
+from contextlib import asynccontextmanager, contextmanager
 
 import aiohttp
 import aiohttp.web
-from telegram import Update, Message, BotCommand, User
+from telegram import Bot, Update, Message, BotCommand, User, File
 from telegram.constants import ChatAction, ParseMode
 from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters, BasePersistence
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 from google import genai
 from google.genai import types
@@ -29,7 +46,9 @@ from google.genai import errors as genai_errors
 
 # --- КОНФИГУРАЦИЯ ---
 log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=log_level)
+WORKER_INDEX = os.getenv("WORKER_INDEX") # Номер воркера; задает фронт-процесс в многопроцессном режиме, вручную не задается
+log_prefix = f"worker-{WORKER_INDEX} - " if WORKER_INDEX is not None else ""
+logging.basicConfig(format=f'%(asctime)s - {log_prefix}%(name)s - %(levelname)s - %(message)s', level=log_level)
 logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
@@ -44,19 +63,97 @@ if not all([TELEGRAM_BOT_TOKEN, GOOGLE_API_KEY, WEBHOOK_HOST, GEMINI_WEBHOOK_PAT
 
 # --- КОНСТАНТЫ И НАСТРОЙКИ ---
 MODEL_NAME = 'gemini-2.5-flash'
+THINKING_BUDGET = 24576 # Максимальный бюджет на мышление; маршруты ниже задают свой
 YOUTUBE_REGEX = r'(?:https?:\/\/)?(?:www\.|m\.)?(?:youtube\.com\/(?:watch\?v=|embed\/|v\/|shorts\/)|youtu\.be\/|youtube-nocookie\.com\/embed\/)([a-zA-Z0-9_-]{11})'
 URL_REGEX = r'https?:\/\/[^\s/$.?#].[^\s]*'
 DATE_TIME_REGEX = r'^\s*(какой\s+)?(день|дата|число|время|который\s+час)\??\s*$'
-MAX_CONTEXT_CHARS = 150000
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "48000")) # Бюджет запроса: системная инструкция + история + новый ход
 MAX_HISTORY_RESPONSE_LEN = 3000
+HISTORY_SUMMARY = os.getenv("HISTORY_SUMMARY", "0") == "1" # Сжимать старую историю в краткое содержание фоновым запросом
+SUMMARY_MODEL_NAME = os.getenv("SUMMARY_MODEL_NAME", "gemini-2.5-flash-lite")
+HISTORY_SUMMARY_TRIGGER_ITEMS = int(os.getenv("HISTORY_SUMMARY_TRIGGER_ITEMS", "40")) # Меньше MAX_HISTORY_ITEMS, чтобы старые ходы успели попасть в сводку
+HISTORY_SUMMARY_TRIGGER_TOKENS = int(os.getenv("HISTORY_SUMMARY_TRIGGER_TOKENS", "16000"))
+HISTORY_SUMMARY_KEEP_ITEMS = int(os.getenv("HISTORY_SUMMARY_KEEP_ITEMS", "16")) # Последние записи остаются дословно
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "1024"))
+CONTEXT_OVERFLOW_RETRIES = 2 # Сколько раз урезать историю и повторять запрос, если он больше лимита модели
 MAX_HISTORY_ITEMS = 50
 MAX_MEDIA_CONTEXTS = 50
 MEDIA_CONTEXT_TTL_SECONDS = 47 * 3600
 TELEGRAM_FILE_LIMIT_MB = 20
+PERSISTENCE_STORAGE_MODE = os.getenv("PERSISTENCE_STORAGE_MODE", "blob").lower() # blob | rows
+PERSISTENCE_BACKEND = os.getenv("PERSISTENCE_BACKEND", "psycopg2").lower() # psycopg2 | asyncpg
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")) # 0 — если БД за pgbouncer в режиме transaction
+PERSISTENCE_WRITE_DELAY = float(os.getenv("PERSISTENCE_WRITE_DELAY", "1.0")) # Окно склейки записей chat_data, сек; 0 — писать сразу
+PERSISTENCE_SERIALIZER = os.getenv("PERSISTENCE_SERIALIZER", "msgpack").lower() # msgpack | pickle
+PERSISTENCE_COMPRESSION = os.getenv("PERSISTENCE_COMPRESSION", "zstd").lower() # none | zlib | zstd (без пакета zstandard — zlib)
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16")) # Сколько апдейтов обрабатывается одновременно
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000")) # Сверх этого вебхук отвечает 503 и Telegram повторит доставку
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", "25")) # Сколько ждать дообработки очереди при остановке, сек
+UPDATE_DEDUP_BACKEND = os.getenv("UPDATE_DEDUP_BACKEND", "memory").lower() # memory | postgres (переживает рестарт, общий для реплик)
+UPDATE_DEDUP_SIZE = int(os.getenv("UPDATE_DEDUP_SIZE", "10000"))
+UPDATE_DEDUP_TTL_SECONDS = int(os.getenv("UPDATE_DEDUP_TTL_SECONDS", str(24 * 3600))) # Telegram хранит недоставленные апдейты до суток
+ROUTING_RULES = os.getenv("ROUTING_RULES", "") # JSON-список правил RequestRouter вместо DEFAULT_ROUTING_RULES
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "0") == "1" # Показывать ответ по мере генерации
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0")) # Пауза между правками сообщения в личке, сек
+STREAM_EDIT_INTERVAL_GROUP = float(os.getenv("STREAM_EDIT_INTERVAL_GROUP", "3.0")) # В группах лимит Telegram ~20 сообщений в минуту
+FILE_CACHE_BACKEND = os.getenv("FILE_CACHE_BACKEND", "memory").lower() # memory | postgres (общий для реплик)
+FILE_CACHE_SIZE = int(os.getenv("FILE_CACHE_SIZE", "1000"))
+FILE_CACHE_TTL_SECONDS = int(os.getenv("FILE_CACHE_TTL_SECONDS", str(MEDIA_CONTEXT_TTL_SECONDS))) # File API хранит файлы 48 часов
+FILE_UPLOAD_CONCURRENCY = int(os.getenv("FILE_UPLOAD_CONCURRENCY", "4")) # Одновременные загрузки в File API
+FILE_POLL_CONCURRENCY = int(os.getenv("FILE_POLL_CONCURRENCY", "8")) # Одновременные запросы статуса файла
+FILE_ACTIVE_TIMEOUT_BASE = float(os.getenv("FILE_ACTIVE_TIMEOUT_BASE", "30")) # Ожидание ACTIVE: база + на каждый МБ, сек
+FILE_ACTIVE_TIMEOUT_PER_MB = float(os.getenv("FILE_ACTIVE_TIMEOUT_PER_MB", "6"))
+FILE_ACTIVE_TIMEOUT_MAX = float(os.getenv("FILE_ACTIVE_TIMEOUT_MAX", "300"))
+MEDIA_MEMORY_BUDGET_MB = int(os.getenv("MEDIA_MEMORY_BUDGET_MB", "64")) # Сколько памяти все загрузки медиа занимают одновременно
+MEDIA_SPOOL_MEMORY_MB = int(os.getenv("MEDIA_SPOOL_MEMORY_MB", "4")) # Файл крупнее этого скачивается во временный файл на диске
+MEDIA_DOWNLOAD_CHUNK_KB = int(os.getenv("MEDIA_DOWNLOAD_CHUNK_KB", "256"))
+CONTEXT_CACHE_MODE = os.getenv("CONTEXT_CACHE_MODE", "off").lower() # off | system | history (явный кэш контекста Gemini, платный)
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", "4096")) # История короче не кэшируется отдельно для чата
+CONTEXT_CACHE_MAX_TAIL_ITEMS = int(os.getenv("CONTEXT_CACHE_MAX_TAIL_ITEMS", "10")) # Сколько новых записей досылать поверх кэша до пересоздания
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower() # memory | postgres (общий для реплик)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "500"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", str(24 * 3600)))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8")) # Одновременных запросов к Gemini (генерация и загрузка файлов)
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "150")) # Общий лимит запросов в минуту под квоту API; 0 — без лимита
+CHAT_RATE_PER_MINUTE = float(os.getenv("CHAT_RATE_PER_MINUTE", "20")) # Запросов к модели на чат; 0 — без лимита
+CHAT_RATE_BURST = int(os.getenv("CHAT_RATE_BURST", "10"))
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "10")) # Запросов к модели на пользователя; 0 — без лимита
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "5"))
+ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "15")) # Дольше ждать лимита не стоит — запрос отклоняется
+GEMINI_RETRY_ATTEMPTS = int(os.getenv("GEMINI_RETRY_ATTEMPTS", "3")) # Повторы при 429/503
+GEMINI_RETRY_MAX_DELAY = float(os.getenv("GEMINI_RETRY_MAX_DELAY", "30")) # Если API просит ждать дольше (дневная квота), не повторяем
+COALESCE_WINDOW_MS = int(os.getenv("COALESCE_WINDOW_MS", "0")) # Пауза, после которой серия сообщений одного автора уходит одним запросом; 0 — выключено
+COALESCE_MAX_MS = int(os.getenv("COALESCE_MAX_MS", "4000")) # Дольше первое сообщение серии не ждет
+COALESCE_MAX_MESSAGES = int(os.getenv("COALESCE_MAX_MESSAGES", "10")) # Альбом в Telegram — до 10 файлов
+MEDIA_CONTEXT_BACKEND = os.getenv("MEDIA_CONTEXT_BACKEND", "memory").lower() # memory | postgres (ответы на файлы переживают рестарт, общие для реплик)
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30")) # Сообщений в секунду на бота (лимит Telegram)
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20")) # Сообщений и правок в минуту в группу
+TELEGRAM_PRIVATE_RATE = float(os.getenv("TELEGRAM_PRIVATE_RATE", "1")) # Сообщений и правок в секунду в личный чат
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1")) # >1 — фронт-процесс принимает вебхук и раздает апдейты воркерам по chat_id
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "10100")) # Воркер i слушает 127.0.0.1:WORKER_BASE_PORT+i
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", str(UPDATE_DRAIN_TIMEOUT + 10))) # Сколько ждать дообработки в воркерах при остановке, сек
+CHAT_DATA_CACHE_SIZE = int(os.getenv("CHAT_DATA_CACHE_SIZE", "1000")) # Сколько чатов держать в памяти
+CHAT_DATA_MIN_IDLE_SECONDS = int(os.getenv("CHAT_DATA_MIN_IDLE_SECONDS", "600")) # Чат младше этого не выгружается, даже при переполнении
 
 # --- ИНСТРУМЕНТЫ И ПРОМПТЫ ---
 TEXT_TOOLS = [types.Tool(google_search=types.GoogleSearch(), code_execution=types.ToolCodeExecution(), url_context=types.UrlContext())]
 MEDIA_TOOLS = [types.Tool(google_search=types.GoogleSearch())] 
+TOOL_SETS = {"text": TEXT_TOOLS, "media": MEDIA_TOOLS, "search": MEDIA_TOOLS, "none": []}
+
+# Правила маршрутизации запросов (RequestRouter): первое подходящее по условиям when задает модель,
+# бюджет мышления и набор инструментов из TOOL_SETS. Условия: has_media, has_url, has_code, is_question,
+# is_reply, chat_type (private | group | supergroup или список), min_chars, max_chars.
+DEFAULT_ROUTING_RULES = [
+    {"name": "media", "when": {"has_media": True}, "thinking_budget": 8192, "tools": "media"},
+    {"name": "trivial", "when": {"has_url": False, "has_code": False, "is_question": False, "max_chars": 60}, "thinking_budget": 0, "tools": "search"},
+    {"name": "url", "when": {"has_url": True}, "thinking_budget": 4096, "tools": "text"},
+    {"name": "code", "when": {"has_code": True}, "thinking_budget": THINKING_BUDGET, "tools": "text"},
+    {"name": "complex", "when": {"min_chars": 400}, "thinking_budget": THINKING_BUDGET, "tools": "text"},
+    {"name": "default", "when": {}, "thinking_budget": 8192, "tools": "text"},
+]
 
 SAFETY_SETTINGS = [
     types.SafetySetting(category=c, threshold=types.HarmBlockThreshold.BLOCK_NONE)
@@ -74,12 +171,206 @@ except FileNotFoundError:
     АБСОЛЮТНЫЕ ЗАПРЕТЫ: НИКОГДА не показывай `tool_code`, `thought` или другие внутренние рассуждения. НИКОГДА не начинай ответ с префикса пользователя (например, `[12345; Name: User]:`). Отвечай только по существу.
     """
 
+# --- МЕТРИКИ ---
+# Метрики в текстовом формате Prometheus (GET /metrics) без внешних зависимостей. Запись на горячем пути —
+# поиск корзины бинарным поиском и пара сложений; накопленные значения и gauge считаются только при выдаче.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ") for value in values)
+    pairs = [f'{name}="{value}"' for name, value in zip(names, escaped)]
+    if extra: pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help_text, self.label_names, self.buckets = name, help_text, label_names, buckets
+        self._series: dict[tuple, list] = {} # значения меток -> [число наблюдений в каждой корзине..., в +Inf, сумма]
+
+    def observe(self, value: float, *labels) -> None:
+        series = self._series.get(labels)
+        if series is None: series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, name: str, help_text: str, label_names: tuple = ()):
+        self.name, self.help_text, self.label_names = name, help_text, label_names
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter",
+                *(f"{self.name}{format_labels(self.label_names, labels)} {value}" for labels, value in self._values.items())]
+
+class Gauge:
+    # Значение берется функцией в момент выдачи, на горячем пути ничего не пишется
+    def __init__(self, name: str, help_text: str, func):
+        self.name, self.help_text, self.func = name, help_text, func
+
+    def render(self) -> list[str]:
+        try: value = self.func()
+        except Exception: return [] # Источник еще не создан (до запуска бота)
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class Metrics:
+    def __init__(self):
+        self.telegram_download = Histogram("bot_telegram_download_seconds", "Скачивание файла из Telegram.")
+        self.file_upload = Histogram("bot_file_api_upload_seconds", "Загрузка файла в Gemini File API.")
+        self.file_active_wait = Histogram("bot_file_api_active_wait_seconds", "Ожидание статуса ACTIVE после загрузки.")
+        self.generation = Histogram("bot_gemini_generation_seconds", "Генерация ответа Gemini.", ("model", "tools", "mode"))
+        self.first_chunk = Histogram("bot_gemini_first_chunk_seconds", "Время до первого фрагмента стрима Gemini.", ("model", "tools"))
+        self.send_reply = Histogram("bot_send_reply_seconds", "Отправка ответа в Telegram.", ("mode",))
+        self.persistence_write = Histogram("bot_persistence_write_seconds", "Запись накопленных chat_data в БД.")
+        self.api_errors = Counter("bot_gemini_api_errors_total", "Ошибки Gemini API по виду.", ("kind",))
+        self.gauges: list[Gauge] = []
+
+    def gauge(self, name: str, help_text: str, func) -> None:
+        self.gauges = [gauge for gauge in self.gauges if gauge.name != name] + [Gauge(name, help_text, func)]
+
+    def render(self) -> str:
+        metrics = [value for value in vars(self).values() if isinstance(value, (Histogram, Counter))] + self.gauges
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+METRICS = Metrics()
+
+# --- СЕРИАЛИЗАЦИЯ ---
+class PickleSerializer:
+    # Исходный формат хранения; оставлен для отката и сравнения в benchmarks/serialization_benchmark.py
+    name = "pickle"
+    def dumps(self, obj: object) -> bytes: return pickle.dumps(obj)
+    def loads(self, blob: bytes) -> object:
+        blob = bytes(blob)
+        # После отката с msgpack в БД могут остаться записи нового формата
+        return pickle.loads(blob) if blob[:1] == b'\x80' else MsgpackSerializer().loads(blob)
+
+class MsgpackSerializer:
+    # Запись: [версия схемы: 1 байт][сжатие: 1 байт][msgpack]. Pickle протокола 2+ всегда начинается с 0x80,
+    # поэтому старые строки без заголовка распознаются и читаются как pickle.
+    name = "msgpack"
+    FORMAT_VERSION = 1
+    COMPRESSION_CODES = {"none": 0, "zlib": 1, "zstd": 2}
+    PICKLE_PROTO = 0x80
+
+    def __init__(self, compression: str = "none", min_compress_size: int = 512, level: int | None = None):
+        if compression not in self.COMPRESSION_CODES:
+            raise ValueError(f"Неизвестный тип сжатия PERSISTENCE_COMPRESSION: '{compression}'")
+        if compression == "zstd" and zstandard is None:
+            logger.warning("Пакет zstandard не установлен — для сжатия chat_data используется zlib.")
+            compression = "zlib"
+        self.compression = compression
+        self.min_compress_size = min_compress_size
+        self._zstd_level = level or 3
+        self._zlib_level = level or 1 # Уровни выше почти не уменьшают историю чата, но в разы медленнее
+
+    def dumps(self, obj: object) -> bytes:
+        try: payload = msgpack.packb(obj, use_bin_type=True)
+        except TypeError as e:
+            # В chat_data попал тип, которого нет в msgpack — лучше сохранить pickle, чем потерять запись
+            logger.error(f"MsgpackSerializer: объект не сериализуется в msgpack ({e}), сохраняю в pickle.")
+            return pickle.dumps(obj)
+        compression = self.compression if len(payload) >= self.min_compress_size else "none"
+        if compression == "zlib": payload = zlib.compress(payload, self._zlib_level)
+        elif compression == "zstd": payload = zstandard.ZstdCompressor(level=self._zstd_level).compress(payload) # Объекты zstd не потокобезопасны
+        return bytes((self.FORMAT_VERSION, self.COMPRESSION_CODES[compression])) + payload
+
+    def loads(self, blob: bytes) -> object:
+        blob = bytes(blob)
+        if not blob or blob[0] == self.PICKLE_PROTO: return pickle.loads(blob)
+        version, compression, payload = blob[0], blob[1], blob[2:]
+        if version != self.FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия формата chat_data: {version}")
+        if compression == self.COMPRESSION_CODES["zlib"]: payload = zlib.decompress(payload)
+        elif compression == self.COMPRESSION_CODES["zstd"]:
+            if zstandard is None: raise ValueError("Запись сжата zstd, но пакет zstandard не установлен.")
+            payload = zstandard.ZstdDecompressor().decompress(payload)
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+# Ошибки разбора поврежденной записи: заголовок, распаковка zlib/zstd, msgpack (ValueError) и pickle
+SERIALIZER_DECODE_ERRORS = (ValueError, IndexError, EOFError, pickle.UnpicklingError, zlib.error, *((zstandard.ZstdError,) if zstandard else ()))
+
+def create_serializer(name: str = PERSISTENCE_SERIALIZER, compression: str = PERSISTENCE_COMPRESSION) -> PickleSerializer | MsgpackSerializer:
+    if name == "pickle": return PickleSerializer()
+    if name == "msgpack": return MsgpackSerializer(compression)
+    raise ValueError(f"Неизвестный PERSISTENCE_SERIALIZER: '{name}'")
+
 # --- КЛАСС PERSISTENCE ---
+@lru_cache(maxsize=None)
+def to_asyncpg_query(query: str) -> str:
+    # Запросы пишутся с плейсхолдерами psycopg2 (%s); asyncpg ожидает $1, $2, ...
+    counter = itertools.count(1)
+    return re.sub(r'%s', lambda _: f"${next(counter)}", query)
+
+class ChatDataUnavailable(Exception):
+    # chat_data чата не загрузился из БД. Обработчик на пустом chat_data записал бы его поверх сохраненной истории,
+    # поэтому апдейт прерывается, а пользователю отвечает error_handler
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        super().__init__(f"Данные чата {chat_id} временно недоступны.")
+
+def db_retry_delay(attempt: int, base: float = 0.5, cap: float = 10.0) -> float:
+    # Экспоненциальная задержка с полным джиттером, чтобы реплики не переподключались синхронно
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
 class PostgresPersistence(BasePersistence):
-    def __init__(self, database_url: str):
+    # Режимы хранения chat_data:
+    #   blob — весь chat_data одной записью в persistence_data (ключ chat_data_{id});
+    #   rows — метаданные чата в chat_meta, история построчно в chat_history (chat_id, seq).
+    #          На каждый ход дописываются только новые записи, обрезка истории — удаление диапазона seq.
+    # Данные чата загружаются лениво — при первом апдейте из чата (refresh_chat_data; при ошибке БД апдейт
+    # прерывается ChatDataUnavailable, чтобы обработчик не записал пустой chat_data). Загруженные чаты
+    # учитываются в LRU; самые давно неактивные выгружаются из памяти через evict_callback
+    # (unload_chat_data), их данные остаются в БД и подгружаются заново при следующем апдейте.
+    # Формат записей задает serializer (по умолчанию msgpack со сжатием, старые pickle-строки читаются).
+    # Записи chat_data отложены (write-behind): save_chat_data лишь помечает чат измененным, а через
+    # PERSISTENCE_WRITE_DELAY все накопленные чаты пишутся одной транзакцией, повторные обновления чата
+    # за это окно склеиваются. flush() дописывает очередь немедленно — его вызывает main() при остановке.
+    # Драйвер-зависимы только _connect_with_retry, _load_chat, _write и close — их переопределяет AsyncPostgresPersistence.
+    db_errors = (psycopg2.Error,)
+    SQL_SELECT_BLOB = "SELECT data FROM persistence_data WHERE key = %s;"
+    SQL_SELECT_CHAT_BLOBS = "SELECT key, data FROM persistence_data WHERE key LIKE 'chat_data_%';"
+    SQL_SELECT_META = "SELECT data FROM chat_meta WHERE chat_id = %s;"
+    SQL_SELECT_HISTORY = "SELECT entry FROM chat_history WHERE chat_id = %s ORDER BY seq;"
+
+    def __init__(self, database_url: str, storage_mode: str = PERSISTENCE_STORAGE_MODE, chat_cache_size: int = CHAT_DATA_CACHE_SIZE,
+                 min_size: int = DB_POOL_MIN_SIZE, max_size: int = DB_POOL_MAX_SIZE, write_delay: float = PERSISTENCE_WRITE_DELAY, serializer=None):
         super().__init__()
+        if storage_mode not in ("blob", "rows"):
+            raise ValueError(f"Неизвестный режим хранения PERSISTENCE_STORAGE_MODE: '{storage_mode}'")
         self.db_pool = None
         self.dsn = database_url
+        self.storage_mode = storage_mode
+        self.serializer = serializer or create_serializer()
+        self.min_size, self.max_size = min_size, max_size
+        self._persisted_seq: dict[int, int] = {} # chat_id -> последний seq истории, записанный в chat_history
+        self._seq_writes: dict[int, object] = {} # chat_id -> метка записи, которая обновит _persisted_seq по завершении
+        self.chat_cache_size = chat_cache_size
+        self.evict_callback = None
+        self._loaded_chats: OrderedDict[int, float] = OrderedDict() # chat_id -> время последнего обращения
+        self.write_delay = write_delay
+        self._dirty_chats: dict[int, dict] = {}
+        self._flush_task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
         self._connect_with_retry()
 
     def _connect_with_retry(self, retries=5, delay=5):
@@ -87,7 +378,7 @@ class PostgresPersistence(BasePersistence):
             try:
                 self._connect()
                 self._initialize_db()
-                logger.info("PostgresPersistence: Успешное подключение к БД.")
+                logger.info(f"PostgresPersistence: Успешное подключение к БД (режим хранения: {self.storage_mode}).")
                 return
             except psycopg2.Error as e:
                 logger.error(f"PostgresPersistence: Не удалось подключиться к БД (попытка {attempt + 1}/{retries}): {e}")
@@ -105,20 +396,20 @@ class PostgresPersistence(BasePersistence):
             if "keepalives" not in dsn: dsn = f"{dsn}&{keepalive_options}"
         else:
             dsn = f"{dsn}?{keepalive_options}"
-        self.db_pool = psycopg2.pool.SimpleConnectionPool(1, 10, dsn=dsn)
+        # Запросы идут из пула потоков asyncio.to_thread, поэтому пул соединений должен быть потокобезопасным
+        self.db_pool = psycopg2.pool.ThreadedConnectionPool(self.min_size, self.max_size, dsn=dsn)
 
-    def _execute(self, query: str, params: tuple = None, fetch: str = None, retries=3):
+    def _run(self, operation, retries=3):
+        # Выполняет operation(cursor) в одной транзакции с повтором при обрыве соединения
         last_exception = None
         for attempt in range(retries):
             conn = None
             try:
                 conn = self.db_pool.getconn()
                 with conn.cursor() as cur:
-                    cur.execute(query, params)
-                    if fetch == "one": return cur.fetchone()
-                    if fetch == "all": return cur.fetchall()
-                    conn.commit()
-                return True
+                    result = operation(cur)
+                conn.commit()
+                return result
             except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
                 logger.warning(f"Postgres: Ошибка соединения (попытка {attempt + 1}/{retries}): {e}")
                 last_exception = e
@@ -134,29 +425,261 @@ class PostgresPersistence(BasePersistence):
         logger.error(f"Postgres: Не удалось выполнить запрос после {retries} попыток. Последняя ошибка: {last_exception}")
         if last_exception: raise last_exception
 
-    def _initialize_db(self): self._execute("CREATE TABLE IF NOT EXISTS persistence_data (key TEXT PRIMARY KEY, data BYTEA NOT NULL);")
-    def _get_pickled(self, key: str) -> object | None:
-        res = self._execute("SELECT data FROM persistence_data WHERE key = %s;", (key,), fetch="one")
-        return pickle.loads(res[0]) if res and res[0] else None
-    def _set_pickled(self, key: str, data: object) -> None: self._execute("INSERT INTO persistence_data (key, data) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET data = %s;", (key, pickle.dumps(data), pickle.dumps(data)))
+    def _execute(self, query: str, params: tuple = None, fetch: str = None, retries=3):
+        def operation(cur):
+            cur.execute(query, params)
+            if fetch == "one": return cur.fetchone()
+            if fetch == "all": return cur.fetchall()
+            return True
+        return self._run(operation, retries)
+
+    def _execute_batch(self, statements: list[tuple[str, list[tuple]]], retries=3):
+        # statements: [(query, [params, ...]), ...] — все выполняются в одной транзакции
+        def operation(cur):
+            for query, params_list in statements:
+                if params_list: psycopg2.extras.execute_batch(cur, query, params_list)
+            return True
+        return self._run(operation, retries)
+
+    def _initialize_db(self):
+        for query in self._schema_statements(): self._execute(query)
+        # В многопроцессном режиме blob-чаты переносит один раз фронт-процесс, до запуска воркеров (run_front)
+        if self.storage_mode == "rows" and WORKER_INDEX is None:
+            blobs = self._execute(self.SQL_SELECT_CHAT_BLOBS, fetch="all") or []
+            for key, blob in blobs:
+                migration = self._migration_statements(key, blob)
+                if not migration: continue
+                chat_id, history_seq, statements = migration
+                self._execute_batch(statements)
+                self._persisted_seq[chat_id] = history_seq
+            if blobs: logger.info(f"PostgresPersistence: {len(blobs)} чатов перенесено из blob-режима в построчное хранение.")
+
+    def _get_chat(self, chat_id: int) -> dict | None:
+        def operation(cur):
+            if self.storage_mode == "blob":
+                cur.execute(self.SQL_SELECT_BLOB, (f"chat_data_{chat_id}",))
+                res = cur.fetchone()
+                return self.serializer.loads(res[0]) if res and res[0] else None
+            cur.execute(self.SQL_SELECT_META, (chat_id,))
+            meta = cur.fetchone()
+            if not meta: return None
+            cur.execute(self.SQL_SELECT_HISTORY, (chat_id,))
+            return self._decode_chat_rows(meta[0], [row[0] for row in cur.fetchall()])
+        return self._run(operation)
+
+    # --- Драйвер-зависимые операции ---
+    async def _load_chat(self, chat_id: int) -> dict | None: return await asyncio.to_thread(self._get_chat, chat_id)
+    async def _write(self, statements: list[tuple[str, list[tuple]]]) -> None: await asyncio.to_thread(self._execute_batch, statements)
+    async def _fetch_one(self, query: str, params: tuple) -> tuple | None: return await asyncio.to_thread(self._execute, query, params, fetch="one")
+    async def close(self):
+        self._cancel_flush_task()
+        if self.db_pool: self.db_pool.closeall()
+
+    # --- Схема и инструкции записи (общие для обоих драйверов) ---
+    def _schema_statements(self) -> list[str]:
+        statements = ["CREATE TABLE IF NOT EXISTS persistence_data (key TEXT PRIMARY KEY, data BYTEA NOT NULL);",
+                      "CREATE TABLE IF NOT EXISTS processed_updates (update_id BIGINT PRIMARY KEY, received_at TIMESTAMPTZ NOT NULL DEFAULT now());",
+                      "CREATE TABLE IF NOT EXISTS file_cache (cache_key TEXT PRIMARY KEY, file_uri TEXT NOT NULL, mime_type TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL);",
+                      "CREATE TABLE IF NOT EXISTS response_cache (cache_key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL);",
+                      "CREATE TABLE IF NOT EXISTS media_contexts (chat_id BIGINT NOT NULL, message_id BIGINT NOT NULL, file_uri TEXT NOT NULL, "
+                      "mime_type TEXT NOT NULL, expires_at DOUBLE PRECISION NOT NULL, PRIMARY KEY (chat_id, message_id));"]
+        if self.storage_mode == "rows":
+            statements.append("CREATE TABLE IF NOT EXISTS chat_meta (chat_id BIGINT PRIMARY KEY, data BYTEA NOT NULL);")
+            statements.append("CREATE TABLE IF NOT EXISTS chat_history (chat_id BIGINT NOT NULL, seq BIGINT NOT NULL, entry BYTEA NOT NULL, PRIMARY KEY (chat_id, seq));")
+        return statements
+
+    @staticmethod
+    def _ensure_history_seq(data: dict) -> None:
+        # Записи, сохраненные в blob-режиме, не имеют seq — нумеруем историю заново по порядку
+        history = data.get("history", [])
+        if all("seq" in entry for entry in history): return
+        for seq, entry in enumerate(history, 1): entry["seq"] = seq
+        data["history_seq"] = len(history)
+
+    def _decode_chat_rows(self, meta: bytes, entries: list[bytes]) -> dict:
+        data = self.serializer.loads(meta)
+        data["history"] = [self.serializer.loads(entry) for entry in entries]
+        return data
+
+    def _chat_rows_statements(self, chat_id: int, data: dict) -> list[tuple[str, list[tuple]]]:
+        self._ensure_history_seq(data)
+        history = data.get("history", [])
+        meta = {k: v for k, v in data.items() if k != "history"}
+        persisted_seq = self._persisted_seq.get(chat_id)
+        statements = []
+        if persisted_seq is None or data.get("history_seq", 0) < persisted_seq:
+            # Состояние в БД неизвестно или счетчик меньше записанного (данные старого формата) — переписываем историю целиком
+            statements.append(("DELETE FROM chat_history WHERE chat_id = %s;", [(chat_id,)]))
+            new_entries = history
+        else:
+            new_entries = [entry for entry in history if entry["seq"] > persisted_seq]
+            if history: statements.append(("DELETE FROM chat_history WHERE chat_id = %s AND seq < %s;", [(chat_id, history[0]["seq"])]))
+            else: statements.append(("DELETE FROM chat_history WHERE chat_id = %s;", [(chat_id,)]))
+        statements.append(("INSERT INTO chat_history (chat_id, seq, entry) VALUES (%s, %s, %s) ON CONFLICT (chat_id, seq) DO UPDATE SET entry = EXCLUDED.entry;",
+                           [(chat_id, entry["seq"], self.serializer.dumps(entry)) for entry in new_entries]))
+        statements.append(("INSERT INTO chat_meta (chat_id, data) VALUES (%s, %s) ON CONFLICT (chat_id) DO UPDATE SET data = EXCLUDED.data;", [(chat_id, self.serializer.dumps(meta))]))
+        return statements
+
+    def _chat_write_statements(self, chat_id: int, data: dict) -> list[tuple[str, list[tuple]]]:
+        if self.storage_mode == "rows": return self._chat_rows_statements(chat_id, data)
+        return [("INSERT INTO persistence_data (key, data) VALUES (%s, %s) ON CONFLICT (key) DO UPDATE SET data = EXCLUDED.data;", [(f"chat_data_{chat_id}", self.serializer.dumps(data))])]
+
+    def _chat_drop_statements(self, chat_id: int) -> list[tuple[str, list[tuple]]]:
+        if self.storage_mode == "rows": return [("DELETE FROM chat_history WHERE chat_id = %s;", [(chat_id,)]), ("DELETE FROM chat_meta WHERE chat_id = %s;", [(chat_id,)])]
+        return [("DELETE FROM persistence_data WHERE key = %s;", [(f"chat_data_{chat_id}",)])]
+
+    @staticmethod
+    def _merge_statements(statement_lists: list[list[tuple[str, list[tuple]]]]) -> list[tuple[str, list[tuple]]]:
+        # Склеивает инструкции нескольких чатов: одинаковые запросы на одной позиции идут одним executemany,
+        # а порядок позиций внутри чата (удаление -> вставка истории -> метаданные) сохраняется
+        merged: dict[tuple[int, str], list[tuple]] = {}
+        for statements in statement_lists:
+            for position, (query, params_list) in enumerate(statements):
+                merged.setdefault((position, query), []).extend(params_list)
+        return [(query, params_list) for (_, query), params_list in sorted(merged.items(), key=lambda item: item[0][0])]
+
+    def _migration_statements(self, key: str, blob: bytes) -> tuple[int, int, list] | None:
+        # Перенос chat_data_{id} из persistence_data в построчное хранение; blob удаляется в той же транзакции
+        try: chat_id, data = int(key.split('_')[-1]), self.serializer.loads(blob)
+        except SERIALIZER_DECODE_ERRORS as e:
+            logger.warning(f"Миграция: некорректный ключ или данные чата в БД: '{key}' ({e!r}). Запись пропущена.")
+            return None
+        self._persisted_seq.pop(chat_id, None)
+        statements = self._chat_rows_statements(chat_id, data)
+        statements.append(("DELETE FROM persistence_data WHERE key = %s;", [(key,)]))
+        return chat_id, data.get("history_seq", 0), statements
+
+    # --- Ленивая загрузка и LRU чатов в памяти ---
+    def _touch_chat(self, chat_id: int) -> None:
+        self._loaded_chats[chat_id] = time.monotonic()
+        self._loaded_chats.move_to_end(chat_id)
+
+    def _evict_idle_chats(self) -> None:
+        # Выгружаются только чаты, простаивающие дольше CHAT_DATA_MIN_IDLE_SECONDS, чтобы не отнять chat_data
+        # у запроса, который еще ждет ответа модели; до тех пор LRU временно может превышать лимит
+        now = time.monotonic()
+        while len(self._loaded_chats) > self.chat_cache_size:
+            chat_id, last_access = next(iter(self._loaded_chats.items()))
+            if now - last_access < CHAT_DATA_MIN_IDLE_SECONDS: break
+            del self._loaded_chats[chat_id]
+            self._forget_persisted_seq(chat_id)
+            if self.evict_callback: self.evict_callback(chat_id)
+            logger.debug(f"PostgresPersistence: чат {chat_id} выгружен из памяти.")
+
+    def _forget_persisted_seq(self, chat_id: int) -> None:
+        # Состояние чата в БД больше не известно; снимается и метка записи в полете, чтобы она не вернула старый seq
+        self._persisted_seq.pop(chat_id, None)
+        self._seq_writes.pop(chat_id, None)
+
+    # --- Отложенная запись (write-behind) ---
+    async def _write_chats(self, chats: dict[int, dict]) -> None:
+        # Инструкции собираются в цикле событий, пока chat_data не может измениться параллельно
+        statement_lists, history_seqs, mark, written = [], {}, object(), False
+        for chat_id, data in chats.items():
+            statement_lists.append(self._chat_write_statements(chat_id, data))
+            history_seqs[chat_id] = data.get("history_seq", 0)
+            self._seq_writes[chat_id] = mark
+        try:
+            with METRICS.persistence_write.time():
+                await self._write(self._merge_statements(statement_lists))
+            written = True
+        finally:
+            # Пока шла запись, чат могли удалить (drop_chat_data) или выгрузить — тогда его seq не восстанавливаем;
+            # более поздняя запись того же чата сменила метку и обновит seq сама
+            for chat_id, seq in history_seqs.items():
+                if self._seq_writes.get(chat_id) is not mark: continue
+                del self._seq_writes[chat_id]
+                if written and self.storage_mode == "rows": self._persisted_seq[chat_id] = seq
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    def _cancel_flush_task(self) -> None:
+        if self._flush_task and not self._flush_task.done(): self._flush_task.cancel()
+        self._flush_task = None
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.write_delay)
+        self._flush_task = None
+        await self.flush()
+
+    # --- Учет обработанных update_id (UpdateDeduplicator) ---
+    async def claim_update(self, update_id: int) -> bool:
+        # True, если апдейт встречается впервые; вставка атомарна, поэтому работает и между репликами
+        row = await self._fetch_one("INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT (update_id) DO NOTHING RETURNING update_id;", (update_id,))
+        return row is not None
+    async def release_update(self, update_id: int) -> None: await self._write([("DELETE FROM processed_updates WHERE update_id = %s;", [(update_id,)])])
+    async def prune_updates(self, ttl_seconds: float) -> None:
+        await self._write([("DELETE FROM processed_updates WHERE received_at < now() - make_interval(secs => %s);", [(float(ttl_seconds),)])])
+
+    # --- Кэш загрузок в File API (FileUploadCache) ---
+    async def get_cached_file(self, cache_key: str) -> tuple[str, str, float] | None:
+        row = await self._fetch_one("SELECT file_uri, mime_type, expires_at FROM file_cache WHERE cache_key = %s AND expires_at > %s;", (cache_key, time.time()))
+        return tuple(row) if row else None
+    async def put_cached_file(self, cache_keys: list[str], file_uri: str, mime_type: str, expires_at: float) -> None:
+        await self._write([("INSERT INTO file_cache (cache_key, file_uri, mime_type, expires_at) VALUES (%s, %s, %s, %s) "
+                            "ON CONFLICT (cache_key) DO UPDATE SET file_uri = EXCLUDED.file_uri, mime_type = EXCLUDED.mime_type, expires_at = EXCLUDED.expires_at;",
+                            [(key, file_uri, mime_type, expires_at) for key in cache_keys])])
+    async def prune_cached_files(self) -> None: await self._write([("DELETE FROM file_cache WHERE expires_at < %s;", [(time.time(),)])])
+
+    # --- Кэш ответов утилитарных команд (ResponseCache) ---
+    async def get_cached_response(self, cache_key: str) -> tuple[str, float] | None:
+        row = await self._fetch_one("SELECT response, expires_at FROM response_cache WHERE cache_key = %s AND expires_at > %s;", (cache_key, time.time()))
+        return tuple(row) if row else None
+    async def put_cached_response(self, cache_key: str, response: str, expires_at: float) -> None:
+        await self._write([("INSERT INTO response_cache (cache_key, response, expires_at) VALUES (%s, %s, %s) "
+                            "ON CONFLICT (cache_key) DO UPDATE SET response = EXCLUDED.response, expires_at = EXCLUDED.expires_at;", [(cache_key, response, expires_at)])])
+    async def prune_cached_responses(self) -> None: await self._write([("DELETE FROM response_cache WHERE expires_at < %s;", [(time.time(),)])])
+
+    # --- Медиа-контексты для ответов на файлы (MediaContextStore) ---
+    async def get_media_context(self, chat_id: int, message_id: int) -> tuple[str, str, float] | None:
+        row = await self._fetch_one("SELECT file_uri, mime_type, expires_at FROM media_contexts WHERE chat_id = %s AND message_id = %s AND expires_at > %s;",
+                                    (chat_id, message_id, time.time()))
+        return tuple(row) if row else None
+    async def put_media_context(self, chat_id: int, message_ids: list[int], file_uri: str, mime_type: str, expires_at: float) -> None:
+        await self._write([("INSERT INTO media_contexts (chat_id, message_id, file_uri, mime_type, expires_at) VALUES (%s, %s, %s, %s, %s) "
+                            "ON CONFLICT (chat_id, message_id) DO UPDATE SET file_uri = EXCLUDED.file_uri, mime_type = EXCLUDED.mime_type, expires_at = EXCLUDED.expires_at;",
+                            [(chat_id, message_id, file_uri, mime_type, expires_at) for message_id in message_ids])])
+    async def drop_media_contexts(self, chat_id: int) -> None: await self._write([("DELETE FROM media_contexts WHERE chat_id = %s;", [(chat_id,)])])
+    async def prune_media_contexts(self) -> None: await self._write([("DELETE FROM media_contexts WHERE expires_at < %s;", [(time.time(),)])])
+
     async def get_bot_data(self) -> dict: return defaultdict(dict)
     async def update_bot_data(self, data: dict) -> None: pass
-    async def get_chat_data(self) -> defaultdict[int, dict]:
-        all_data = await asyncio.to_thread(self._execute, "SELECT key, data FROM persistence_data WHERE key LIKE 'chat_data_%';", fetch="all")
-        chat_data = defaultdict(dict)
-        if all_data:
-            for k, d in all_data:
-                try: chat_data[int(k.split('_')[-1])] = pickle.loads(d)
-                except (ValueError, IndexError, pickle.UnpicklingError): logger.warning(f"Обнаружен некорректный ключ или данные чата в БД: '{k}'. Запись пропущена.")
-        return chat_data
-    async def update_chat_data(self, chat_id: int, data: dict) -> None: await asyncio.to_thread(self._set_pickled, f"chat_data_{chat_id}", data)
-    async def drop_chat_data(self, chat_id: int) -> None: await asyncio.to_thread(self._execute, "DELETE FROM persistence_data WHERE key = %s;", (f"chat_data_{chat_id}",))
+    async def get_chat_data(self) -> defaultdict[int, dict]: return defaultdict(dict) # Чаты загружаются лениво в refresh_chat_data
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        # PTB вызывает этот метод только из update_persistence, а та работает лишь после application.start()
+        # или в Application.shutdown() — main() не вызывает ни то, ни другое, так что путем записи он не является.
+        # chat_data пишет сам бот, один раз в конце хода (ChatLockManager.save -> save_chat_data)
+        if chat_id in self._loaded_chats: self._touch_chat(chat_id)
+    async def save_chat_data(self, chat_id: int, data: dict) -> None:
+        if chat_id in self._loaded_chats: self._touch_chat(chat_id)
+        if self.write_delay <= 0: return await self._write_chats({chat_id: data})
+        self._dirty_chats[chat_id] = data
+        self._schedule_flush()
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._loaded_chats.pop(chat_id, None)
+        self._dirty_chats.pop(chat_id, None)
+        self._forget_persisted_seq(chat_id)
+        await self._write(self._chat_drop_statements(chat_id))
     async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
-        try:
-            data = await asyncio.to_thread(self._get_pickled, f"chat_data_{chat_id}") or {}
-            chat_data.update(data)
-        except psycopg2.Error as e:
-            logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА БД: Не удалось обновить данные для чата {chat_id}. Ошибка: {e}")
+        if chat_id in self._loaded_chats:
+            self._touch_chat(chat_id)
+            return
+        if chat_id in self._dirty_chats:
+            # Чат выгружен из памяти раньше, чем его изменения ушли в БД — берем их из очереди записи.
+            # _persisted_seq не трогаем: эти записи в БД еще не попали
+            chat_data.update(self._dirty_chats[chat_id])
+        else:
+            try:
+                data = await self._load_chat(chat_id) or {}
+                chat_data.update(data)
+            except self.db_errors as e:
+                logger.critical(f"КРИТИЧЕСКАЯ ОШИБКА БД: Не удалось обновить данные для чата {chat_id}. Ошибка: {e}")
+                raise ChatDataUnavailable(chat_id) from e
+            if self.storage_mode == "rows": self._persisted_seq[chat_id] = data.get("history_seq", 0)
+        self._touch_chat(chat_id)
+        self._evict_idle_chats()
     async def get_user_data(self) -> defaultdict[int, dict]: return defaultdict(dict)
     async def update_user_data(self, user_id: int, data: dict) -> None: pass
     async def drop_user_data(self, user_id: int) -> None: pass
@@ -166,9 +689,118 @@ class PostgresPersistence(BasePersistence):
     async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None: pass
     async def refresh_bot_data(self, bot_data: dict) -> None: pass
     async def refresh_user_data(self, user_id: int, user_data: dict) -> None: pass
-    async def flush(self) -> None: pass
-    def close(self):
-        if self.db_pool: self.db_pool.closeall()
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._dirty_chats: return
+            pending, self._dirty_chats = self._dirty_chats, {}
+            try:
+                await self._write_chats(pending)
+                logger.debug(f"PostgresPersistence: записаны данные {len(pending)} чатов.")
+            except Exception as e:
+                logger.error(f"PostgresPersistence: Не удалось записать данные {len(pending)} чатов, повтор через {self.write_delay} с. Ошибка: {e}")
+                for chat_id, data in pending.items(): self._dirty_chats.setdefault(chat_id, data)
+                self._schedule_flush()
+
+class AsyncPostgresPersistence(PostgresPersistence):
+    # Тот же формат хранения, что у PostgresPersistence, но на нативном asyncio-драйвере asyncpg:
+    # без пула потоков и блокирующих sleep, с асинхронным пулом соединений. asyncpg готовит каждый запрос
+    # один раз на соединение и держит подготовленные выражения в кэше (DB_STATEMENT_CACHE_SIZE).
+    db_errors = (asyncpg.PostgresError, asyncpg.InterfaceError, OSError)
+    connection_errors = (asyncpg.PostgresConnectionError, asyncpg.InterfaceError, OSError)
+
+    def _connect_with_retry(self, retries=5, delay=5): pass # Пул asyncpg создается асинхронно в connect()
+
+    async def connect(self, retries=5):
+        for attempt in range(retries):
+            try:
+                self.db_pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size,
+                                                         statement_cache_size=DB_STATEMENT_CACHE_SIZE, max_inactive_connection_lifetime=300)
+                await self._initialize_db_async()
+                logger.info(f"AsyncPostgresPersistence: Успешное подключение к БД (режим хранения: {self.storage_mode}, пул {self.min_size}-{self.max_size}).")
+                return
+            except self.db_errors as e:
+                logger.error(f"AsyncPostgresPersistence: Не удалось подключиться к БД (попытка {attempt + 1}/{retries}): {e}")
+                await self.close()
+                if attempt < retries - 1:
+                    await asyncio.sleep(db_retry_delay(attempt, base=2.0, cap=30.0))
+                else:
+                    raise
+
+    async def _run_async(self, operation, retries=3):
+        last_exception = None
+        for attempt in range(retries):
+            try:
+                async with self.db_pool.acquire() as conn:
+                    return await operation(conn)
+            except self.connection_errors as e:
+                logger.warning(f"Postgres (asyncpg): Ошибка соединения (попытка {attempt + 1}/{retries}): {e}")
+                last_exception = e
+                if attempt < retries - 1:
+                    await asyncio.sleep(db_retry_delay(attempt))
+        logger.error(f"Postgres (asyncpg): Не удалось выполнить запрос после {retries} попыток. Последняя ошибка: {last_exception}")
+        raise last_exception
+
+    async def _initialize_db_async(self):
+        async def create_schema(conn):
+            for query in self._schema_statements(): await conn.execute(query)
+        await self._run_async(create_schema)
+        if self.storage_mode == "rows" and WORKER_INDEX is None:
+            blobs = await self._run_async(lambda conn: conn.fetch(self.SQL_SELECT_CHAT_BLOBS))
+            for key, blob in blobs:
+                migration = self._migration_statements(key, blob)
+                if not migration: continue
+                chat_id, history_seq, statements = migration
+                await self._write(statements)
+                self._persisted_seq[chat_id] = history_seq
+            if blobs: logger.info(f"AsyncPostgresPersistence: {len(blobs)} чатов перенесено из blob-режима в построчное хранение.")
+
+    async def _load_chat(self, chat_id: int) -> dict | None:
+        async def operation(conn):
+            if self.storage_mode == "blob":
+                blob = await conn.fetchval(to_asyncpg_query(self.SQL_SELECT_BLOB), f"chat_data_{chat_id}")
+                return self.serializer.loads(blob) if blob else None
+            meta = await conn.fetchval(to_asyncpg_query(self.SQL_SELECT_META), chat_id)
+            if meta is None: return None
+            entries = await conn.fetch(to_asyncpg_query(self.SQL_SELECT_HISTORY), chat_id)
+            return self._decode_chat_rows(meta, [row[0] for row in entries])
+        return await self._run_async(operation)
+
+    async def _fetch_one(self, query: str, params: tuple) -> tuple | None:
+        return await self._run_async(lambda conn: conn.fetchrow(to_asyncpg_query(query), *params))
+
+    async def _write(self, statements: list[tuple[str, list[tuple]]]) -> None:
+        async def operation(conn):
+            async with conn.transaction():
+                for query, params_list in statements:
+                    if params_list: await conn.executemany(to_asyncpg_query(query), params_list)
+        await self._run_async(operation)
+
+    async def close(self):
+        self._cancel_flush_task()
+        if self.db_pool:
+            await self.db_pool.close()
+            self.db_pool = None
+
+def unload_chat_data(application: Application, chat_id: int) -> None:
+    # evict_callback PostgresPersistence: chat_data убирается только из памяти. Application.drop_chat_data не подходит —
+    # он ставит чат в очередь удаления из persistence, которую PTB разбирает лишь в update_persistence: без
+    # application.start() очередь росла бы без предела, а с ним данные выгруженного чата стерлись бы из БД
+    application._chat_data.pop(chat_id, None)
+
+async def create_persistence(database_url: str | None) -> PostgresPersistence | None:
+    # Драйвер выбирается по PERSISTENCE_BACKEND или по схеме DSN postgresql+asyncpg://
+    if not database_url: return None
+    backend = PERSISTENCE_BACKEND
+    scheme, sep, rest = database_url.partition("://")
+    if scheme.endswith("+asyncpg"):
+        backend, database_url = "asyncpg", f"{scheme.removesuffix('+asyncpg')}{sep}{rest}"
+    if backend == "asyncpg":
+        persistence = AsyncPostgresPersistence(database_url)
+        await persistence.connect()
+        return persistence
+    if backend != "psycopg2":
+        raise ValueError(f"Неизвестный PERSISTENCE_BACKEND: '{backend}'")
+    return PostgresPersistence(database_url)
 
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 def get_current_time_str(timezone: str = "Europe/Moscow") -> str:
@@ -225,152 +857,992 @@ def ignore_if_processing(func):
 
 def part_to_dict(part: types.Part) -> dict:
     if part.text: return {'type': 'text', 'content': part.text}
-    if part.file_data: return {'type': 'file', 'uri': part.file_data.file_uri, 'mime': part.file_data.mime_type, 'timestamp': time.time()}
+    if part.file_data: return {'type': 'file', 'uri': part.file_data.file_uri, 'mime': part.file_data.mime_type}
     return {}
 
 def dict_to_part(part_dict: dict) -> types.Part | None:
     if not isinstance(part_dict, dict): return None
     if part_dict.get('type') == 'text': return types.Part(text=part_dict.get('content', ''))
     if part_dict.get('type') == 'file':
-        if time.time() - part_dict.get('timestamp', 0) > MEDIA_CONTEXT_TTL_SECONDS:
-            logger.info(f"Медиа-контекст {part_dict.get('uri')} протух и будет проигнорирован.")
-            return None
         return types.Part(file_data=types.FileData(file_uri=part_dict['uri'], mime_type=part_dict['mime']))
     return None
 
-def build_history_for_request(chat_history: list) -> list[types.Content]:
-    valid_history, current_chars = [], 0
-    for entry in reversed(chat_history):
-        if entry.get("role") in ("user", "model") and isinstance(entry.get("parts"), list):
-            entry_api_parts = []
-            entry_text_len = 0
-            if entry.get("role") == "user":
-                user_id = entry.get('user_id', 'Unknown')
-                user_name = entry.get('user_name', 'User')
-                user_prefix = f"[{user_id}; Name: {user_name}]: "
-                
-                for part_dict in entry["parts"]:
-                    # В историю для API отправляется только текст
-                    if part_dict.get('type') == 'text':
-                        prefixed_text = f"{user_prefix}{part_dict.get('content', '')}"
-                        entry_api_parts.append(types.Part(text=prefixed_text))
-                        entry_text_len += len(prefixed_text)
-            else: # model
-                for part_dict in entry["parts"]:
-                    if part_dict.get('type') == 'text':
-                        text = part_dict.get('content', '')
-                        entry_api_parts.append(types.Part(text=text))
-                        entry_text_len += len(text)
-
-            if not entry_api_parts: continue
-            
-            if current_chars + entry_text_len > MAX_CONTEXT_CHARS:
-                logger.info(f"Достигнут лимит контекста ({MAX_CONTEXT_CHARS} симв). История обрезана до {len(valid_history)} сообщений.")
-                break
-
-            clean_content = types.Content(role=entry["role"], parts=entry_api_parts)
-            valid_history.append(clean_content)
-            current_chars += entry_text_len
-            
-    valid_history.reverse()
-    return valid_history
-
-def find_media_context_in_history(context: ContextTypes.DEFAULT_TYPE, reply_to_id: int) -> dict | None:
-    chat_id = context.effective_chat.id
-    history = context.chat_data.get("history", [])
-    all_media_contexts = context.application.bot_data.setdefault('media_contexts', {})
-    chat_media_contexts = all_media_contexts.get(chat_id, {})
-    
-    current_reply_id = reply_to_id
-    for _ in range(len(history)):
-        bot_message = next((msg for msg in reversed(history) if msg.get("role") == "model" and msg.get("bot_message_id") == current_reply_id), None)
-        if bot_message and 'original_message_id' in bot_message:
-            user_msg_id = bot_message['original_message_id']
-            if user_msg_id in chat_media_contexts:
-                media_context = chat_media_contexts[user_msg_id]
-                if time.time() - media_context.get('timestamp', 0) < MEDIA_CONTEXT_TTL_SECONDS:
-                    return media_context
-                else:
-                    logger.info(f"Найденный медиа-контекст для msg_id {user_msg_id} протух.")
-                    return None
-            current_reply_id = user_msg_id
-        else:
-            if current_reply_id in chat_media_contexts:
-                media_context = chat_media_contexts[current_reply_id]
-                if time.time() - media_context.get('timestamp', 0) < MEDIA_CONTEXT_TTL_SECONDS:
-                    return media_context
-                else:
-                    logger.info(f"Найденный медиа-контекст для msg_id {current_reply_id} протух.")
-                    return None
-            break
-    return None
+TOKEN_CHAR_CLASSES = [ # (символы, сколько их в среднем на токен)
+    (re.compile(r"[a-zA-Z]"), 4.0),
+    (re.compile(r"[а-яА-ЯёЁ]"), 3.0),
+    (re.compile(r"[0-9]"), 1.0), # Gemini разбивает числа по цифрам
+    (re.compile(r"[^\w\s]"), 1.2), # Пунктуация, разметка, код
+    (re.compile(r"[^\sa-zA-Zа-яА-ЯёЁ0-9\W]"), 1.0), # Прочие письменности (CJK и т.п.)
+]
 
-async def upload_and_wait_for_file(client: genai.Client, file_bytes: bytes, mime_type: str, file_name: str) -> types.Part:
-    logger.info(f"Загрузка файла '{file_name}' ({len(file_bytes) / 1024:.2f} KB) через File API...")
-    try:
-        upload_config = types.UploadFileConfig(mime_type=mime_type, display_name=file_name)
-        upload_response = await client.aio.files.upload(
-            file=io.BytesIO(file_bytes),
-            config=upload_config
-        )
-        logger.info(f"Файл '{file_name}' загружен. Имя: {upload_response.name}. Ожидание статуса ACTIVE...")
+def estimate_tokens(text: str) -> float:
+    # Оценка до калибровки: токенизатор Gemini тратит на кириллицу, латиницу и код заметно разное число токенов
+    if not text: return 0.0
+    return sum(len(pattern.findall(text)) / chars_per_token for pattern, chars_per_token in TOKEN_CHAR_CLASSES) + 1
+
+class ContextOverflowError(Exception):
+    # Запрос больше лимита модели; actual/limit взяты из текста ошибки API, если он их содержит
+    def __init__(self, actual: int | None, limit: int | None):
+        super().__init__(f"Запрос ({actual} токенов) больше лимита модели ({limit}).")
+        self.actual, self.limit = actual, limit
+
+def parse_context_overflow(e: genai_errors.APIError) -> ContextOverflowError | None:
+    error_text = str(e).lower()
+    if not ("input token count" in error_text and "exceeds the maximum" in error_text): return None
+    numbers = [int(n) for n in re.findall(r"\((\d+)\)", error_text)[:2]]
+    return ContextOverflowError(*numbers) if len(numbers) == 2 else ContextOverflowError(None, None)
+
+class TokenBudget:
+    # Бюджет токенов запроса. estimate_tokens дает оценку по классам символов, а множитель factor подгоняет
+    # ее к реальности: после каждого ответа сравнивается оценка запроса и prompt_token_count из usage_metadata
+    # (скользящее среднее). История под бюджет выбирается в единицах estimate_tokens, то есть MAX_CONTEXT_TOKENS / factor.
+    EMA_WEIGHT = 0.2
+    FACTOR_BOUNDS = (0.5, 3.0)
+    OVERFLOW_MARGIN = 0.9 # После ошибки переполнения целимся в 90% лимита модели
+
+    def __init__(self, max_tokens: int = MAX_CONTEXT_TOKENS):
+        self.max_tokens = max_tokens
+        self.factor = 1.0
+        self.samples = 0
+        self.overflows = 0
+        self.model_limit: int | None = None # Лимит модели, узнанный из ошибки переполнения
+        self._system_tokens: float | None = None
+
+    def system_tokens(self) -> float:
+        if self._system_tokens is None: self._system_tokens = estimate_tokens(format_system_instruction())
+        return self._system_tokens
+
+    @staticmethod
+    def content_tokens(content: types.Content) -> float:
+        return sum(estimate_tokens(part.text) for part in content.parts if part.text)
+
+    def history_budget(self, new_content: types.Content) -> float:
+        max_tokens = min(self.max_tokens, self.model_limit * self.OVERFLOW_MARGIN) if self.model_limit else self.max_tokens
+        return max(0.0, max_tokens / self.factor - self.system_tokens() - self.content_tokens(new_content))
+
+    def observe(self, estimated: float, prompt_tokens: int | None) -> None:
+        if not estimated or not prompt_tokens: return
+        ratio = min(max(prompt_tokens / estimated, self.FACTOR_BOUNDS[0]), self.FACTOR_BOUNDS[1])
+        self.factor = ratio if not self.samples else self.factor + self.EMA_WEIGHT * (ratio - self.factor)
+        self.samples += 1
+
+    def overflow_budget(self, history_tokens: float, estimated: float, error: ContextOverflowError) -> float:
+        # Новый бюджет истории после ошибки переполнения: урезаем ровно на избыток с запасом, иначе вдвое
+        self.overflows += 1
+        if not error.actual or not error.limit: return history_tokens / 2
+        self.model_limit = error.limit
+        self.observe(estimated, error.actual)
+        return max(0.0, history_tokens - (error.actual - error.limit * self.OVERFLOW_MARGIN) / self.factor)
+
+    def stats(self) -> dict:
+        return {"token_factor": round(self.factor, 3), "token_samples": self.samples, "context_overflows": self.overflows}
+
+def history_entry_to_content(entry: dict) -> tuple[types.Content | None, float]:
+    # Запись истории -> Content для API и оценка числа токенов в нем (некалиброванная, см. TokenBudget)
+    if entry.get("role") not in ("user", "model", "summary") or not isinstance(entry.get("parts"), list): return None, 0
+    entry_api_parts = []
+    if entry.get("role") == "summary":
+        # Сводка старой части разговора (HistoryCompactor) — идет в запрос от имени пользователя
+        summary_text = "\n".join(part_dict.get('content', '') for part_dict in entry["parts"] if part_dict.get('type') == 'text')
+        if not summary_text: return None, 0
+        text = f"[Краткое содержание более ранней части разговора]:\n{summary_text}"
+        return types.Content(role="user", parts=[types.Part(text=text)]), estimate_tokens(text)
+    if entry.get("role") == "user":
+        user_id = entry.get('user_id', 'Unknown')
+        user_name = entry.get('user_name', 'User')
+        user_prefix = f"[{user_id}; Name: {user_name}]: "
         
-        file_response = await client.aio.files.get(name=upload_response.name)
-        
-        for _ in range(15):
-            if file_response.state.name == 'ACTIVE':
-                logger.info(f"Файл '{file_name}' активен.")
-                return types.Part(file_data=types.FileData(file_uri=file_response.uri, mime_type=mime_type))
-            if file_response.state.name == 'FAILED':
-                raise IOError(f"Ошибка обработки файла '{file_name}' на сервере Google.")
-            await asyncio.sleep(2)
-            file_response = await client.aio.files.get(name=upload_response.name)
-
-        raise asyncio.TimeoutError(f"Файл '{file_name}' не стал активным за 30 секунд.")
+        for part_dict in entry["parts"]:
+            # В историю для API отправляется только текст
+            if part_dict.get('type') == 'text':
+                prefixed_text = f"{user_prefix}{part_dict.get('content', '')}"
+                entry_api_parts.append(types.Part(text=prefixed_text))
+    else: # model
+        for part_dict in entry["parts"]:
+            if part_dict.get('type') == 'text':
+                text = part_dict.get('content', '')
+                entry_api_parts.append(types.Part(text=text))
+
+    if not entry_api_parts: return None, 0
+    return types.Content(role=entry["role"], parts=entry_api_parts), sum(estimate_tokens(part.text) for part in entry_api_parts)
+
+class HistoryIndex:
+    # Инкрементальное представление истории чата для запроса: готовые Content и оценки токенов записей плюс
+    # нарастающая сумма токенов, поэтому окно под бюджет выбирается бинарным поиском,
+    # а новая запись в add_to_history добавляется за O(1). Индекс сверяется с самим списком истории
+    # (тот же объект, длина и последняя запись) и перестраивается целиком, если историю заменили —
+    # /clear, загрузка чата из БД или обрезка в обход add_to_history.
+    def __init__(self):
+        self.summary_item: tuple[dict, types.Content, float] | None = None
+        self._reset(None)
+
+    def _reset(self, history: list | None) -> None:
+        self.history = history
+        self.items: list[tuple[dict, types.Content, float]] = [] # (запись, Content, токенов)
+        self.starts: list[float] = [] # токенов во всех записях до этой, с начала жизни индекса
+        self.positions: list[int] = [] # сквозной номер записи в истории (записи без текста в items не попадают)
+        self.head = 0 # первый элемент items, еще присутствующий в истории
+        self.base = 0 # сквозной номер history[0]
+        self.total = 0
+        self.length = 0
+        self.last_entry = None
+
+    def _add(self, entry: dict) -> None:
+        content, tokens = history_entry_to_content(entry)
+        if content is not None:
+            self.items.append((entry, content, tokens))
+            self.starts.append(self.total)
+            self.positions.append(self.base + self.length)
+            self.total += tokens
+        self.length += 1
+        self.last_entry = entry
+
+    def is_current(self, history: list) -> bool:
+        return history is self.history and len(history) == self.length and (not history or history[-1] is self.last_entry)
+
+    def rebuild(self, history: list) -> None:
+        self._reset(history)
+        for entry in history: self._add(entry)
+
+    def appended(self, history: list) -> None:
+        # Вызывается сразу после history.append(entry)
+        if history is self.history and len(history) == self.length + 1 and (self.length == 0 or history[-2] is self.last_entry): self._add(history[-1])
+        else: self.history = None
+
+    def trimmed(self, history: list, removed: int) -> None:
+        # История заменена срезом old[removed:]
+        if len(history) != self.length - removed or self.history is None:
+            self.history = None
+            return
+        self.history, self.base, self.length = history, self.base + removed, self.length - removed
+        while self.head < len(self.items) and self.positions[self.head] < self.base: self.head += 1
+        if self.head > 32 and self.head * 2 > len(self.items):
+            del self.items[:self.head], self.starts[:self.head], self.positions[:self.head]
+            self.head = 0
+
+    def tokens(self, history: list) -> float:
+        if not self.is_current(history): self.rebuild(history)
+        return self.total - self.starts[self.head] if self.head < len(self.items) else 0.0
+
+    def window(self, history: list, budget: float, summary: dict | None = None) -> list[tuple[dict, types.Content, float]]:
+        # Последние записи истории, укладывающиеся в budget токенов (в единицах estimate_tokens);
+        # сводка старой части разговора, если есть и помещается, идет первой
+        if not self.is_current(history): self.rebuild(history)
+        summary_item = None
+        if summary:
+            if self.summary_item is None or self.summary_item[0] is not summary:
+                content, tokens = history_entry_to_content(summary)
+                self.summary_item = (summary, content, tokens) if content else None
+            if self.summary_item and self.summary_item[2] <= budget:
+                summary_item = self.summary_item
+                budget -= summary_item[2]
+        start = bisect.bisect_left(self.starts, self.total - budget, self.head)
+        if start > self.head:
+            logger.info(f"Достигнут лимит контекста (~{budget:.0f} токенов на историю). История обрезана до {len(self.items) - start} сообщений.")
+        return ([summary_item] if summary_item else []) + self.items[start:]
+
+def get_history_index(context: ContextTypes.DEFAULT_TYPE) -> HistoryIndex:
+    # Индексы живут только в памяти процесса, не дольше CHAT_DATA_CACHE_SIZE последних чатов
+    indexes = context.bot_data.setdefault('history_indexes', OrderedDict())
+    chat_id = context.chat_data.get('id')
+    index = indexes.get(chat_id)
+    if index is None:
+        index = indexes[chat_id] = HistoryIndex()
+        if len(indexes) > CHAT_DATA_CACHE_SIZE: indexes.popitem(last=False)
+    indexes.move_to_end(chat_id)
+    return index
+
+class MediaContextStore:
+    # Файл, к которому относится сообщение: ответ (reply) на сообщение с файлом или на ответ бота по нему
+    # снова отправляет файл в модель. Запись хранится под id сообщения пользователя с файлом, а add_to_history
+    # через link копирует ее под id ответа бота — цепочка reply разрешается одним поиском по (чат, id сообщения).
+    # Записи живут MEDIA_CONTEXT_TTL_SECONDS с момента сохранения; в памяти — до MAX_MEDIA_CONTEXTS файлов на чат
+    # для CHAT_DATA_CACHE_SIZE последних чатов, с persistence — еще и в таблице media_contexts.
+    PRUNE_INTERVAL_SECONDS = 3600
+
+    def __init__(self, persistence: PostgresPersistence | None = None, ttl: float = MEDIA_CONTEXT_TTL_SECONDS,
+                 per_chat: int = 2 * MAX_MEDIA_CONTEXTS, max_chats: int = CHAT_DATA_CACHE_SIZE): # Сообщение с файлом + ответ бота
+        self.persistence = persistence
+        self.ttl, self.per_chat, self.max_chats = ttl, per_chat, max_chats
+        self.counters = {"media_context_hits": 0, "media_context_db_hits": 0, "media_context_misses": 0}
+        self._chats: OrderedDict[int, OrderedDict[int, tuple[str, str, float]]] = OrderedDict() # чат -> id сообщения -> (file_uri, mime_type, expires_at)
+        self._last_prune = 0.0
+
+    def _put_local(self, chat_id: int, message_ids: list[int], entry: tuple[str, str, float]) -> None:
+        chat_entries = self._chats.get(chat_id)
+        if chat_entries is None:
+            chat_entries = self._chats[chat_id] = OrderedDict()
+            if len(self._chats) > self.max_chats: self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+        for message_id in message_ids: chat_entries[message_id] = entry
+        while len(chat_entries) > self.per_chat: chat_entries.popitem(last=False)
+
+    async def _store(self, chat_id: int, message_ids: list[int], entry: tuple[str, str, float]) -> None:
+        self._put_local(chat_id, message_ids, entry)
+        if not self.persistence: return
+        try: await self.persistence.put_media_context(chat_id, message_ids, *entry)
+        except self.persistence.db_errors as e: logger.warning(f"Не удалось сохранить медиа-контекст в БД: {e}")
+
+    async def put(self, chat_id: int, message_id: int, part: types.Part) -> None:
+        await self._store(chat_id, [message_id], (part.file_data.file_uri, part.file_data.mime_type, time.time() + self.ttl))
+        await self._prune()
+        logger.info(f"Сохранен медиа-контекст для msg_id {message_id} в чате {chat_id}")
+
+    async def link(self, chat_id: int, message_id: int, original_message_id: int) -> None:
+        # Файл сообщения original_message_id (если он есть) теперь доступен и по ответу на message_id.
+        # Запись о файле сохраняется в том же ходе раньше ответа бота, поэтому в БД здесь не заглядываем
+        entry = self._chats.get(chat_id, {}).get(original_message_id)
+        if entry and entry[2] > time.time(): await self._store(chat_id, [message_id], entry)
+
+    async def get(self, chat_id: int, message_id: int) -> types.Part | None:
+        entry = self._chats.get(chat_id, {}).get(message_id)
+        if entry and entry[2] > time.time():
+            self.counters["media_context_hits"] += 1
+        elif self.persistence:
+            try: entry = await self.persistence.get_media_context(chat_id, message_id)
+            except self.persistence.db_errors as e:
+                logger.warning(f"Не удалось прочитать медиа-контекст из БД: {e}")
+                entry = None
+            if entry:
+                self.counters["media_context_db_hits"] += 1
+                self._put_local(chat_id, [message_id], entry)
+        else: entry = None
+        if not entry:
+            self.counters["media_context_misses"] += 1
+            return None
+        return types.Part(file_data=types.FileData(file_uri=entry[0], mime_type=entry[1]))
+
+    async def forget_chat(self, chat_id: int) -> None:
+        self._chats.pop(chat_id, None)
+        if not self.persistence: return
+        try: await self.persistence.drop_media_contexts(chat_id)
+        except self.persistence.db_errors as e: logger.warning(f"Не удалось удалить медиа-контексты чата из БД: {e}")
+
+    async def _prune(self) -> None:
+        # Протухшие записи удаляются раз в PRUNE_INTERVAL_SECONDS, а не проверкой при каждом чтении
+        if time.monotonic() - self._last_prune < self.PRUNE_INTERVAL_SECONDS: return
+        self._last_prune, now = time.monotonic(), time.time()
+        for chat_id in list(self._chats):
+            chat_entries = self._chats[chat_id]
+            for message_id in [message_id for message_id, entry in chat_entries.items() if entry[2] <= now]: del chat_entries[message_id]
+            if not chat_entries: del self._chats[chat_id]
+        if not self.persistence: return
+        try: await self.persistence.prune_media_contexts()
+        except self.persistence.db_errors as e: logger.warning(f"Не удалось очистить медиа-контексты в БД: {e}")
+
+@asynccontextmanager
+async def keyed_lock(locks: dict[str, list], key: str):
+    # Блокировка по ключу: параллельные запросы с одним ключом выполняются по очереди (второй найдет результат
+    # первого в кэше), запись о блокировке удаляется, когда ее больше никто не ждет
+    lock_entry = locks.setdefault(key, [asyncio.Lock(), 0])
+    lock_entry[1] += 1
+    try:
+        async with lock_entry[0]:
+            yield
+    finally:
+        lock_entry[1] -= 1
+        if not lock_entry[1]: locks.pop(key, None)
+
+class ChatLockManager:
+    # Ход чата — чтение истории, генерация, дописывание истории и запись в БД — выполняется под блокировкой чата,
+    # чтобы параллельные апдейты одного чата и фоновое сжатие истории не отправляли устаревшую историю и не
+    # теряли записи друг друга. Разные чаты друг друга не ждут. Блокировка живет, только пока чат ее держит
+    # или ждет. save — единственная запись chat_data за ход.
+    def __init__(self):
+        self._locks: dict[object, list] = {}
+        self.counters = {"chat_turns": 0, "chat_turn_waits": 0, "chat_saves": 0}
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def lock(self, chat_id: object):
+        started = time.monotonic()
+        if chat_id in self._locks: self.counters["chat_turn_waits"] += 1
+        async with keyed_lock(self._locks, chat_id):
+            self.counters["chat_turns"] += 1
+            self.max_wait = max(self.max_wait, time.monotonic() - started)
+            yield
+
+    async def save(self, application: Application, chat_id: int, chat_data: dict) -> None:
+        if not application.persistence: return
+        self.counters["chat_saves"] += 1
+        await application.persistence.save_chat_data(chat_id, chat_data)
+
+    def stats(self) -> dict:
+        return {**self.counters, "locked_chats": len(self._locks), "max_chat_turn_wait_seconds": round(self.max_wait, 3)}
+
+def serialize_chat(func):
+    # Обработчик, меняющий историю чата, выполняется под ChatLockManager.lock этого чата
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        if not update or not update.effective_chat:
+            return await func(update, context, *args, **kwargs)
+        async with context.bot_data['chat_locks'].lock(update.effective_chat.id):
+            return await func(update, context, *args, **kwargs)
+    return wrapper
 
-    except Exception as e:
-        logger.error(f"Ошибка при загрузке файла через File API: {e}", exc_info=True)
-        raise IOError(f"Не удалось загрузить или обработать файл '{file_name}' на сервере Google.")
+class TokenBucket:
+    # rate токенов в секунду, не больше capacity про запас. Отрицательный остаток — «долг» после паузы по 429
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens, self.updated = capacity, time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self) -> None:
+        self._refill()
+        self.tokens -= 1
+
+    def pause(self, seconds: float) -> None:
+        self._refill()
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class RateLimitExceeded(Exception):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Слишком много запросов, попробуйте через {retry_after:.0f} с.")
+
+class AdmissionController:
+    # Допуск запросов к Gemini. Каждый запрос пользователя сначала проходит корзины токенов чата и пользователя
+    # (admit): если корзина пуста, запрос ждет до ADMISSION_MAX_WAIT_SECONDS, дольше — RateLimitExceeded.
+    # Каждый вызов API (генерация, загрузка файла, сжатие истории) занимает один из GEMINI_MAX_CONCURRENCY слотов
+    # и токен общей корзины GEMINI_RPM (slot). Ожидающие слота стоят в очередях по чатам, слоты раздаются
+    # по кругу — шумная группа получает не больше других. 429/503 повторяются с экспоненциальной задержкой
+    # (или той, что просит API), повтор занимает тот же слот, а после 429 общая корзина на это время пустеет.
+    MAX_BUCKETS = 10000 # Корзин чатов/пользователей в памяти; полные (неиспользуемые) вытесняются первыми
+    RETRY_STATUSES = (429, 503)
+    RETRY_DELAY_REGEX = re.compile(r"retryDelay['\"]?\s*:\s*['\"](\d+(?:\.\d+)?)s")
+
+    def __init__(self, max_concurrency: int = GEMINI_MAX_CONCURRENCY, rpm: float = GEMINI_RPM, chat_rate: float = CHAT_RATE_PER_MINUTE,
+                 chat_burst: int = CHAT_RATE_BURST, user_rate: float = USER_RATE_PER_MINUTE, user_burst: int = USER_RATE_BURST,
+                 max_wait: float = ADMISSION_MAX_WAIT_SECONDS, retry_attempts: int = GEMINI_RETRY_ATTEMPTS, retry_max_delay: float = GEMINI_RETRY_MAX_DELAY):
+        self.max_concurrency = max_concurrency
+        self.global_bucket = TokenBucket(rpm / 60, max(1, min(rpm / 60 * 5, max_concurrency))) if rpm > 0 else None
+        self.limits = {"chat": (chat_rate / 60, chat_burst), "user": (user_rate / 60, user_burst)}
+        self.max_wait, self.retry_attempts, self.retry_max_delay = max_wait, retry_attempts, retry_max_delay
+        self.active = 0
+        self.counters = {"admitted": 0, "throttled": 0, "rate_limited": 0, "slot_waits": 0, "api_retries": 0, "api_retry_giveups": 0}
+        self.max_slot_wait = 0.0
+        self._buckets: OrderedDict[tuple, TokenBucket] = OrderedDict()
+        self._waiters: OrderedDict[object, deque] = OrderedDict() # ключ чата -> очередь future ожидающих слота
+        self._wakeup: asyncio.TimerHandle | None = None
+
+    def _bucket(self, kind: str, key: object) -> TokenBucket | None:
+        rate, burst = self.limits[kind]
+        if rate <= 0: return None
+        bucket = self._buckets.get((kind, key))
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                oldest = next((k for k, b in self._buckets.items() if b.is_full()), next(iter(self._buckets)))
+                del self._buckets[oldest]
+            bucket = self._buckets[(kind, key)] = TokenBucket(rate, burst)
+        self._buckets.move_to_end((kind, key))
+        return bucket
+
+    async def admit(self, chat_id: object, user_id: object = None) -> None:
+        buckets = [b for b in (self._bucket("chat", chat_id), self._bucket("user", user_id) if user_id is not None else None) if b]
+        wait = max((b.wait_time() for b in buckets), default=0.0)
+        if wait > self.max_wait:
+            self.counters["rate_limited"] += 1
+            logger.warning(f"ChatID: {chat_id} | Лимит запросов превышен (пользователь {user_id}), ждать {wait:.1f} с — запрос отклонен.")
+            raise RateLimitExceeded(wait)
+        for bucket in buckets: bucket.take() # Токен берется сразу: следующий запрос встанет в очередь за этим
+        if wait > 0:
+            self.counters["throttled"] += 1
+            logger.info(f"ChatID: {chat_id} | Лимит запросов: ожидание {wait:.1f} с.")
+            await asyncio.sleep(wait)
+        self.counters["admitted"] += 1
+
+    def _grant(self) -> None:
+        # Раздача свободных слотов по кругу между чатами, пока хватает токенов общей корзины
+        while self._waiters and self.active < self.max_concurrency:
+            wait = self.global_bucket.wait_time() if self.global_bucket else 0.0
+            if wait > 0:
+                if not self._wakeup: self._wakeup = asyncio.get_running_loop().call_later(wait, self._on_wakeup)
+                return
+            key, queue = next(iter(self._waiters.items()))
+            future = queue.popleft()
+            if queue: self._waiters.move_to_end(key)
+            else: del self._waiters[key]
+            if future.done(): continue # Ожидание отменено
+            if self.global_bucket: self.global_bucket.take()
+            self.active += 1
+            future.set_result(None)
+
+    def _on_wakeup(self) -> None:
+        self._wakeup = None
+        self._grant()
+
+    @asynccontextmanager
+    async def slot(self, key: object = None):
+        if not self._waiters and self.active < self.max_concurrency and not (self.global_bucket and self.global_bucket.wait_time() > 0):
+            if self.global_bucket: self.global_bucket.take()
+            self.active += 1
+        else:
+            self.counters["slot_waits"] += 1
+            started = time.monotonic()
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.setdefault(key, deque()).append(future)
+            self._grant()
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled(): self._release() # Слот успели выдать
+                raise
+            self.max_slot_wait = max(self.max_slot_wait, time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._grant()
+
+    def retry_delay(self, e: genai_errors.APIError, attempt: int) -> float | None:
+        if e.code not in self.RETRY_STATUSES or attempt >= self.retry_attempts: return None
+        requested = self.RETRY_DELAY_REGEX.search(str(e))
+        delay = max(float(requested.group(1)) if requested else 0.0, 1.0 + db_retry_delay(attempt, base=1.0, cap=self.retry_max_delay))
+        return delay if delay <= self.retry_max_delay else None
+
+    async def backoff(self, e: genai_errors.APIError, attempt: int) -> None:
+        # Пауза перед повтором; если повторять нельзя, пробрасывает исходную ошибку
+        delay = self.retry_delay(e, attempt)
+        if delay is None:
+            if e.code in self.RETRY_STATUSES: self.counters["api_retry_giveups"] += 1
+            raise e
+        self.counters["api_retries"] += 1
+        if e.code == 429 and self.global_bucket: self.global_bucket.pause(delay)
+        logger.warning(f"Gemini API ответил {e.code}, повтор {attempt + 1}/{self.retry_attempts} через {delay:.1f} с.")
+        await asyncio.sleep(delay)
+
+    async def call(self, func):
+        # func — функция без аргументов, возвращающая корутину; вызывается заново на каждый повтор
+        for attempt in itertools.count():
+            try:
+                return await func()
+            except genai_errors.APIError as e:
+                await self.backoff(e, attempt)
+
+    def stats(self) -> dict:
+        return {**self.counters, "active": self.active, "max_concurrency": self.max_concurrency, "waiting_chats": len(self._waiters),
+                "waiting": sum(len(queue) for queue in self._waiters.values()), "max_slot_wait_seconds": round(self.max_slot_wait, 3),
+                "rate_buckets": len(self._buckets)}
+
+class MediaDownloader:
+    # Файл из Telegram читается потоком частями по MEDIA_DOWNLOAD_CHUNK_KB в SpooledTemporaryFile: до
+    # MEDIA_SPOOL_MEMORY_MB он лежит в памяти, крупнее — на диске, и этот же объект отдается в File API.
+    # sha256 для FileUploadCache считается по ходу чтения. Все загрузки вместе резервируют не больше
+    # MEDIA_MEMORY_BUDGET_MB (буфер скачивания + часть загрузки в genai); сверх бюджета новые ждут очереди.
+    GENAI_UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024 # Размер части, которой клиент genai читает файл при загрузке
+
+    def __init__(self, budget_bytes: int = MEDIA_MEMORY_BUDGET_MB * 1024 * 1024, spool_bytes: int = MEDIA_SPOOL_MEMORY_MB * 1024 * 1024,
+                 chunk_bytes: int = MEDIA_DOWNLOAD_CHUNK_KB * 1024):
+        self.budget_bytes, self.spool_bytes, self.chunk_bytes = budget_bytes, spool_bytes, chunk_bytes
+        self.reserved_bytes = self.max_reserved_bytes = 0
+        self.waiting = 0
+        self.counters = {"downloads": 0, "spooled_to_disk": 0, "budget_waits": 0}
+        self._budget = asyncio.Condition()
+        self._session: aiohttp.ClientSession | None = None
+
+    def reservation_size(self, size_bytes: int) -> int:
+        # Больше бюджета не резервируется никогда, иначе такой файл ждал бы вечно
+        return min(self.budget_bytes, min(size_bytes, self.spool_bytes) + min(size_bytes, self.GENAI_UPLOAD_CHUNK_BYTES))
+
+    @asynccontextmanager
+    async def reserve(self, size_bytes: int):
+        amount = self.reservation_size(size_bytes)
+        async with self._budget:
+            if self.reserved_bytes + amount > self.budget_bytes:
+                self.counters["budget_waits"] += 1
+                self.waiting += 1
+                try: await self._budget.wait_for(lambda: self.reserved_bytes + amount <= self.budget_bytes)
+                finally: self.waiting -= 1
+            self.reserved_bytes += amount
+            self.max_reserved_bytes = max(self.max_reserved_bytes, self.reserved_bytes)
+        try:
+            yield
+        finally:
+            async with self._budget:
+                self.reserved_bytes -= amount
+                self._budget.notify_all()
+
+    async def download(self, media_file: File) -> tuple[io.IOBase, str, int]:
+        # Возвращает (файловый объект в начале, sha256, размер); закрыть объект должен вызывающий
+        spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        digest, size_bytes, started = hashlib.sha256(), 0, time.perf_counter()
+        try:
+            if not media_file.file_path: raise IOError("У файла нет file_path.")
+            if media_file.file_path.startswith(("http://", "https://")):
+                if self._session is None or self._session.closed:
+                    self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_connect=20, sock_read=60))
+                async with self._session.get(media_file.file_path) as response:
+                    response.raise_for_status()
+                    async for chunk in response.content.iter_chunked(self.chunk_bytes):
+                        digest.update(chunk)
+                        spool.write(chunk)
+                        size_bytes += len(chunk)
+            else:
+                # Локальный Bot API сервер отдает путь к файлу на диске
+                with open(media_file.file_path, "rb") as source:
+                    while chunk := await asyncio.to_thread(source.read, self.chunk_bytes):
+                        digest.update(chunk)
+                        spool.write(chunk)
+                        size_bytes += len(chunk)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            spool.close()
+            logger.error(f"Ошибка скачивания файла из Telegram: {e}")
+            raise IOError("Не удалось скачать файл из Telegram.")
+        METRICS.telegram_download.observe(time.perf_counter() - started)
+        self.counters["downloads"] += 1
+        if size_bytes > self.spool_bytes: self.counters["spooled_to_disk"] += 1
+        spool.seek(0)
+        return spool, digest.hexdigest(), size_bytes
+
+    async def close(self) -> None:
+        if self._session: await self._session.close()
+
+    def stats(self) -> dict:
+        return {**self.counters, "reserved_bytes": self.reserved_bytes, "max_reserved_bytes": self.max_reserved_bytes,
+                "budget_bytes": self.budget_bytes, "waiting": self.waiting}
+
+class FileUploadManager:
+    # Загрузка в File API и ожидание статуса ACTIVE. Интервал опроса files.get растет экспоненциально
+    # с джиттером от стартового значения, зависящего от типа файла: картинки обрабатываются за доли секунды,
+    # видео — десятки секунд. Таймаут ожидания растет с размером файла. Одновременных загрузок не больше
+    # FILE_UPLOAD_CONCURRENCY, одновременных запросов статуса — не больше FILE_POLL_CONCURRENCY.
+    POLL_PROFILES = {"image": (0.3, 2.0), "audio": (1.0, 5.0), "video": (2.0, 10.0)} # тип -> (первая пауза, предел паузы), сек
+    DEFAULT_POLL_PROFILE = (0.5, 5.0)
+
+    def __init__(self, max_uploads: int = FILE_UPLOAD_CONCURRENCY, max_polls: int = FILE_POLL_CONCURRENCY, admission: AdmissionController | None = None):
+        self.admission = admission or AdmissionController()
+        self._upload_semaphore = asyncio.Semaphore(max_uploads)
+        self._poll_semaphore = asyncio.Semaphore(max_polls)
+        self.counters = {"uploads": 0, "activated": 0, "upload_failures": 0, "upload_timeouts": 0, "status_polls": 0}
+        self.upload_seconds = self.max_upload_seconds = 0.0
+        self.active_seconds = self.max_active_seconds = 0.0
+
+    @staticmethod
+    def active_timeout(size_bytes: int) -> float:
+        return min(FILE_ACTIVE_TIMEOUT_MAX, FILE_ACTIVE_TIMEOUT_BASE + FILE_ACTIVE_TIMEOUT_PER_MB * size_bytes / (1024 * 1024))
+
+    @classmethod
+    def poll_delay(cls, mime_type: str, attempt: int) -> float:
+        base, cap = cls.POLL_PROFILES.get((mime_type or "").split("/")[0], cls.DEFAULT_POLL_PROFILE)
+        delay = min(cap, base * 1.6 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2) # Половинный джиттер: опросы не синхронны, но и не слишком часты
+
+    async def _get_file(self, client: genai.Client, name: str) -> types.File:
+        async with self._poll_semaphore:
+            self.counters["status_polls"] += 1
+            return await client.aio.files.get(name=name)
+
+    async def upload(self, client: genai.Client, file_obj: io.IOBase, size_bytes: int, mime_type: str, file_name: str, queue_key: object = None) -> tuple[types.File, float]:
+        # file_obj читается клиентом genai частями по 8 МБ, целиком в память он не копируется. Ожидание ACTIVE —
+        # отдельный шаг (wait_active): на время опроса ни буфер файла, ни резерв памяти MediaDownloader не нужны
+        logger.info(f"Загрузка файла '{file_name}' ({size_bytes / 1024:.2f} KB) через File API...")
+        try:
+            async with self._upload_semaphore:
+                started = time.monotonic()
+                upload_config = types.UploadFileConfig(mime_type=mime_type, display_name=file_name)
+                async def upload() -> types.File:
+                    file_obj.seek(0) # Повтор после 429/503 читает файл с начала
+                    return await client.aio.files.upload(file=file_obj, config=upload_config)
+                async with self.admission.slot(queue_key):
+                    upload_response = await self.admission.call(upload)
+                uploaded = time.monotonic()
+        except Exception as e:
+            self.counters["upload_failures"] += 1
+            logger.error(f"Ошибка при загрузке файла через File API: {e}", exc_info=True)
+            raise IOError(f"Не удалось загрузить файл '{file_name}' на сервер Google.")
+        self.counters["uploads"] += 1
+        METRICS.file_upload.observe(uploaded - started)
+        self.upload_seconds += uploaded - started
+        self.max_upload_seconds = max(self.max_upload_seconds, uploaded - started)
+        logger.info(f"Файл '{file_name}' загружен за {uploaded - started:.2f} с. Имя: {upload_response.name}. Ожидание статуса ACTIVE...")
+        return upload_response, uploaded
+
+    async def wait_active(self, client: genai.Client, upload_response: types.File, uploaded: float, size_bytes: int, mime_type: str, file_name: str) -> types.Part:
+        try:
+            timeout = self.active_timeout(size_bytes)
+            file_response, attempt = upload_response, 0
+            # Ответ upload уже содержит статус — маленькие файлы часто активны сразу, без лишнего files.get
+            while getattr(file_response.state, 'name', None) != 'ACTIVE':
+                if getattr(file_response.state, 'name', None) == 'FAILED':
+                    raise IOError(f"Ошибка обработки файла '{file_name}' на сервере Google.")
+                remaining = uploaded + timeout - time.monotonic()
+                if remaining <= 0:
+                    self.counters["upload_timeouts"] += 1
+                    raise asyncio.TimeoutError(f"Файл '{file_name}' не стал активным за {timeout:.0f} секунд.")
+                await asyncio.sleep(min(remaining, self.poll_delay(mime_type, attempt)))
+                attempt += 1
+                file_response = await self._get_file(client, upload_response.name)
+
+            active = time.monotonic() - uploaded
+            self.counters["activated"] += 1
+            METRICS.file_active_wait.observe(active)
+            self.active_seconds += active
+            self.max_active_seconds = max(self.max_active_seconds, active)
+            logger.info(f"Файл '{file_name}' активен через {active:.2f} с после загрузки.")
+            return types.Part(file_data=types.FileData(file_uri=file_response.uri, mime_type=mime_type))
+
+        except Exception as e:
+            self.counters["upload_failures"] += 1
+            logger.error(f"Ошибка при обработке файла в File API: {e}", exc_info=True)
+            raise IOError(f"Не удалось загрузить или обработать файл '{file_name}' на сервере Google.")
+
+    def stats(self) -> dict:
+        uploaded, activated = self.counters["uploads"], self.counters["activated"]
+        return {**self.counters, "avg_upload_seconds": round(self.upload_seconds / uploaded, 3) if uploaded else 0.0, "max_upload_seconds": round(self.max_upload_seconds, 3),
+                "avg_time_to_active_seconds": round(self.active_seconds / activated, 3) if activated else 0.0, "max_time_to_active_seconds": round(self.max_active_seconds, 3)}
+
+class FileUploadCache:
+    # Один и тот же файл часто приходит повторно: пересылка, /summarize и затем /keypoints на то же сообщение.
+    # Кэш связывает file_unique_id Telegram и sha256 содержимого с URI уже загруженного в File API файла,
+    # поэтому при попадании по file_unique_id не нужны ни скачивание из Telegram, ни загрузка в Google,
+    # а при попадании по хэшу — только загрузка. Записи живут FILE_CACHE_TTL_SECONDS (меньше 48 часов File API),
+    # в памяти держатся последние FILE_CACHE_SIZE ключей, с persistence — еще и в таблице file_cache, общей для реплик.
+    PRUNE_INTERVAL_SECONDS = 3600
+
+    def __init__(self, persistence: PostgresPersistence | None = None, uploader: FileUploadManager | None = None,
+                 downloader: MediaDownloader | None = None, max_size: int = FILE_CACHE_SIZE, ttl: float = FILE_CACHE_TTL_SECONDS):
+        self.persistence = persistence
+        self.uploader = uploader or FileUploadManager()
+        self.downloader = downloader or MediaDownloader()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.counters = {"file_cache_id_hits": 0, "file_cache_hash_hits": 0, "file_cache_uploads": 0}
+        self._entries: OrderedDict[str, tuple[str, str, float]] = OrderedDict() # ключ -> (file_uri, mime_type, expires_at)
+        self._locks: dict[str, list] = {} # file_unique_id -> [asyncio.Lock, число ожидающих] (keyed_lock)
+        self._last_prune = 0.0
+
+    def _get_local(self, key: str) -> tuple[str, str, float] | None:
+        entry = self._entries.get(key)
+        if entry is None: return None
+        if entry[2] <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _put_local(self, keys: list[str], entry: tuple[str, str, float]) -> None:
+        for key in keys:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size: self._entries.popitem(last=False)
+
+    async def _lookup(self, key: str) -> tuple[str, str, float] | None:
+        entry = self._get_local(key)
+        if entry or not self.persistence: return entry
+        try: entry = await self.persistence.get_cached_file(key)
+        except self.persistence.db_errors as e:
+            logger.warning(f"Не удалось прочитать кэш файлов из БД: {e}")
+            return None
+        if entry: self._put_local([key], entry)
+        return entry
 
-async def generate_response(client: genai.Client, request_contents: list, context: ContextTypes.DEFAULT_TYPE, tools: list) -> types.GenerateContentResponse | str:
-    chat_id = context.chat_data.get('id', 'Unknown')
-    
+    async def _store(self, keys: list[str], entry: tuple[str, str, float]) -> None:
+        self._put_local(keys, entry)
+        if not self.persistence: return
+        try:
+            await self.persistence.put_cached_file(keys, *entry)
+            if time.monotonic() - self._last_prune > self.PRUNE_INTERVAL_SECONDS:
+                self._last_prune = time.monotonic()
+                await self.persistence.prune_cached_files()
+        except self.persistence.db_errors as e: logger.warning(f"Не удалось сохранить кэш файлов в БД: {e}")
+
+    async def get_part(self, client: genai.Client, media_obj, mime_type: str, file_name: str, queue_key: object = None) -> types.Part:
+        # Параллельные запросы с одним файлом ждут друг друга, чтобы файл загрузился один раз
+        uid_key = f"uid:{media_obj.file_unique_id}"
+        async with keyed_lock(self._locks, uid_key):
+            entry = await self._lookup(uid_key)
+            if entry:
+                self.counters["file_cache_id_hits"] += 1
+                logger.info(f"Файл '{file_name}' взят из кэша File API без скачивания.")
+                return types.Part(file_data=types.FileData(file_uri=entry[0], mime_type=entry[1]))
+            media_file = await media_obj.get_file()
+            size_bytes = media_obj.file_size or media_file.file_size or self.downloader.spool_bytes
+            async with self.downloader.reserve(size_bytes):
+                file_obj, digest, size_bytes = await self.downloader.download(media_file)
+                with file_obj:
+                    hash_key = f"sha256:{digest}"
+                    entry = await self._lookup(hash_key)
+                    if entry:
+                        self.counters["file_cache_hash_hits"] += 1
+                        logger.info(f"Файл '{file_name}' уже загружен в File API под другим file_unique_id.")
+                        await self._store([uid_key], entry)
+                        return types.Part(file_data=types.FileData(file_uri=entry[0], mime_type=entry[1]))
+                    expires_at = time.time() + self.ttl
+                    uploaded_file, uploaded = await self.uploader.upload(client, file_obj, size_bytes, mime_type, file_name, queue_key)
+            # Буфер закрыт и резерв памяти отдан до ожидания ACTIVE, которое для видео длится минутами
+            part = await self.uploader.wait_active(client, uploaded_file, uploaded, size_bytes, mime_type, file_name)
+            self.counters["file_cache_uploads"] += 1
+            await self._store([uid_key, hash_key], (part.file_data.file_uri, mime_type, expires_at))
+            return part
+
+async def get_media_part(context: ContextTypes.DEFAULT_TYPE, media_obj, mime_type: str, file_name: str) -> types.Part:
+    return await context.bot_data['file_cache'].get_part(context.bot_data['gemini_client'], media_obj, mime_type, file_name, context.chat_data.get('id'))
+
+class ResponseCache:
+    # Готовые ответы на запросы без истории — /transcript, /summarize, /keypoints: одно и то же видео с YouTube
+    # или файл разбирают в разных чатах, а ответ от чата не зависит. Ключ — хэш (нормализованный промпт,
+    # идентичность медиа — id видео или file_unique_id, модель, набор инструментов). Записи живут
+    # RESPONSE_CACHE_TTL_SECONDS, в памяти — последние RESPONSE_CACHE_SIZE, с persistence еще и в таблице response_cache.
+    # Одинаковые запросы, пришедшие одновременно, выполняются один раз (lock), остальные берут ответ из кэша.
+    PRUNE_INTERVAL_SECONDS = 3600
+
+    def __init__(self, persistence: PostgresPersistence | None = None, max_size: int = RESPONSE_CACHE_SIZE, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self.persistence = persistence
+        self.max_size = max_size
+        self.ttl = ttl
+        self.counters = {"response_cache_hits": 0, "response_cache_misses": 0}
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict() # ключ -> (ответ, истекает)
+        self._locks: dict[str, list] = {}
+        self._last_prune = 0.0
+
+    @staticmethod
+    def make_key(prompt: str, media_id: str, model: str = MODEL_NAME, tools_kind: str = "media") -> str:
+        normalized = " ".join(prompt.split()).lower()
+        return hashlib.sha256(json.dumps([normalized, media_id, model, tools_kind], ensure_ascii=False).encode()).hexdigest()
+
+    async def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry and entry[1] > time.time():
+            self._entries.move_to_end(key)
+            return entry[0]
+        self._entries.pop(key, None)
+        if not self.persistence: return None
+        try: entry = await self.persistence.get_cached_response(key)
+        except self.persistence.db_errors as e:
+            logger.warning(f"Не удалось прочитать кэш ответов из БД: {e}")
+            return None
+        if not entry: return None
+        self._remember(key, entry)
+        return entry[0]
+
+    def _remember(self, key: str, entry: tuple[str, float]) -> None:
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size: self._entries.popitem(last=False)
+
+    async def put(self, key: str, response: str) -> None:
+        entry = (response, time.time() + self.ttl)
+        self._remember(key, entry)
+        if not self.persistence: return
+        try:
+            await self.persistence.put_cached_response(key, *entry)
+            if time.monotonic() - self._last_prune > self.PRUNE_INTERVAL_SECONDS:
+                self._last_prune = time.monotonic()
+                await self.persistence.prune_cached_responses()
+        except self.persistence.db_errors as e: logger.warning(f"Не удалось сохранить кэш ответов в БД: {e}")
+
+    async def get_or_generate(self, key: str, generate) -> str:
+        # generate() -> (текст, можно ли кэшировать); ошибки и заблокированные ответы не кэшируются
+        async with keyed_lock(self._locks, key):
+            cached = await self.get(key)
+            if cached is not None:
+                self.counters["response_cache_hits"] += 1
+                return cached
+            self.counters["response_cache_misses"] += 1
+            text, cacheable = await generate()
+            if cacheable: await self.put(key, text)
+            return text
+
+def is_complete_response(response: types.GenerateContentResponse | str) -> bool:
+    # Ответ дошел до конца без блокировок и содержит текст — такой можно отдавать повторно
+    if isinstance(response, str) or not response or not response.candidates: return False
+    candidate = response.candidates[0]
+    return bool(candidate.finish_reason and candidate.finish_reason.name == "STOP" and candidate.content and candidate.content.parts
+                and any(part.text for part in candidate.content.parts))
+
+def format_system_instruction(current_time: str | None = None) -> str:
     try:
-        final_system_instruction = SYSTEM_INSTRUCTION.format(current_time=get_current_time_str())
+        return SYSTEM_INSTRUCTION.format(current_time=current_time or get_current_time_str())
     except KeyError:
         logger.warning("В system_prompt.md отсутствует плейсхолдер {current_time}. Дата не будет подставлена.")
-        final_system_instruction = SYSTEM_INSTRUCTION
+        return SYSTEM_INSTRUCTION
 
-    config = types.GenerateContentConfig(
+def build_generate_config(tools: list, cached_content: str | None = None, thinking_budget: int = THINKING_BUDGET) -> types.GenerateContentConfig:
+    # С cached_content системная инструкция и инструменты уже лежат в кэше, повторно их передавать нельзя
+    return types.GenerateContentConfig(
         safety_settings=SAFETY_SETTINGS, 
-        tools=tools,
-        system_instruction=types.Content(parts=[types.Part(text=final_system_instruction)]),
+        tools=None if cached_content else tools,
+        system_instruction=None if cached_content else types.Content(parts=[types.Part(text=format_system_instruction())]),
+        cached_content=cached_content,
         temperature=1.0,
-        thinking_config=types.ThinkingConfig(thinking_budget=24576) # Максимальный бюджет на мышление
+        thinking_config=types.ThinkingConfig(thinking_budget=thinking_budget)
     )
+
+class ContextCacheManager:
+    # Явный кэш контекста Gemini (CONTEXT_CACHE_MODE):
+    #   system  — системная инструкция и инструменты кэшируются один раз на набор инструментов и общие для всех чатов;
+    #   history — вдобавок в чатах, где история длиннее CONTEXT_CACHE_MIN_TOKENS, кэшируется ее стабильный префикс.
+    #             Дальше отправляются только записи после префикса и новый ход. Кэш пересоздается, когда таких
+    #             записей больше CONTEXT_CACHE_MAX_TAIL_ITEMS, начало окна истории сдвинулось или TTL на исходе.
+    # Имя и срок кэша чата хранятся в chat_data['context_caches'] (переживают рестарт и видны репликам),
+    # /clear и /newtopic удаляют их. Текущее время в кэш не попадает — оно идет System Note в новом ходе.
+    CACHED_TIME_NOTE = "см. System Note в начале последнего сообщения пользователя"
+    EXPIRY_MARGIN_SECONDS = 120 # Кэш, истекающий раньше, не используется: запрос может не успеть
+    CREATE_RETRY_SECONDS = 600 # Пауза после неудачного создания общего кэша (например, слишком мало токенов)
+    CACHE_ERROR_PATTERN = re.compile(r"cached ?contents?\b", re.IGNORECASE) # "CachedContent not found (or permission denied)"
+
+    def __init__(self, mode: str = CONTEXT_CACHE_MODE, ttl: int = CONTEXT_CACHE_TTL_SECONDS):
+        if mode not in ("off", "system", "history"):
+            raise ValueError(f"Неизвестный CONTEXT_CACHE_MODE: '{mode}'")
+        self.mode = mode
+        self.ttl = ttl
+        self.counters = {"context_cache_hits": 0, "context_cache_created": 0, "context_cache_failures": 0, "context_cache_fallbacks": 0}
+        self._system_caches: dict[str, tuple[str, float]] = {} # набор инструментов -> (имя кэша, истекает)
+        self._system_retry_at: dict[str, float] = {}
+        self._system_lock = asyncio.Lock()
+        self._background: set[asyncio.Task] = set()
+
+    async def _create(self, client: genai.Client, model: str, tools: list, contents: list[types.Content], display_name: str) -> tuple[str, float] | None:
+        try:
+            cache = await client.aio.caches.create(model=model, config=types.CreateCachedContentConfig(
+                contents=contents or None, tools=tools, ttl=f"{self.ttl}s", display_name=display_name,
+                system_instruction=types.Content(parts=[types.Part(text=format_system_instruction(self.CACHED_TIME_NOTE))])))
+        except Exception as e:
+            # Кэш — только оптимизация: любая ошибка, включая сетевые и таймауты, означает запрос без кэша
+            self.counters["context_cache_failures"] += 1
+            logger.warning(f"Не удалось создать кэш контекста '{display_name}': {e}")
+            return None
+        self.counters["context_cache_created"] += 1
+        expires_at = cache.expire_time.timestamp() if cache.expire_time else time.time() + self.ttl
+        logger.info(f"Создан кэш контекста {cache.name} ('{display_name}').")
+        return cache.name, expires_at
+
+    def _delete_later(self, client: genai.Client, name: str) -> None:
+        async def delete():
+            try: await client.aio.caches.delete(name=name)
+            except genai_errors.APIError as e: logger.info(f"Кэш контекста {name} не удален (возможно, уже истек): {e}")
+        task = asyncio.create_task(delete())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _system_cache(self, client: genai.Client, kind: str, model: str, tools: list) -> str | None:
+        async with self._system_lock:
+            cached = self._system_caches.get(kind)
+            if cached and cached[1] - time.time() > self.EXPIRY_MARGIN_SECONDS: return cached[0]
+            if time.time() < self._system_retry_at.get(kind, 0): return None
+            created = await self._create(client, model, tools, [], f"system-{kind}")
+            if not created:
+                self._system_retry_at[kind] = time.time() + self.CREATE_RETRY_SECONDS
+                return None
+            self._system_caches[kind] = created
+            return created[0]
+
+    async def _history_cache(self, client: genai.Client, chat_data: dict, kind: str, model: str, tools: list, history: list[tuple[dict, types.Content, float]]) -> tuple[str, int] | None:
+        # Возвращает (имя кэша, сколько записей истории в нем) или None, если история короткая
+        if sum(tokens for _, _, tokens in history) < CONTEXT_CACHE_MIN_TOKENS: return None
+        seqs = [entry.get("seq") for entry, _, _ in history]
+        chat_caches = chat_data.setdefault("context_caches", {})
+        state = chat_caches.get(kind)
+        if state and state["expires_at"] - time.time() > self.EXPIRY_MARGIN_SECONDS and seqs[0] == state["first_seq"] and state["last_seq"] in seqs:
+            cached_count = seqs.index(state["last_seq"]) + 1
+            if len(seqs) - cached_count <= CONTEXT_CACHE_MAX_TAIL_ITEMS: return state["name"], cached_count
+        created = await self._create(client, model, tools, [content for _, content, _ in history], f"chat-{chat_data.get('id')}-{kind}")
+        if state: self._delete_later(client, state["name"])
+        if not created:
+            chat_caches.pop(kind, None)
+            return None
+        chat_caches[kind] = {"name": created[0], "expires_at": created[1], "first_seq": seqs[0], "last_seq": seqs[-1]}
+        return created[0], len(seqs)
+
+    async def prepare(self, client: genai.Client, chat_data: dict, tools_kind: str, tools: list, history: list[tuple[dict, types.Content, float]],
+                      new_content: types.Content, model: str = MODEL_NAME, thinking_budget: int = THINKING_BUDGET) -> tuple[list[types.Content], types.GenerateContentConfig]:
+        # Возвращает (contents, config) запроса — с кэшем, если он доступен, иначе полный запрос.
+        # Кэш привязан к модели и инструментам, поэтому у каждой пары свой
+        full_contents = [content for _, content, _ in history] + [new_content]
+        if self.mode == "off": return full_contents, build_generate_config(tools, thinking_budget=thinking_budget)
+        kind, cache_name, cached_count = f"{tools_kind}@{model}", None, 0
+        if self.mode == "history" and history and all("seq" in entry for entry, _, _ in history):
+            cache_name, cached_count = await self._history_cache(client, chat_data, kind, model, tools, history) or (None, 0)
+        if not cache_name: cache_name = await self._system_cache(client, kind, model, tools)
+        if not cache_name: return full_contents, build_generate_config(tools, thinking_budget=thinking_budget)
+        self.counters["context_cache_hits"] += 1
+        time_note = types.Part(text=f"(System Note: {get_current_time_str()})")
+        turn = types.Content(role=new_content.role, parts=[time_note, *new_content.parts])
+        return [content for _, content, _ in history[cached_count:]] + [turn], build_generate_config(tools, cache_name, thinking_budget)
+
+    def is_cache_error(self, config: types.GenerateContentConfig, e: genai_errors.APIError) -> bool:
+        # Только 403/404 о самом кэше: прочие ошибки запроса с кэшем без кэша повторять бессмысленно
+        return bool(config.cached_content) and e.code in (403, 404) and bool(self.CACHE_ERROR_PATTERN.search(str(e)) or config.cached_content in str(e))
+
+    def forget(self, chat_data: dict, cache_name: str) -> None:
+        # Кэш оказался недоступен (удален или истек раньше срока) — больше на него не ссылаемся
+        self.counters["context_cache_fallbacks"] += 1
+        for kind, (name, _) in list(self._system_caches.items()):
+            if name == cache_name: del self._system_caches[kind]
+        chat_caches = chat_data.get("context_caches", {})
+        for kind, state in list(chat_caches.items()):
+            if state["name"] == cache_name: del chat_caches[kind]
+
+    def invalidate_chat(self, client: genai.Client, chat_data: dict) -> None:
+        for state in chat_data.pop("context_caches", {}).values(): self._delete_later(client, state["name"])
+
+def api_error_kind(e: genai_errors.APIError) -> str:
+    error_text = str(e).lower()
+    if "input token count" in error_text and "exceeds the maximum" in error_text: return "token_limit"
+    if "resource has been exhausted" in error_text or e.code == 429: return "exhausted"
+    if "permission denied" in error_text: return "permission"
+    return "other"
+
+def describe_api_error(e: genai_errors.APIError) -> str:
+    error_kind = api_error_kind(e)
+    
+    if error_kind == "token_limit":
+        return "🤯 <b>Слишком длинная история!</b>\nКажется, мы заболтались, и я уже не могу удержать в голове весь наш диалог. Пожалуйста, очистите историю командой /clear, чтобы начать заново."
+    
+    if error_kind == "exhausted":
+        return "⏳ <b>Слишком много запросов!</b>\nПожалуйста, подождите минуту, я немного перегрузилась."
+
+    if error_kind == "permission":
+        return "❌ <b>Ошибка доступа к файлу.</b>\nВозможно, файл был удален с серверов Google (срок хранения 48 часов) или возникла другая проблема. Попробуйте отправить файл заново."
+
+    return f"❌ <b>Ошибка Google API:</b>\n<code>{html.escape(str(e))}</code>"
+
+async def generate_response(client: genai.Client, request_contents: list, context: ContextTypes.DEFAULT_TYPE, tools: list,
+                            config: types.GenerateContentConfig | None = None, fallback_contents: list | None = None,
+                            raise_on_overflow: bool = False, model: str = MODEL_NAME, tools_kind: str = "custom") -> types.GenerateContentResponse | str:
+    # fallback_contents — полный запрос без кэша контекста, на случай если кэш уже недоступен.
+    # raise_on_overflow — переполнение контекста бросает ContextOverflowError, чтобы вызывающий урезал историю и повторил
+    chat_id = context.chat_data.get('id', 'Unknown')
+    config = config or build_generate_config(tools)
+    
+    admission = context.bot_data['admission']
     
     try:
-        response = await client.aio.models.generate_content(
-            model=MODEL_NAME,
-            contents=request_contents,
-            config=config
-        )
+        async with admission.slot(chat_id):
+            with METRICS.generation.time(model, tools_kind, "full"):
+                response = await admission.call(lambda: client.aio.models.generate_content(
+                    model=model,
+                    contents=request_contents,
+                    config=config
+                ))
         logger.info(f"ChatID: {chat_id} | Ответ от Gemini API получен.")
         return response
     except genai_errors.APIError as e:
-        error_text = str(e).lower()
+        METRICS.api_errors.inc(api_error_kind(e))
+        cache_manager = context.bot_data['context_caches']
+        if fallback_contents and cache_manager.is_cache_error(config, e):
+            logger.warning(f"ChatID: {chat_id} | Кэш контекста {config.cached_content} недоступен ({e}), повтор без кэша.")
+            cache_manager.forget(context.chat_data, config.cached_content)
+            return await generate_response(client, fallback_contents, context, tools, build_generate_config(tools, thinking_budget=config.thinking_config.thinking_budget),
+                                           raise_on_overflow=raise_on_overflow, model=model, tools_kind=tools_kind)
+        if raise_on_overflow and (overflow := parse_context_overflow(e)): raise overflow
         logger.error(f"ChatID: {chat_id} | Ошибка Google API: {e}", exc_info=False)
-        
-        if "input token count" in error_text and "exceeds the maximum" in error_text:
-            return "🤯 <b>Слишком длинная история!</b>\nКажется, мы заболтались, и я уже не могу удержать в голове весь наш диалог. Пожалуйста, очистите историю командой /clear, чтобы начать заново."
-        
-        if "resource has been exhausted" in error_text:
-            return "⏳ <b>Слишком много запросов!</b>\nПожалуйста, подождите минуту, я немного перегрузилась."
-
-        if "permission denied" in error_text:
-            return "❌ <b>Ошибка доступа к файлу.</b>\nВозможно, файл был удален с серверов Google (срок хранения 48 часов) или возникла другая проблема. Попробуйте отправить файл заново."
-
-        return f"❌ <b>Ошибка Google API:</b>\n<code>{html.escape(str(e))}</code>"
+        return describe_api_error(e)
     except Exception as e:
         logger.error(f"ChatID: {chat_id} | Неизвестная ошибка генерации: {e}", exc_info=True)
         return f"❌ <b>Произошла внутренняя ошибка:</b>\n<code>{html.escape(str(e))}</code>"
@@ -396,19 +1868,19 @@ def format_gemini_response(response: types.GenerateContentResponse) -> str:
             logger.warning("В ответе модели не найдено текстовых частей.")
             return "Я получила нетекстовый ответ, который не могу отобразить."
 
-        full_text = "".join(text_parts)
-        
-        sanitized_text = re.sub(r'tool_code\n.*?thought\n', '', full_text, flags=re.DOTALL)
-        user_prefix_pattern = r'\[\d+;\s*Name:\s*.*?\]:\s*'
-        sanitized_text = re.sub(user_prefix_pattern, '', sanitized_text)
-        
-        return sanitized_text.strip()
+        return sanitize_model_text("".join(text_parts))
         
     except (AttributeError, IndexError) as e:
         logger.error(f"Ошибка при парсинге ответа Gemini: {e}", exc_info=True)
         return "Произошла ошибка при обработке ответа от нейросети."
 
-async def send_reply(target_message: Message, response_text: str, add_context_hint: bool = False) -> Message | None:
+def sanitize_model_text(full_text: str) -> str:
+    sanitized_text = re.sub(r'tool_code\n.*?thought\n', '', full_text, flags=re.DOTALL)
+    user_prefix_pattern = r'\[\d+;\s*Name:\s*.*?\]:\s*'
+    sanitized_text = re.sub(user_prefix_pattern, '', sanitized_text)
+    return sanitized_text.strip()
+
+def prepare_reply_chunks(response_text: str, add_context_hint: bool = False) -> list[str]:
     sanitized_text = re.sub(r'<br\s*/?>', '\n', response_text)
     chunks = html_safe_chunker(sanitized_text)
     
@@ -418,13 +1890,141 @@ async def send_reply(target_message: Message, response_text: str, add_context_hi
             chunks[-1] += hint
         else:
             chunks.append(hint)
+    return chunks
+
+class OutboundScheduler:
+    # Все исходящие в Telegram — ответы, правки стрима, статусы команд, «печатает...» — идут через общий планировщик.
+    # Лимиты Telegram: ~TELEGRAM_GLOBAL_RATE сообщений в секунду на бота, ~TELEGRAM_GROUP_RATE_PER_MINUTE в минуту в группу,
+    # ~TELEGRAM_PRIVATE_RATE в секунду в личный чат. На каждый лимит — TokenBucket, отправка ждет токенов обоих.
+    # Ожидающие упорядочены по приоритету: первый фрагмент ответа раньше продолжений и правок. RetryAfter
+    # замораживает корзину чата на указанное время, и отправка повторяется. «Печатает...» не ждет в очереди и
+    # не тратит токены (иначе в группе отнимал бы лимит у ответов): если в чат его уже отправляли последние
+    # CHAT_ACTION_INTERVAL секунд или токена для сообщения сейчас нет, он пропускается.
+    PRIORITY_FIRST, PRIORITY_NEXT = 0, 1
+    CHAT_ACTION_INTERVAL = 4.5 # Telegram показывает действие ~5 секунд
+    MAX_RETRIES = 3
+    MAX_BUCKETS = 10000
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, group_per_minute: float = TELEGRAM_GROUP_RATE_PER_MINUTE, private_rate: float = TELEGRAM_PRIVATE_RATE):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_limits = {"group": (group_per_minute / 60, 5), "private": (private_rate, 3)} # тип чата -> (токенов в секунду, запас)
+        self.counters = {"sent": 0, "send_errors": 0, "retry_after": 0, "chat_actions_sent": 0, "chat_actions_skipped": 0, "stream_edits_skipped": 0}
+        self.send_seconds = self.max_send_seconds = 0.0
+        self.max_queue_depth = 0
+        self._buckets: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._last_actions: OrderedDict[tuple, float] = OrderedDict() # (чат, действие) -> когда отправлено
+        self._queue: list[tuple] = [] # куча (приоритет, порядковый номер, чат, future)
+        self._sequence = itertools.count()
+        self._wakeup: asyncio.TimerHandle | None = None
+
+    def _bucket(self, chat) -> TokenBucket:
+        bucket = self._buckets.get(chat.id)
+        if bucket is None:
+            if len(self._buckets) >= self.MAX_BUCKETS:
+                oldest = next((k for k, b in self._buckets.items() if b.is_full()), next(iter(self._buckets)))
+                del self._buckets[oldest]
+            bucket = self._buckets[chat.id] = TokenBucket(*self.chat_limits["private" if chat.type == "private" else "group"])
+        self._buckets.move_to_end(chat.id)
+        return bucket
+
+    def can_send_now(self, chat) -> bool:
+        return not self._queue and self.global_bucket.wait_time() == 0 and self._bucket(chat).wait_time() == 0
+
+    def _take(self, chat) -> None:
+        self.global_bucket.take()
+        self._bucket(chat).take()
+
+    def _grant(self) -> None:
+        # Проходим очередь по приоритету: отправляем все, для чьих чатов есть токены, остальных возвращаем
+        deferred, earliest = [], None
+        while self._queue:
+            global_wait = self.global_bucket.wait_time()
+            if global_wait > 0:
+                earliest = global_wait
+                break
+            item = heapq.heappop(self._queue)
+            future, chat = item[3], item[2]
+            if future.done(): continue
+            chat_wait = self._bucket(chat).wait_time()
+            if chat_wait > 0:
+                deferred.append(item)
+                earliest = chat_wait if earliest is None else min(earliest, chat_wait)
+                continue
+            self._take(chat)
+            future.set_result(None)
+        for item in deferred: heapq.heappush(self._queue, item)
+        if earliest is not None and self._queue and not self._wakeup:
+            self._wakeup = asyncio.get_running_loop().call_later(earliest, self._on_wakeup)
+
+    def _on_wakeup(self) -> None:
+        self._wakeup = None
+        self._grant()
+
+    async def _acquire(self, chat, priority: int, sequence: int) -> None:
+        if self.can_send_now(chat):
+            self._take(chat)
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, sequence, chat, future))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._queue))
+        self._grant()
+        await future # Отмененное ожидание остается в куче и пропускается в _grant
+
+    async def run(self, chat, func, priority: int = PRIORITY_NEXT):
+        # func — функция без аргументов, возвращающая корутину вызова Bot API; вызывается заново после RetryAfter.
+        # Номер в очереди берется один раз: повтор после RetryAfter не уступает место сообщениям, вставшим позже
+        started, sequence = time.monotonic(), next(self._sequence)
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self._acquire(chat, priority, sequence)
+            try:
+                result = await func()
+                break
+            except RetryAfter as e:
+                self.counters["retry_after"] += 1
+                self._bucket(chat).pause(e.retry_after)
+                if attempt == self.MAX_RETRIES: raise
+                logger.warning(f"ChatID: {chat.id} | Telegram просит подождать {e.retry_after} с, отправка отложена.")
+            except Exception:
+                self.counters["send_errors"] += 1
+                raise
+        elapsed = time.monotonic() - started
+        self.counters["sent"] += 1
+        self.send_seconds += elapsed
+        self.max_send_seconds = max(self.max_send_seconds, elapsed)
+        return result
+
+    async def reply(self, message: Message, text: str, **kwargs) -> Message:
+        return await self.run(message.chat, lambda: message.reply_text(text, **kwargs), self.PRIORITY_FIRST)
+
+    async def chat_action(self, bot, chat, action: str) -> None:
+        key = (chat.id, action)
+        if time.monotonic() - self._last_actions.get(key, float("-inf")) < self.CHAT_ACTION_INTERVAL or not self.can_send_now(chat):
+            self.counters["chat_actions_skipped"] += 1
+            return
+        self._last_actions[key] = time.monotonic()
+        self._last_actions.move_to_end(key)
+        if len(self._last_actions) > self.MAX_BUCKETS: self._last_actions.popitem(last=False)
+        self.counters["chat_actions_sent"] += 1
+        await bot.send_chat_action(chat_id=chat.id, action=action)
+
+    def stats(self) -> dict:
+        sent = self.counters["sent"]
+        return {**self.counters, "queue_depth": len(self._queue), "max_queue_depth": self.max_queue_depth,
+                "avg_send_seconds": round(self.send_seconds / sent, 4) if sent else 0.0, "max_send_seconds": round(self.max_send_seconds, 4)}
+
+async def send_reply(sender: OutboundScheduler, target_message: Message, response_text: str, add_context_hint: bool = False) -> Message | None:
+    with METRICS.send_reply.time("send"): return await _send_reply_chunks(sender, target_message, response_text, add_context_hint)
+
+async def _send_reply_chunks(sender: OutboundScheduler, target_message: Message, response_text: str, add_context_hint: bool) -> Message | None:
+    sanitized_text = re.sub(r'<br\s*/?>', '\n', response_text)
+    chunks = prepare_reply_chunks(response_text, add_context_hint)
+    bot = target_message.get_bot()
             
     sent_message = None
     try:
         for i, chunk in enumerate(chunks):
-            if i == 0: sent_message = await target_message.reply_html(chunk)
-            else: sent_message = await target_message.get_bot().send_message(chat_id=target_message.chat_id, text=chunk, parse_mode=ParseMode.HTML)
-            await asyncio.sleep(0.1)
+            if i == 0: sent_message = await sender.run(target_message.chat, lambda: target_message.reply_html(chunk), sender.PRIORITY_FIRST)
+            else: sent_message = await sender.run(target_message.chat, lambda: bot.send_message(chat_id=target_message.chat_id, text=chunk, parse_mode=ParseMode.HTML))
         return sent_message
     except BadRequest as e:
         if "Can't parse entities" in str(e) or "unsupported start tag" in str(e):
@@ -432,12 +2032,147 @@ async def send_reply(target_message: Message, response_text: str, add_context_hi
             plain_text = re.sub(r'<[^>]*>', '', sanitized_text)
             plain_chunks = [plain_text[i:i+4096] for i in range(0, len(plain_text), 4096)]
             for i, chunk in enumerate(plain_chunks):
-                if i == 0: sent_message = await target_message.reply_text(chunk)
-                else: sent_message = await target_message.get_bot().send_message(chat_id=target_message.chat_id, text=chunk)
+                if i == 0: sent_message = await sender.run(target_message.chat, lambda: target_message.reply_text(chunk), sender.PRIORITY_FIRST)
+                else: sent_message = await sender.run(target_message.chat, lambda: bot.send_message(chat_id=target_message.chat_id, text=chunk))
             return sent_message
     except Exception as e: logger.error(f"Критическая ошибка отправки ответа: {e}", exc_info=True)
     return None
 
+def close_open_html_tags(text: str) -> str:
+    # Промежуточный текст стрима может оборваться посреди тега — отрезаем хвост и закрываем открытые теги
+    text = re.sub(r'<[^>]*$|&[#\w]*$', '', text)
+    tag_stack = []
+    for match in re.finditer(r'<(/?)(b|i|code|pre|a|tg-spoiler)\b[^>]*>', text, re.IGNORECASE):
+        tag_name, is_closing = match.group(2).lower(), bool(match.group(1))
+        if not is_closing: tag_stack.append(tag_name)
+        elif tag_stack and tag_stack[-1] == tag_name: tag_stack.pop()
+    return text + ''.join(f'</{tag}>' for tag in reversed(tag_stack))
+
+class StreamingReply:
+    # Прогрессивный ответ: первый фрагмент уходит сразу, дальше сообщение правится не чаще edit_interval.
+    # Текст сверх лимита Telegram переносится в новые сообщения по границам html_safe_chunker.
+    def __init__(self, target_message: Message, edit_interval: float, sender: OutboundScheduler):
+        self.target_message = target_message
+        self.sender = sender
+        self.edit_interval = edit_interval
+        self.messages: list[Message] = []
+        self.sent_chunks: list[str] = []
+        self._next_render_at = 0.0
+
+    async def update(self, text: str) -> None:
+        if time.monotonic() < self._next_render_at: return
+        if self.messages and not self.sender.can_send_now(self.target_message.chat):
+            self.sender.counters["stream_edits_skipped"] += 1 # Промежуточная правка не стоит очереди — покажем текст в следующей
+            return
+        try:
+            await self._render(prepare_reply_chunks(close_open_html_tags(text)))
+        except RetryAfter as e:
+            self._next_render_at = time.monotonic() + e.retry_after
+            return
+        except BadRequest as e:
+            logger.debug(f"Промежуточная правка стрима не удалась: {e}")
+        self._next_render_at = time.monotonic() + self.edit_interval
+
+    async def finish(self, text: str, add_context_hint: bool = False) -> Message | None:
+        chunks = prepare_reply_chunks(text, add_context_hint)
+        try:
+            await self._render(chunks) # RetryAfter обрабатывает OutboundScheduler
+        except BadRequest as e:
+            if "Can't parse entities" not in str(e) and "unsupported start tag" not in str(e): raise
+            logger.warning(f"Ошибка парсинга HTML: {e}. Отправляю как обычный текст.")
+            plain_text = re.sub(r'<[^>]*>', '', re.sub(r'<br\s*/?>', '\n', text))
+            chunks = [plain_text[i:i+4096] for i in range(0, len(plain_text), 4096)]
+            await self._render(chunks, parse_mode=None)
+        chat = self.target_message.chat
+        for extra_message in self.messages[len(chunks):]: # Окончательный текст вышел короче промежуточного
+            try: await self.sender.run(chat, extra_message.delete)
+            except BadRequest: pass
+        del self.messages[len(chunks):], self.sent_chunks[len(chunks):]
+        return self.messages[-1] if self.messages else None
+
+    async def _render(self, chunks: list[str], parse_mode: str | None = ParseMode.HTML) -> None:
+        chat, bot = self.target_message.chat, self.target_message.get_bot()
+        for i, chunk in enumerate(chunks):
+            if i < len(self.messages):
+                if self.sent_chunks[i] == chunk: continue
+                try: await self.sender.run(chat, lambda: self.messages[i].edit_text(chunk, parse_mode=parse_mode))
+                except BadRequest as e:
+                    if "Message is not modified" not in str(e): raise
+            elif i == 0:
+                self.messages.append(await self.sender.run(chat, lambda: self.target_message.reply_text(chunk, parse_mode=parse_mode), self.sender.PRIORITY_FIRST))
+            else:
+                self.messages.append(await self.sender.run(chat, lambda: bot.send_message(chat_id=self.target_message.chat_id, text=chunk, parse_mode=parse_mode)))
+            if i < len(self.sent_chunks): self.sent_chunks[i] = chunk
+            else: self.sent_chunks.append(chunk)
+
+async def stream_reply(client: genai.Client, request_contents: list, context: ContextTypes.DEFAULT_TYPE, tools: list, target_message: Message, add_context_hint: bool = False,
+                       config: types.GenerateContentConfig | None = None, fallback_contents: list | None = None,
+                       raise_on_overflow: bool = False, model: str = MODEL_NAME, tools_kind: str = "custom") -> tuple[str, Message | None, types.GenerateContentResponseUsageMetadata | None]:
+    # Потоковый аналог generate_response + send_reply: возвращает итоговый текст, последнее отправленное сообщение и usage_metadata
+    chat_id = context.chat_data.get('id', 'Unknown')
+    edit_interval = STREAM_EDIT_INTERVAL if target_message.chat.type == "private" else STREAM_EDIT_INTERVAL_GROUP
+    streamer = StreamingReply(target_message, edit_interval, context.bot_data['sender'])
+    text_parts, last_chunk, error_text = [], None, None
+    config = config or build_generate_config(tools)
+    admission = context.bot_data['admission']
+    try:
+        async with admission.slot(chat_id):
+            started = time.perf_counter()
+            for attempt in itertools.count():
+                try:
+                    # Запрос уходит при чтении первого фрагмента, поэтому 429/503 ловятся здесь же
+                    stream = await client.aio.models.generate_content_stream(model=model, contents=request_contents, config=config)
+                    async for chunk in stream:
+                        last_chunk = chunk
+                        candidate = chunk.candidates[0] if chunk.candidates else None
+                        if not candidate or not candidate.content or not candidate.content.parts: continue
+                        new_text = "".join(part.text for part in candidate.content.parts if part.text and not part.thought)
+                        if not new_text: continue
+                        if not text_parts:
+                            METRICS.first_chunk.observe(time.perf_counter() - started, model, tools_kind)
+                            logger.info(f"ChatID: {chat_id} | Первый фрагмент ответа от Gemini API получен (стрим).")
+                        text_parts.append(new_text)
+                        await streamer.update(sanitize_model_text("".join(text_parts)))
+                    break
+                except genai_errors.APIError as e:
+                    if text_parts: raise # Часть ответа уже показана — повтор ее бы продублировал
+                    await admission.backoff(e, attempt)
+            METRICS.generation.observe(time.perf_counter() - started, model, tools_kind, "stream")
+        logger.info(f"ChatID: {chat_id} | Ответ от Gemini API получен (стрим).")
+    except genai_errors.APIError as e:
+        METRICS.api_errors.inc(api_error_kind(e))
+        cache_manager = context.bot_data['context_caches']
+        if not text_parts and fallback_contents and cache_manager.is_cache_error(config, e):
+            logger.warning(f"ChatID: {chat_id} | Кэш контекста {config.cached_content} недоступен ({e}), повтор без кэша.")
+            cache_manager.forget(context.chat_data, config.cached_content)
+            return await stream_reply(client, fallback_contents, context, tools, target_message, add_context_hint,
+                                      build_generate_config(tools, thinking_budget=config.thinking_config.thinking_budget), raise_on_overflow=raise_on_overflow, model=model, tools_kind=tools_kind)
+        if not text_parts and raise_on_overflow and (overflow := parse_context_overflow(e)): raise overflow
+        logger.error(f"ChatID: {chat_id} | Ошибка Google API: {e}", exc_info=False)
+        error_text = describe_api_error(e)
+    except Exception as e:
+        logger.error(f"ChatID: {chat_id} | Неизвестная ошибка генерации: {e}", exc_info=True)
+        error_text = f"❌ <b>Произошла внутренняя ошибка:</b>\n<code>{html.escape(str(e))}</code>"
+
+    if text_parts:
+        final_text = sanitize_model_text("".join(text_parts))
+        if error_text: final_text = f"{final_text}\n\n{error_text}" # Стрим оборвался — показанное пользователю не убираем
+    else:
+        final_text = error_text or format_gemini_response(last_chunk)
+    usage = last_chunk.usage_metadata if last_chunk else None
+    try:
+        with METRICS.send_reply.time("stream"): return final_text, await streamer.finish(final_text, add_context_hint), usage
+    except Exception as e:
+        logger.error(f"Критическая ошибка отправки ответа: {e}", exc_info=True)
+        return final_text, None, usage
+
+def clear_chat_data(chat_data: dict) -> None:
+    # history_seq переживает /clear: построчное хранение удаляет из БД строки с seq меньше первой записи истории,
+    # и сброшенный счетчик, обогнав записанный до того, как очистка дошла до БД, смешал бы старую историю с новой
+    history_seq = chat_data.get("history_seq", 0)
+    chat_data.clear()
+    if history_seq: chat_data["history_seq"] = history_seq
+
 async def add_to_history(context: ContextTypes.DEFAULT_TYPE, role: str, parts: list[types.Part], user: User = None, **kwargs):
     chat_history = context.chat_data.setdefault("history", [])
     
@@ -449,20 +2184,165 @@ async def add_to_history(context: ContextTypes.DEFAULT_TYPE, role: str, parts: l
 
     if not entry_parts: return # Не сохраняем в историю сообщения без текста
             
-    entry = {"role": role, "parts": entry_parts, **kwargs}
+    # seq — сквозной номер записи в чате; по нему построчное хранение дописывает только новые ходы
+    seq = context.chat_data.get("history_seq", 0) + 1
+    context.chat_data["history_seq"] = seq
+    entry = {"role": role, "parts": entry_parts, "seq": seq, **kwargs}
     if role == 'user' and user:
         entry['user_id'] = user.id
         entry['user_name'] = user.first_name
     
     chat_history.append(entry)
+    if role == 'model' and kwargs.get('bot_message_id') and kwargs.get('original_message_id'):
+        await context.bot_data['media_contexts'].link(context.chat_data.get('id'), kwargs['bot_message_id'], kwargs['original_message_id'])
+    history_index = get_history_index(context)
+    history_index.appended(chat_history)
     if len(chat_history) > MAX_HISTORY_ITEMS:
         context.chat_data["history"] = chat_history[-MAX_HISTORY_ITEMS:]
-
+        history_index.trimmed(context.chat_data["history"], len(chat_history) - MAX_HISTORY_ITEMS)
+
+class HistoryCompactor:
+    # Фоновое сжатие длинной истории (HISTORY_SUMMARY=1). Когда в чате больше HISTORY_SUMMARY_TRIGGER_ITEMS записей
+    # или ~HISTORY_SUMMARY_TRIGGER_TOKENS токенов, все записи, кроме последних HISTORY_SUMMARY_KEEP_ITEMS, вместе с прежней
+    # сводкой пересказываются дешевой моделью SUMMARY_MODEL_NAME. Сводка хранится в chat_data['history_summary']
+    # (seq — последняя вошедшая в нее запись) и идет в запрос первой, а пересказанные записи удаляются из истории.
+    SUMMARY_PROMPT = ("Ниже — более ранняя часть переписки в чате с ассистентом{previous}. Составь ее сжатое содержание для самого "
+                      "ассистента: ключевые факты, вопросы и ответы, решения и договоренности, имена, предпочтения и просьбы участников, "
+                      "незакрытые темы. Пиши по-русски, без вступлений и оценок, не длиннее 400 слов.\n\n{transcript}")
+    MIN_ITEMS = 4 # Меньше записей сжимать нет смысла
+
+    def __init__(self, enabled: bool = HISTORY_SUMMARY):
+        self.enabled = enabled
+        self.counters = {"history_summaries": 0, "history_summary_failures": 0, "history_items_summarized": 0}
+        self._running: dict[object, asyncio.Task] = {}
+
+    def schedule(self, context: ContextTypes.DEFAULT_TYPE) -> None:
+        chat_id, history = context.chat_data.get('id'), context.chat_data.get("history", [])
+        if not self.enabled or chat_id in self._running or len(history) - HISTORY_SUMMARY_KEEP_ITEMS < self.MIN_ITEMS: return
+        if not all("seq" in entry for entry in history): return
+        if len(history) < HISTORY_SUMMARY_TRIGGER_ITEMS and get_history_index(context).tokens(history) < HISTORY_SUMMARY_TRIGGER_TOKENS: return
+        task = asyncio.create_task(self._run(context.bot_data['gemini_client'], context.application, get_history_index(context), chat_id, context.chat_data))
+        self._running[chat_id] = task
+        task.add_done_callback(lambda _: self._running.pop(chat_id, None)) # Отметка снимается при любом исходе, в том числе отмене
+
+    @staticmethod
+    def _transcript(entries: list[dict]) -> str:
+        lines = []
+        for entry in entries:
+            text = " ".join(part_dict.get('content', '') for part_dict in entry.get("parts", []) if part_dict.get('type') == 'text')
+            speaker = entry.get('user_name', 'Пользователь') if entry.get("role") == "user" else "Ассистент"
+            if text: lines.append(f"{speaker}: {text}")
+        return "\n\n".join(lines)
+
+    async def _run(self, client: genai.Client, application: Application, history_index: HistoryIndex, chat_id: int, chat_data: dict) -> None:
+        # Задача фоновая и никем не ожидается: любая ошибка (сеть, таймаут, неожиданный ответ) только пишется в лог
+        try: await self._compact(client, application, history_index, chat_id, chat_data)
+        except Exception as e:
+            self.counters["history_summary_failures"] += 1
+            logger.error(f"ChatID: {chat_id} | Сжатие истории завершилось ошибкой: {e!r}", exc_info=True)
+
+    async def _compact(self, client: genai.Client, application: Application, history_index: HistoryIndex, chat_id: int, chat_data: dict) -> None:
+        history = chat_data["history"]
+        entries = history[:len(history) - HISTORY_SUMMARY_KEEP_ITEMS]
+        previous = chat_data.get("history_summary")
+        previous_text = " ".join(part_dict.get('content', '') for part_dict in previous["parts"]) if previous else ""
+        prompt = self.SUMMARY_PROMPT.format(previous=" и ее прежнее краткое содержание" if previous_text else "",
+                                            transcript=(f"Прежнее краткое содержание:\n{previous_text}\n\nПродолжение переписки:\n" if previous_text else "") + self._transcript(entries))
+        try:
+            admission = application.bot_data['admission']
+            async with admission.slot(chat_id):
+                response = await admission.call(lambda: client.aio.models.generate_content(model=SUMMARY_MODEL_NAME, contents=prompt, config=types.GenerateContentConfig(
+                    temperature=0.2, max_output_tokens=HISTORY_SUMMARY_MAX_TOKENS, safety_settings=SAFETY_SETTINGS,
+                    thinking_config=types.ThinkingConfig(thinking_budget=0))))
+            summary_text = (response.text or "").strip()
+        except genai_errors.APIError as e:
+            self.counters["history_summary_failures"] += 1
+            logger.warning(f"ChatID: {chat_id} | Не удалось сжать историю: {e}")
+            return
+        if not summary_text: return
+        chat_locks = application.bot_data['chat_locks']
+        async with chat_locks.lock(chat_id): # Сводка применяется между ходами чата, а не посреди хода
+            # Пока шел запрос, историю могли очистить (/clear), заменить или выгрузить чат из памяти — тогда сводка уже не к месту
+            current = chat_data.get("history")
+            if current is not history or application.chat_data.get(chat_id) is not chat_data: return
+            removed = len(entries)
+            chat_data["history_summary"] = {"role": "summary", "parts": [{"type": "text", "content": summary_text}], "seq": entries[-1]["seq"]}
+            chat_data["history"] = current[removed:]
+            history_index.trimmed(chat_data["history"], removed)
+            self.counters["history_summaries"] += 1
+            self.counters["history_items_summarized"] += removed
+            logger.info(f"ChatID: {chat_id} | {removed} старых записей истории сжаты в сводку ({len(summary_text)} симв).")
+            await chat_locks.save(application, chat_id, chat_data)
+
+class RequestRouter:
+    # Выбор модели, бюджета мышления и инструментов под запрос: короткая реплика без вопроса не должна ждать
+    # 24k токенов размышлений. Правила — DEFAULT_ROUTING_RULES или JSON из ROUTING_RULES, побеждает первое подходящее.
+    # Каждое решение пишется в лог вместе с задержкой и токенами, а сводка по маршрутам отдается в /stats.
+    # Вопрос или просьба что-то сделать — такой запрос не считается мелкой репликой
+    QUESTION_REGEX = re.compile(r"\?|^\s*(кто|что|где|когда|почему|зачем|как|какой|какая|какие|сколько|чей|можно ли|who|what|where|when|why|how|which)\b|"
+                                r"\b(расскажи|объясни|найди|покажи|напиши|сравни|переведи|посчитай|придумай|составь|tell|explain|find|write|translate)", re.IGNORECASE)
+    CODE_REGEX = re.compile(r"```|^\s*(def |class |import |from \S+ import|#include|function |SELECT |const |let |public )|[;{}]\s*$", re.MULTILINE)
+
+    def __init__(self, rules: list[dict] | None = None):
+        self.rules = [{"model": MODEL_NAME, "thinking_budget": THINKING_BUDGET, "tools": "text", "when": {}, **rule} for rule in (rules or self.load_rules())]
+        unknown_tools = {rule["tools"] for rule in self.rules} - TOOL_SETS.keys()
+        if unknown_tools: raise ValueError(f"Неизвестные наборы инструментов в правилах маршрутизации: {unknown_tools}")
+        if self.rules[-1]["when"]: self.rules.append({"name": "fallback", "model": MODEL_NAME, "thinking_budget": THINKING_BUDGET, "tools": "text", "when": {}})
+        self._stats: dict[str, dict] = defaultdict(lambda: {"requests": 0, "total_seconds": 0.0, "max_seconds": 0.0, "prompt_tokens": 0, "thought_tokens": 0, "output_tokens": 0})
+
+    @staticmethod
+    def load_rules() -> list[dict]:
+        if not ROUTING_RULES: return DEFAULT_ROUTING_RULES
+        try:
+            rules = json.loads(ROUTING_RULES)
+            if isinstance(rules, list) and rules and all(isinstance(rule, dict) and "name" in rule for rule in rules): return rules
+            logger.error("ROUTING_RULES должен быть непустым JSON-списком правил с полем name. Используются правила по умолчанию.")
+        except json.JSONDecodeError as e:
+            logger.error(f"ROUTING_RULES не разобран ({e}). Используются правила по умолчанию.")
+        return DEFAULT_ROUTING_RULES
+
+    @classmethod
+    def features(cls, message: Message, prompt_text: str, has_media: bool) -> dict:
+        return {"chars": len(prompt_text), "has_media": has_media, "has_url": bool(re.search(URL_REGEX, prompt_text)),
+                "has_code": bool(cls.CODE_REGEX.search(prompt_text)), "is_question": bool(cls.QUESTION_REGEX.search(prompt_text)),
+                "is_reply": bool(message.reply_to_message), "chat_type": message.chat.type}
+
+    @staticmethod
+    def matches(when: dict, features: dict) -> bool:
+        for key, expected in when.items():
+            if key == "min_chars": ok = features["chars"] >= expected
+            elif key == "max_chars": ok = features["chars"] <= expected
+            elif key == "chat_type": ok = features["chat_type"] in (expected if isinstance(expected, list) else [expected])
+            else: ok = features.get(key) == expected
+            if not ok: return False
+        return True
+
+    def route(self, features: dict) -> dict:
+        return next(rule for rule in self.rules if self.matches(rule["when"], features))
+
+    def record(self, route: dict, chat_id: int, seconds: float, usage: types.GenerateContentResponseUsageMetadata | None) -> None:
+        prompt, thought, output = (usage.prompt_token_count or 0, usage.thoughts_token_count or 0, usage.candidates_token_count or 0) if usage else (0, 0, 0)
+        logger.info(f"ChatID: {chat_id} | Маршрут '{route['name']}' ({route['model']}, мышление {route['thinking_budget']}, инструменты {route['tools']}): "
+                    f"{seconds:.2f} с, токены: запрос {prompt}, мышление {thought}, ответ {output}")
+        stats = self._stats[route["name"]]
+        stats["requests"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["prompt_tokens"] += prompt
+        stats["thought_tokens"] += thought
+        stats["output_tokens"] += output
+
+    def stats(self) -> dict:
+        return {name: {**stats, "avg_seconds": round(stats["total_seconds"] / stats["requests"], 3), "total_seconds": round(stats["total_seconds"], 3),
+                       "max_seconds": round(stats["max_seconds"], 3)} for name, stats in self._stats.items()}
+
+@serialize_chat
 async def process_request(update: Update, context: ContextTypes.DEFAULT_TYPE, content_parts: list, is_media_request: bool = False):
     message, client = update.message, context.bot_data['gemini_client']
     user = message.from_user
     chat_id = message.chat_id
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    sender = context.bot_data['sender']
+    await sender.chat_action(context.bot, message.chat, ChatAction.TYPING)
 
     # Шаг 1: Предварительная проверка на запрос времени/даты. Вынесена из try-except.
     text_part_content = next((p.text for p in content_parts if p.text), None)
@@ -470,15 +2350,18 @@ async def process_request(update: Update, context: ContextTypes.DEFAULT_TYPE, co
         logger.info("Обнаружен запрос о времени/дате. Отвечаем напрямую.")
         time_str = get_current_time_str()
         response_text = f"{user.first_name}, {time_str[0].lower()}{time_str[1:]}"
-        sent_message = await send_reply(message, response_text)
+        sent_message = await send_reply(sender, message, response_text)
         if sent_message:
             await add_to_history(context, role="user", parts=content_parts, user=user, original_message_id=message.message_id)
             await add_to_history(context, role="model", parts=[types.Part(text=response_text)], original_message_id=message.message_id, bot_message_id=sent_message.message_id)
+            await context.bot_data['chat_locks'].save(context.application, chat_id, context.chat_data)
         return # Завершаем выполнение здесь
 
     # Шаг 2: Основная логика в блоке try-except
     try:
-        history_for_api = build_history_for_request(context.chat_data.get("history", []))
+        await context.bot_data['admission'].admit(chat_id, user.id)
+        history, history_index = context.chat_data.setdefault("history", []), get_history_index(context)
+        token_budget = context.bot_data['token_budget']
         
         user_prefix = f"[{user.id}; Name: {user.first_name}]: "
         prompt_text = next((p.text for p in content_parts if p.text), "")
@@ -503,48 +2386,73 @@ async def process_request(update: Update, context: ContextTypes.DEFAULT_TYPE, co
             elif not part.text:
                 current_request_parts.append(part)
 
-        request_contents = history_for_api + [types.Content(parts=current_request_parts, role="user")]
-        
-        tools = MEDIA_TOOLS if is_media_request else TEXT_TOOLS
-        response_obj = await generate_response(client, request_contents, context, tools)
-        
-        if isinstance(response_obj, str):
-            reply_text = response_obj
-        else:
-            reply_text = format_gemini_response(response_obj)
+        new_content = types.Content(parts=current_request_parts, role="user")
+        router = context.bot_data['router']
+        route = router.route(router.features(message, prompt_text, has_media or is_media_request))
+        tools = TOOL_SETS[route["tools"]]
+        started = time.monotonic()
+        history_budget = token_budget.history_budget(new_content)
+        for attempt in range(CONTEXT_OVERFLOW_RETRIES + 1):
+            history_for_api = history_index.window(history, history_budget, context.chat_data.get("history_summary"))
+            history_tokens = sum(tokens for _, _, tokens in history_for_api)
+            # Размер файлов заранее неизвестен, поэтому калибруем оценку только по текстовым запросам
+            estimated_tokens = None if has_media else token_budget.system_tokens() + history_tokens + token_budget.content_tokens(new_content)
+            full_contents = [content for _, content, _ in history_for_api] + [new_content]
+            request_contents, config = await context.bot_data['context_caches'].prepare(
+                client, context.chat_data, route["tools"], tools, history_for_api, new_content, route["model"], route["thinking_budget"])
+            fallback_contents = full_contents if config.cached_content else None
+            can_retry = attempt < CONTEXT_OVERFLOW_RETRIES and bool(history_for_api)
+            try:
+                if STREAM_RESPONSES:
+                    reply_text, sent_message, usage = await stream_reply(client, request_contents, context, tools, message, add_context_hint=is_media_request,
+                                                                         config=config, fallback_contents=fallback_contents, raise_on_overflow=can_retry, model=route["model"], tools_kind=route["tools"])
+                else:
+                    response_obj = await generate_response(client, request_contents, context, tools, config=config, fallback_contents=fallback_contents,
+                                                           raise_on_overflow=can_retry, model=route["model"], tools_kind=route["tools"])
+                    usage = None if isinstance(response_obj, str) else response_obj.usage_metadata
+                break
+            except ContextOverflowError as e:
+                history_budget = token_budget.overflow_budget(history_tokens, estimated_tokens, e)
+                logger.warning(f"ChatID: {chat_id} | {e} Урезаем историю до ~{history_budget:.0f} токенов и повторяем запрос.")
+        if usage: token_budget.observe(estimated_tokens, usage.prompt_token_count)
+        router.record(route, chat_id, time.monotonic() - started, usage)
+
+        if not STREAM_RESPONSES:
+            if isinstance(response_obj, str):
+                reply_text = response_obj
+            else:
+                reply_text = format_gemini_response(response_obj)
+            
+            sent_message = await send_reply(sender, message, reply_text, add_context_hint=is_media_request)
         
         if len(reply_text) > MAX_HISTORY_RESPONSE_LEN:
             full_response_for_history = reply_text[:MAX_HISTORY_RESPONSE_LEN] + "..."
             logger.info(f"Ответ модели для чата {chat_id} был обрезан для сохранения в историю.")
         else:
             full_response_for_history = reply_text
-
-        sent_message = await send_reply(message, reply_text, add_context_hint=is_media_request)
         
         if sent_message:
-            await add_to_history(context, role="user", parts=content_parts, user=user, original_message_id=message.message_id)
-            await add_to_history(context, role="model", parts=[types.Part(text=full_response_for_history)], original_message_id=message.message_id, bot_message_id=sent_message.message_id)
-            
             if is_media_request:
                 media_part = next((p for p in content_parts if p.file_data), None)
-                if media_part:
-                    all_media_contexts = context.application.bot_data.setdefault('media_contexts', {})
-                    chat_media_contexts = all_media_contexts.setdefault(chat_id, OrderedDict())
-                    
-                    chat_media_contexts[message.message_id] = part_to_dict(media_part)
-                    if len(chat_media_contexts) > MAX_MEDIA_CONTEXTS: chat_media_contexts.popitem(last=False)
-                    logger.info(f"Сохранен сессионный медиа-контекст для msg_id {message.message_id} в чате {chat_id}")
+                # Сохраняется до записи ответа в историю, чтобы add_to_history связал с файлом и ответ бота
+                if media_part: await context.bot_data['media_contexts'].put(chat_id, message.message_id, media_part)
+            
+            await add_to_history(context, role="user", parts=content_parts, user=user, original_message_id=message.message_id)
+            await add_to_history(context, role="model", parts=[types.Part(text=full_response_for_history)], original_message_id=message.message_id, bot_message_id=sent_message.message_id)
             
-            await context.application.persistence.update_chat_data(chat_id, context.chat_data)
+            await context.bot_data['chat_locks'].save(context.application, chat_id, context.chat_data)
+            context.bot_data['history_compactor'].schedule(context)
         else:
             logger.error(f"Не удалось отправить ответ для msg_id {message.message_id}. История не будет сохранена, чтобы избежать повреждения.")
 
+    except RateLimitExceeded as e:
+        await sender.reply(message, f"⏳ <b>Слишком много запросов!</b>\nПопробуйте через {e.retry_after:.0f} с.", parse_mode=ParseMode.HTML)
     except (IOError, asyncio.TimeoutError) as e:
         logger.error(f"Ошибка обработки файла: {e}", exc_info=False)
-        await message.reply_text(f"❌ <b>Ошибка обработки файла:</b> {html.escape(str(e))}")
+        await sender.reply(message, f"❌ <b>Ошибка обработки файла:</b> {html.escape(str(e))}")
     except Exception as e:
         logger.error(f"Непредвиденная ошибка в process_request: {e}", exc_info=True)
-        await message.reply_text(f"❌ <b>Произошла критическая внутренняя ошибка:</b>\n<code>{html.escape(str(e))}</code>")
+        await sender.reply(message, f"❌ <b>Произошла критическая внутренняя ошибка:</b>\n<code>{html.escape(str(e))}</code>")
 
 # --- ОБРАБОТЧИКИ КОМАНД ---
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -562,79 +2470,93 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 Пользуйтесь и добавляйте в свои группы!
 
 (!) Используя бот, Вы автоматически соглашаетесь на передачу сообщений и файлов для получения ответов через Google Gemini API."""
-    await update.message.reply_html(start_text)
+    await context.bot_data['sender'].reply(update.message, start_text, parse_mode=ParseMode.HTML)
 
 @ignore_if_processing
+@serialize_chat
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat:
         chat_id = update.effective_chat.id
         
-        context.chat_data.clear()
+        context.bot_data['context_caches'].invalidate_chat(context.bot_data['gemini_client'], context.chat_data)
+        clear_chat_data(context.chat_data)
         
-        bot_data = context.application.bot_data
-        bot_data.get('media_contexts', {}).pop(chat_id, None)
+        await context.bot_data['media_contexts'].forget_chat(chat_id)
         
-        await context.application.persistence.update_chat_data(chat_id, context.chat_data)
+        await context.bot_data['chat_locks'].save(context.application, chat_id, context.chat_data)
         
-        await update.message.reply_text("✅ История чата и весь медиа-контекст полностью очищены.")
+        await context.bot_data['sender'].reply(update.message, "✅ История чата и весь медиа-контекст полностью очищены.")
         logger.info(f"Полная очистка контекста для чата {chat_id} по команде /clear.")
     else:
         logger.warning("Не удалось определить chat_id для команды /clear")
 
 @ignore_if_processing
+@serialize_chat
 async def newtopic_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat:
         chat_id = update.effective_chat.id
         bot_data = context.application.bot_data
-        bot_data.get('media_contexts', {}).pop(chat_id, None)
-        await update.message.reply_text("Контекст предыдущих файлов очищен. Начинаем новую тему.")
+        await bot_data['media_contexts'].forget_chat(chat_id)
+        if "context_caches" in context.chat_data:
+            bot_data['context_caches'].invalidate_chat(bot_data['gemini_client'], context.chat_data)
+            await bot_data['chat_locks'].save(context.application, chat_id, context.chat_data)
+        await context.bot_data['sender'].reply(update.message, "Контекст предыдущих файлов очищен. Начинаем новую тему.")
 
-@ignore_if_processing
 async def utility_media_command(update: Update, context: ContextTypes.DEFAULT_TYPE, prompt: str):
     if not update.message or not update.message.reply_to_message:
-        return await update.message.reply_text("Пожалуйста, используйте эту команду в ответ на сообщение с медиафайлом или ссылкой.")
+        return await context.bot_data['sender'].reply(update.message, "Пожалуйста, используйте эту команду в ответ на сообщение с медиафайлом или ссылкой.")
     
     context.chat_data['id'] = update.effective_chat.id
+    sender = context.bot_data['sender']
     replied_message = update.message.reply_to_message
-    media_obj = replied_message.audio or replied_message.voice or replied_message.video or replied_message.photo or replied_message.document
+    media_obj = replied_message.audio or replied_message.voice or replied_message.video or (replied_message.photo[-1] if replied_message.photo else None) or replied_message.document
     
-    media_part = None
     client = context.bot_data['gemini_client']
     
     try:
         if media_obj:
             if hasattr(media_obj, 'file_size') and media_obj.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024:
-                return await update.message.reply_text(f"❌ Файл слишком большой (> {TELEGRAM_FILE_LIMIT_MB} MB) для обработки этой командой.")
-            media_file = await media_obj.get_file()
-            media_bytes = await media_file.download_as_bytearray()
-            media_part = await upload_and_wait_for_file(client, media_bytes, media_obj.mime_type, getattr(media_obj, 'file_name', 'media.bin'))
+                return await sender.reply(update.message, f"❌ Файл слишком большой (> {TELEGRAM_FILE_LIMIT_MB} MB) для обработки этой командой.")
+            media_id = f"tg:{media_obj.file_unique_id}"
         elif replied_message.text:
             yt_match = re.search(YOUTUBE_REGEX, replied_message.text)
             if yt_match:
-                youtube_url = f"https://www.youtube.com/watch?v={yt_match.group(1)}"
-                media_part = types.Part(file_data=types.FileData(mime_type="video/youtube", file_uri=youtube_url))
+                media_id = f"yt:{yt_match.group(1)}"
             else:
-                return await update.message.reply_text("В цитируемом сообщении нет поддерживаемого медиафайла или YouTube-ссылки.")
+                return await sender.reply(update.message, "В цитируемом сообщении нет поддерживаемого медиафайла или YouTube-ссылки.")
         else:
-            return await update.message.reply_text("Не удалось найти медиафайл в цитируемом сообщении.")
+            return await sender.reply(update.message, "Не удалось найти медиафайл в цитируемом сообщении.")
 
-        await update.message.reply_text("Анализирую...", reply_to_message_id=update.message.message_id)
+        await sender.reply(update.message, "Анализирую...", reply_to_message_id=update.message.message_id)
         
-        content_parts = [media_part, types.Part(text=prompt)]
-        
-        response_obj = await generate_response(client, [types.Content(parts=content_parts, role="user")], context, MEDIA_TOOLS)
-        result_text = format_gemini_response(response_obj) if not isinstance(response_obj, str) else response_obj
-        await send_reply(update.message, result_text, add_context_hint=True)
+        async def generate() -> tuple[str, bool]:
+            # Файл скачивается и загружается, только если ответа еще нет в кэше; лимит запросов тратит тоже только промах
+            await context.bot_data['admission'].admit(update.effective_chat.id, update.effective_user.id if update.effective_user else None)
+            if media_obj:
+                media_part = await get_media_part(context, media_obj, getattr(media_obj, 'mime_type', None) or 'image/jpeg', getattr(media_obj, 'file_name', None) or 'media.bin')
+            else:
+                youtube_url = f"https://www.youtube.com/watch?v={yt_match.group(1)}"
+                media_part = types.Part(file_data=types.FileData(mime_type="video/youtube", file_uri=youtube_url))
+            content_parts = [media_part, types.Part(text=prompt)]
+            response_obj = await generate_response(client, [types.Content(parts=content_parts, role="user")], context, MEDIA_TOOLS, tools_kind="media")
+            result_text = format_gemini_response(response_obj) if not isinstance(response_obj, str) else response_obj
+            return result_text, is_complete_response(response_obj)
+
+        response_cache = context.bot_data['response_cache']
+        result_text = await response_cache.get_or_generate(response_cache.make_key(prompt, media_id), generate)
+        await send_reply(sender, update.message, result_text, add_context_hint=True)
     
+    except RateLimitExceeded as e:
+        await sender.reply(update.message, f"⏳ Слишком много запросов, попробуйте через {e.retry_after:.0f} с.")
     except BadRequest as e:
         if "File is too big" in str(e):
-             await update.message.reply_text(f"❌ Файл слишком большой (> {TELEGRAM_FILE_LIMIT_MB} MB) для обработки.")
+             await sender.reply(update.message, f"❌ Файл слишком большой (> {TELEGRAM_FILE_LIMIT_MB} MB) для обработки.")
         else:
              logger.error(f"Ошибка BadRequest в утилитарной команде: {e}", exc_info=True)
-             await update.message.reply_text(f"❌ Произошла ошибка Telegram: {e}")
+             await sender.reply(update.message, f"❌ Произошла ошибка Telegram: {e}")
     except Exception as e:
         logger.error(f"Ошибка в утилитарной команде: {e}", exc_info=True)
-        await update.message.reply_text(f"❌ Не удалось выполнить команду: {e}")
+        await sender.reply(update.message, f"❌ Не удалось выполнить команду: {e}")
 
 @ignore_if_processing
 async def transcript_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -649,6 +2571,19 @@ async def keypoints_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await utility_media_command(update, context, "Extract the key points or main theses from this material. Present them as a structured bulleted list.")
 
 # --- ОБРАБОТЧИКИ СООБЩЕНИЙ ---
+async def collect_coalesced(context: ContextTypes.DEFAULT_TYPE, messages: list[Message]) -> tuple[list[types.Part], list[str]]:
+    # Фото и тексты сообщений серии (см. MessageCoalescer); фото загружаются параллельно, порядок сохраняется
+    async def photo_part(message: Message) -> types.Part | None:
+        photo = message.photo[-1]
+        if photo.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024: return None
+        try: return await get_media_part(context, photo, 'image/jpeg', photo.file_unique_id + ".jpg")
+        except (BadRequest, IOError) as e:
+            logger.error(f"Ошибка при обработке фото из серии сообщений: {e}")
+            return None
+    parts = await asyncio.gather(*(photo_part(message) for message in messages if message.photo))
+    texts = [text for message in messages if (text := (message.text or message.caption or "").strip())]
+    return [part for part in parts if part], texts
+
 async def handle_media_request(update: Update, context: ContextTypes.DEFAULT_TYPE, file_part: types.Part, user_text: str):
     content_parts = [file_part, types.Part(text=user_text)]
     await process_request(update, context, content_parts, is_media_request=True)
@@ -659,25 +2594,31 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not message or not message.photo: return
     
     context.chat_data['id'] = message.chat_id
+    followers = context.bot_data['coalescer'].pop(update)
     
     photo = message.photo[-1]
-    if photo.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024:
-        await message.reply_text(f"🖼️ Изображение слишком большое (> {TELEGRAM_FILE_LIMIT_MB} MB), я не могу его проанализировать, но сейчас отвечу на текстовую часть сообщения, если она есть.")
+    if photo.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024 and not followers:
+        await context.bot_data['sender'].reply(message, f"🖼️ Изображение слишком большое (> {TELEGRAM_FILE_LIMIT_MB} MB), я не могу его проанализировать, но сейчас отвечу на текстовую часть сообщения, если она есть.")
         if message.caption:
-            await handle_message(update, context, custom_text=message.caption)
+            await _handle_text(update, context, message.caption)
         return
 
     try:
-        photo_file = await photo.get_file()
-        photo_bytes = await photo_file.download_as_bytearray()
-        file_part = await upload_and_wait_for_file(context.bot_data['gemini_client'], photo_bytes, 'image/jpeg', photo_file.file_unique_id + ".jpg")
+        if followers:
+            media_parts, texts = await collect_coalesced(context, [message, *followers])
+            if not media_parts:
+                await _handle_text(update, context, "\n".join(texts))
+                return
+            user_text = "\n".join(texts) or "В ПЕРВУЮ ОЧЕРЕДЬ проанализируй содержимое этих изображений. Лаконично перескажи, что на них, и ответь на вопросы, если они подразумеваются. ПОСЛЕ ЭТОГО выскажи свое мнение."
+            return await process_request(update, context, [*media_parts, types.Part(text=user_text)], is_media_request=True)
+        file_part = await get_media_part(context, photo, 'image/jpeg', photo.file_unique_id + ".jpg")
         await handle_media_request(update, context, file_part, message.caption or "В ПЕРВУЮ ОЧЕРЕДЬ проанализируй содержимое этого изображения. Лаконично перескажи, что на нем, и ответь на вопросы, если они подразумеваются. ПОСЛЕ ЭТОГО выскажи свое мнение.")
     except (BadRequest, IOError) as e:
         logger.error(f"Ошибка при обработке фото: {e}")
-        await message.reply_text(f"❌ Ошибка обработки изображения: {e}")
+        await context.bot_data['sender'].reply(message, f"❌ Ошибка обработки изображения: {e}")
     except Exception as e:
         logger.error(f"Непредвиденная ошибка при обработке изображения: {e}", exc_info=True)
-        await message.reply_text("❌ Произошла внутренняя ошибка при обработке изображения.")
+        await context.bot_data['sender'].reply(message, "❌ Произошла внутренняя ошибка при обработке изображения.")
 
 @ignore_if_processing
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -688,26 +2629,24 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     doc = message.document
     
     if doc.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024:
-        await message.reply_text(f"📑 Файл больше {TELEGRAM_FILE_LIMIT_MB} МБ, я не могу его скачать. Отвечу на текст, если он есть.")
+        await context.bot_data['sender'].reply(message, f"📑 Файл больше {TELEGRAM_FILE_LIMIT_MB} МБ, я не могу его скачать. Отвечу на текст, если он есть.")
         if message.caption:
-            await handle_message(update, context, custom_text=message.caption)
+            await _handle_text(update, context, message.caption)
         return
 
     if doc.mime_type and doc.mime_type.startswith("audio/"):
-        return await handle_audio(update, context, doc)
+        return await _handle_audio(update, context, doc)
     
-    await message.reply_text(f"Загружаю документ '{doc.file_name}'...", reply_to_message_id=message.id)
+    await context.bot_data['sender'].reply(message, f"Загружаю документ '{doc.file_name}'...", reply_to_message_id=message.id)
     try:
-        doc_file = await doc.get_file()
-        doc_bytes = await doc_file.download_as_bytearray()
-        file_part = await upload_and_wait_for_file(context.bot_data['gemini_client'], doc_bytes, doc.mime_type, doc.file_name or "document")
+        file_part = await get_media_part(context, doc, doc.mime_type, doc.file_name or "document")
         await handle_media_request(update, context, file_part, message.caption or "В ПЕРВУЮ ОЧЕРЕДЬ проанализируй содержимое этого документа. Лаконично перескажи его суть и ответь на вопросы, если они подразумеваются. ПОСЛЕ ЭТОГО выскажи свое мнение.")
     except (BadRequest, IOError) as e:
         logger.error(f"Ошибка при обработке документа: {e}")
-        await message.reply_text(f"❌ Ошибка обработки документа: {e}")
+        await context.bot_data['sender'].reply(message, f"❌ Ошибка обработки документа: {e}")
     except Exception as e:
         logger.error(f"Непредвиденная ошибка при обработке документа: {e}", exc_info=True)
-        await message.reply_text("❌ Внутренняя ошибка при обработке документа.")
+        await context.bot_data['sender'].reply(message, "❌ Внутренняя ошибка при обработке документа.")
 
 @ignore_if_processing
 async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -718,53 +2657,51 @@ async def handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     video = message.video
 
     if video.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024:
-        await message.reply_text(f"📹 Видеофайл больше {TELEGRAM_FILE_LIMIT_MB} МБ, я не могу его скачать. Отвечу на текст, если он есть.")
+        await context.bot_data['sender'].reply(message, f"📹 Видеофайл больше {TELEGRAM_FILE_LIMIT_MB} МБ, я не могу его скачать. Отвечу на текст, если он есть.")
         if message.caption:
-            await handle_message(update, context, custom_text=message.caption)
+            await _handle_text(update, context, message.caption)
         return
     
-    await message.reply_text("Загружаю видео...", reply_to_message_id=message.id)
+    await context.bot_data['sender'].reply(message, "Загружаю видео...", reply_to_message_id=message.id)
     try:
-        video_file = await video.get_file()
-        video_bytes = await video_file.download_as_bytearray()
-        video_part = await upload_and_wait_for_file(context.bot_data['gemini_client'], video_bytes, video.mime_type, video.file_name or "video.mp4")
+        video_part = await get_media_part(context, video, video.mime_type, video.file_name or "video.mp4")
         await handle_media_request(update, context, video_part, message.caption or "В ПЕРВУЮ ОЧЕРЕДЬ проанализируй содержимое этого видео. Лаконично перескажи его суть и ответь на вопросы, если они подразумеваются. ПОСЛЕ ЭТОГО выскажи свое мнение. Не вставляй транскрипт и таймкоды, если я не просил.")
     except (BadRequest, IOError) as e:
         logger.error(f"Ошибка при обработке видео: {e}")
-        await message.reply_text(f"❌ Ошибка обработки видео: {e}")
+        await context.bot_data['sender'].reply(message, f"❌ Ошибка обработки видео: {e}")
     except Exception as e:
         logger.error(f"Непредвиденная ошибка при обработке видео: {e}", exc_info=True)
-        await message.reply_text("❌ Внутренняя ошибка при обработке видео.")
+        await context.bot_data['sender'].reply(message, "❌ Внутренняя ошибка при обработке видео.")
 
 @ignore_if_processing
-async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE, audio_source=None):
+async def handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    if not message or not (message.audio or message.voice): return
+    await _handle_audio(update, context, message.audio or message.voice)
+
+async def _handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE, audio):
+    # Аудио и документы с audio/* (handle_document) — без ignore_if_processing, как _handle_text
     message = update.message
-    if not message: return
-    
     context.chat_data['id'] = message.chat_id
-    audio = audio_source or message.audio or message.voice
-    if not audio: return
 
     if audio.file_size > TELEGRAM_FILE_LIMIT_MB * 1024 * 1024:
-         await message.reply_text(f"🎧 Аудиофайл больше {TELEGRAM_FILE_LIMIT_MB} МБ, я не могу его скачать. Отвечу на текст, если он есть.")
+         await context.bot_data['sender'].reply(message, f"🎧 Аудиофайл больше {TELEGRAM_FILE_LIMIT_MB} МБ, я не могу его скачать. Отвечу на текст, если он есть.")
          if message.caption:
-            await handle_message(update, context, custom_text=message.caption)
+            await _handle_text(update, context, message.caption)
          return
 
     file_name = getattr(audio, 'file_name', 'voice_message.ogg')
     user_text = message.caption or "В ПЕРВУЮ ОЧЕРЕДЬ проанализируй и ответь на это голосовое сообщение. ПОСЛЕ ЭТОГО выскажи свое мнение. Не вставляй транскрипт и таймкоды, если я не просил."
     
     try:
-        audio_file = await audio.get_file()
-        audio_bytes = await audio_file.download_as_bytearray()
-        audio_part = await upload_and_wait_for_file(context.bot_data['gemini_client'], audio_bytes, audio.mime_type, file_name)
+        audio_part = await get_media_part(context, audio, audio.mime_type, file_name)
         await handle_media_request(update, context, audio_part, user_text)
     except (BadRequest, IOError) as e:
         logger.error(f"Ошибка при обработке аудио: {e}")
-        await message.reply_text(f"❌ Ошибка обработки аудио: {e}")
+        await context.bot_data['sender'].reply(message, f"❌ Ошибка обработки аудио: {e}")
     except Exception as e:
         logger.error(f"Непредвиденная ошибка при обработке аудио: {e}", exc_info=True)
-        await message.reply_text("❌ Внутренняя ошибка при обработке аудио.")
+        await context.bot_data['sender'].reply(message, "❌ Внутренняя ошибка при обработке аудио.")
 
 @ignore_if_processing
 async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -775,7 +2712,7 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if not match: return
     
     youtube_url = f"https://www.youtube.com/watch?v={match.group(1)}"
-    await message.reply_text("Анализирую видео с YouTube...", reply_to_message_id=message.id)
+    await context.bot_data['sender'].reply(message, "Анализирую видео с YouTube...", reply_to_message_id=message.id)
     try:
         youtube_part = types.Part(file_data=types.FileData(mime_type="video/youtube", file_uri=youtube_url))
         
@@ -784,7 +2721,7 @@ async def handle_youtube_url(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await handle_media_request(update, context, youtube_part, user_prompt)
     except Exception as e:
         logger.error(f"Ошибка при обработке YouTube URL {youtube_url}: {e}", exc_info=True)
-        await message.reply_text("❌ Не удалось обработать ссылку на YouTube. Возможно, видео недоступно или имеет ограничения.")
+        await context.bot_data['sender'].reply(message, "❌ Не удалось обработать ссылку на YouTube. Возможно, видео недоступно или имеет ограничения.")
 
 @ignore_if_processing
 async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -793,79 +2730,510 @@ async def handle_url(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await process_request(update, context, [types.Part(text=message.text)])
 
 @ignore_if_processing
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE, custom_text: str = None):
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message = update.message
-    if not message or not message.from_user: return
-    
-    text = custom_text or (message.text or "").strip()
-    if not text: return
+    if not message: return
+    await _handle_text(update, context, (message.text or "").strip(), context.bot_data['coalescer'].pop(update))
+
+async def _handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, followers: list[Message] = ()):
+    # Тело handle_message без ignore_if_processing: его же вызывают медиа-обработчики, когда файл обработать
+    # нельзя и остается ответить на подпись — вложенный вызов декорированного обработчика молча бы вернулся
+    message = update.message
+    if not message.from_user or not text: return
         
     chat_id = message.chat_id
     context.chat_data['id'] = chat_id
     
-    content_parts = [types.Part(text=text)]
-    is_media_request = False
+    media_parts, follower_texts = await collect_coalesced(context, followers)
+    content_parts = [*media_parts, types.Part(text="\n".join([text, *follower_texts]))]
+    is_media_request = bool(media_parts)
     
-    if custom_text is None and message.reply_to_message:
-        media_context = find_media_context_in_history(context, message.reply_to_message.message_id)
-        if media_context:
-            media_part = dict_to_part(media_context)
-            if media_part:
-                content_parts.insert(0, media_part)
-                is_media_request = True
-                logger.info(f"Применен ЯВНЫЙ медиа-контекст (через reply) для чата {chat_id}")
+    if message.reply_to_message:
+        media_part = await context.bot_data['media_contexts'].get(chat_id, message.reply_to_message.message_id)
+        if media_part:
+            content_parts.insert(0, media_part)
+            is_media_request = True
+            logger.info(f"Применен ЯВНЫЙ медиа-контекст (через reply) для чата {chat_id}")
 
     await process_request(update, context, content_parts, is_media_request=is_media_request)
 
+# --- ОЧЕРЕДЬ АПДЕЙТОВ ---
+class MessageCoalescer:
+    # Склейка серий сообщений (COALESCE_WINDOW_MS > 0). В группах часто пишут несколькими короткими сообщениями
+    # подряд или присылают альбом — без склейки на каждое уходит отдельный запрос и ответы приходят вразнобой.
+    # Если воркер UpdateDispatcher взял текст или фото, он ждет продолжения: следующие сообщения того же автора
+    # (или того же альбома, media_group_id), пришедшие с паузой не больше окна, забираются из очереди чата и
+    # прикрепляются к первому. Его обработчик (handle_message, handle_photo) забирает их через pop и отвечает один раз.
+    def __init__(self, window_ms: int = COALESCE_WINDOW_MS, max_ms: int = COALESCE_MAX_MS, max_messages: int = COALESCE_MAX_MESSAGES):
+        self.window, self.max_wait, self.max_messages = window_ms / 1000, max_ms / 1000, max_messages
+        self.counters = {"coalesced_batches": 0, "coalesced_messages": 0}
+        self._followers: dict[int, list[Message]] = {} # update_id первого сообщения -> присоединенные
+
+    @staticmethod
+    def _is_mergeable(message: Message | None) -> bool:
+        # Только обычный текст и фото: команды, ссылки и прочие файлы идут в свои обработчики
+        if not message or not message.from_user: return False
+        if message.photo: return True
+        text = message.text or ""
+        if any(entity.type in ("url", "text_link") for entity in message.entities): return False
+        return bool(text.strip()) and not text.startswith("/") and not re.search(URL_REGEX, text) and not re.search(YOUTUBE_REGEX, text)
+
+    def can_lead(self, update: Update) -> bool:
+        return self.window > 0 and self._is_mergeable(update.message)
+
+    def matches(self, lead: Update, update: Update) -> bool:
+        first, message = lead.message, update.message
+        if not self._is_mergeable(message): return False
+        if first.media_group_id and message.media_group_id == first.media_group_id: return True
+        # Ответ на другое сообщение — отдельный вопрос со своим контекстом
+        return message.from_user.id == first.from_user.id and not message.reply_to_message
+
+    def attach(self, lead: Update, followers: list[Message]) -> None:
+        self._followers[lead.update_id] = followers
+        self.counters["coalesced_batches"] += 1
+        self.counters["coalesced_messages"] += len(followers)
+        logger.info(f"ChatID: {lead.message.chat_id} | {len(followers) + 1} сообщений склеены в один запрос.")
+
+    def pop(self, update: Update) -> list[Message]:
+        return self._followers.pop(update.update_id, [])
+
+class UpdateDispatcher:
+    # Вебхук только кладет апдейт в очередь и сразу отвечает Telegram, обработку ведут UPDATE_WORKERS воркеров.
+    # У каждого чата своя очередь: апдейты одного чата выполняются строго по порядку, разные чаты — параллельно.
+    # В общей очереди _ready стоят ключи чатов, которые можно брать в работу; чат попадает туда не более
+    # одного раза и после каждого апдейта встает в конец, так что шумный чат не задерживает остальные.
+    def __init__(self, application: Application, workers: int = UPDATE_WORKERS, max_pending: int = UPDATE_QUEUE_SIZE,
+                 coalescer: MessageCoalescer | None = None):
+        self.application = application
+        self.coalescer = coalescer
+        self.workers = workers
+        self.max_pending = max_pending
+        self.accepting = False
+        self.pending = 0
+        self.in_progress = 0
+        self.counters = {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0}
+        self.max_pending_seen = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._chat_queues: dict[object, deque] = {}
+        self._arrivals: dict[object, asyncio.Event] = {} # Чаты, где воркер ждет продолжения серии сообщений
+        self._ready: asyncio.Queue = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._high_watermark_logged = False
+
+    @staticmethod
+    def _queue_key(update: Update) -> object:
+        if update.effective_chat: return update.effective_chat.id
+        return ("update", update.update_id) # Апдейты без чата ни с чем не упорядочиваем
+
+    def start(self) -> None:
+        self.accepting = True
+        self._tasks = [asyncio.create_task(self._worker(), name=f"update-worker-{i}") for i in range(self.workers)]
+        logger.info(f"Очередь апдейтов запущена: {self.workers} воркеров, лимит очереди {self.max_pending}.")
+
+    def submit(self, update: Update) -> bool:
+        if not self.accepting or self.pending >= self.max_pending:
+            self.counters["rejected"] += 1
+            logger.warning(f"Очередь апдейтов переполнена ({self.pending}/{self.max_pending}), апдейт {update.update_id} отклонен.")
+            return False
+        key = self._queue_key(update)
+        chat_queue = self._chat_queues.get(key)
+        if chat_queue is None:
+            chat_queue = self._chat_queues[key] = deque()
+            self._ready.put_nowait(key)
+        chat_queue.append((update, time.monotonic()))
+        if key in self._arrivals: self._arrivals[key].set()
+        self.pending += 1
+        self.counters["accepted"] += 1
+        self.max_pending_seen = max(self.max_pending_seen, self.pending)
+        if self.pending >= self.max_pending * 0.8:
+            if not self._high_watermark_logged:
+                logger.warning(f"Очередь апдейтов заполнена на {self.pending}/{self.max_pending}, обработка не успевает.")
+                self._high_watermark_logged = True
+        else:
+            self._high_watermark_logged = False
+        return True
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            chat_queue = self._chat_queues[key]
+            update, enqueued_at = chat_queue.popleft()
+            self.pending -= 1
+            self.in_progress += 1
+            wait = time.monotonic() - enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            try:
+                if self.coalescer and self.coalescer.can_lead(update): await self._coalesce(key, update, chat_queue)
+                await self.application.process_update(update)
+                self.counters["processed"] += 1
+            except Exception as e:
+                self.counters["failed"] += 1
+                logger.error(f"Ошибка обработки апдейта {update.update_id}: {e}", exc_info=True)
+            finally:
+                self.in_progress -= 1
+                if chat_queue: self._ready.put_nowait(key)
+                else: del self._chat_queues[key]
+                self._ready.task_done()
+
+    async def _coalesce(self, key: object, update: Update, chat_queue: deque) -> None:
+        # Забираем из головы очереди чата подходящие сообщения, пока после последнего не пройдет окно тишины;
+        # неподходящее сообщение обрывает серию, чтобы не нарушить порядок
+        followers, started = [], time.monotonic()
+        quiet_until = started + self.coalescer.window
+        while len(followers) + 1 < self.coalescer.max_messages:
+            if chat_queue:
+                if not self.coalescer.matches(update, chat_queue[0][0]): break
+                followers.append(chat_queue.popleft()[0].message)
+                self.pending -= 1
+                quiet_until = time.monotonic() + self.coalescer.window
+                continue
+            remaining = min(quiet_until, started + self.coalescer.max_wait) - time.monotonic()
+            if remaining <= 0: break
+            arrival = self._arrivals[key] = asyncio.Event()
+            try: await asyncio.wait_for(arrival.wait(), remaining)
+            except asyncio.TimeoutError: break
+            finally: self._arrivals.pop(key, None)
+        if followers: self.coalescer.attach(update, followers)
+
+    async def stop(self, timeout: float = UPDATE_DRAIN_TIMEOUT) -> None:
+        self.accepting = False
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+            logger.info("Очередь апдейтов дообработана.")
+        except asyncio.TimeoutError:
+            logger.warning(f"Очередь апдейтов не дообработана за {timeout} с: в очереди {self.pending}, в работе {self.in_progress}.")
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        started = self.counters["processed"] + self.counters["failed"] + self.in_progress
+        return {"workers": self.workers, "pending": self.pending, "max_pending": self.max_pending, "max_pending_seen": self.max_pending_seen,
+                "in_progress": self.in_progress, "active_chats": len(self._chat_queues), **self.counters,
+                **(self.coalescer.counters if self.coalescer else {}),
+                "avg_wait_seconds": round(self.total_wait / started, 4) if started else 0.0, "max_wait_seconds": round(self.max_wait, 4)}
+
+class UpdateDeduplicator:
+    # Telegram повторяет доставку, если не дождался 200 или процесс упал до ответа, и без этой проверки
+    # повтор заново запускает генерацию. Каждый update_id принимается один раз: в памяти держатся последние
+    # UPDATE_DEDUP_SIZE id не дольше UPDATE_DEDUP_TTL_SECONDS, а с persistence id еще и захватывается
+    # в таблице processed_updates — это переживает рестарт и работает между репликами.
+    PRUNE_INTERVAL_SECONDS = 600
+
+    def __init__(self, persistence: PostgresPersistence | None = None, max_size: int = UPDATE_DEDUP_SIZE, ttl: float = UPDATE_DEDUP_TTL_SECONDS):
+        self.persistence = persistence
+        self.max_size = max_size
+        self.ttl = ttl
+        self.duplicates = 0
+        self._seen: OrderedDict[int, float] = OrderedDict() # update_id -> время получения
+        self._last_prune = 0.0
+        self._background: set[asyncio.Task] = set()
+
+    def _remember(self, update_id: int) -> None:
+        now = time.monotonic()
+        self._seen[update_id] = now
+        self._seen.move_to_end(update_id)
+        while self._seen and (len(self._seen) > self.max_size or now - next(iter(self._seen.values())) > self.ttl):
+            self._seen.popitem(last=False)
+
+    async def claim(self, update_id: int) -> bool:
+        seen_at = self._seen.get(update_id)
+        if seen_at is not None and time.monotonic() - seen_at < self.ttl:
+            self.duplicates += 1
+            return False
+        if self.persistence:
+            try:
+                claimed = await self.persistence.claim_update(update_id)
+            except self.persistence.db_errors as e:
+                # Без БД лучше рискнуть повторной обработкой, чем потерять апдейт
+                logger.error(f"Не удалось проверить update_id {update_id} в БД: {e}")
+                claimed = True
+            if time.monotonic() - self._last_prune > self.PRUNE_INTERVAL_SECONDS:
+                self._last_prune = time.monotonic()
+                task = asyncio.create_task(self._prune())
+                self._background.add(task)
+                task.add_done_callback(self._background.discard)
+            if not claimed:
+                self._remember(update_id)
+                self.duplicates += 1
+                return False
+        self._remember(update_id)
+        return True
+
+    async def release(self, update_id: int) -> None:
+        # Апдейт не принят в обработку (очередь переполнена) — его повторная доставка должна пройти
+        self._seen.pop(update_id, None)
+        if not self.persistence: return
+        try: await self.persistence.release_update(update_id)
+        except self.persistence.db_errors as e: logger.error(f"Не удалось снять отметку update_id {update_id} в БД: {e}")
+
+    async def _prune(self) -> None:
+        try: await self.persistence.prune_updates(self.ttl)
+        except self.persistence.db_errors as e: logger.warning(f"Не удалось очистить processed_updates: {e}")
+
+# --- МНОГОПРОЦЕССНЫЙ РЕЖИМ ---
+def update_affinity_key(data: dict) -> int:
+    # Ключ, по которому апдейт закрепляется за воркером: чат (как у очереди UpdateDispatcher), без чата — автор,
+    # без автора — сам update_id. Все апдейты чата попадают в один процесс, поэтому порядок их обработки, chat_data,
+    # processing_messages, медиа-контексты и кэши чата остаются локальными, как в однопроцессном режиме.
+    for value in data.values():
+        if not isinstance(value, dict): continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat: return int(chat["id"])
+        if value.get("from"): return int(value["from"]["id"])
+    return int(data["update_id"])
+
+def merge_worker_metrics(texts: list[str | None]) -> str:
+    # Метрики воркеров сводятся в один ответ /metrics: семейства склеиваются, к каждому сэмплу добавляется метка worker
+    headers: dict[str, tuple[int, list[str]]] = {} # имя -> (воркер, чьи HELP/TYPE берем; строки)
+    samples: dict[str, list[str]] = {}
+    for index, text in enumerate(texts):
+        family = None
+        for line in (text or "").splitlines():
+            if line.startswith("#"):
+                family = line.split()[2]
+                if headers.setdefault(family, (index, []))[0] == index: headers[family][1].append(line)
+                samples.setdefault(family, [])
+            elif line and family:
+                name, value = line.rsplit(" ", 1)
+                name, _, labels = name.partition("{")
+                samples[family].append(f'{name}{{worker="{index}"{"," + labels if labels else "}"} {value}')
+    return "\n".join(line for family, (_, lines) in headers.items() for line in lines + samples[family]) + "\n"
+
+class WorkerPool:
+    # Фронт-процесс (WORKER_PROCESSES > 1) сам апдейты не обрабатывает: он запускает N копий этого же скрипта
+    # с WORKER_INDEX=i и пересылает каждый апдейт воркеру update_affinity_key % N, возвращая Telegram его ответ
+    # (503 — Telegram повторит доставку). Упавший воркер перезапускается; пока он поднимается, его чаты получают 503.
+    # Глобальные лимиты на бота (TELEGRAM_GLOBAL_RATE, GEMINI_RPM) и ресурсы процесса (GEMINI_MAX_CONCURRENCY,
+    # MEDIA_MEMORY_BUDGET_MB, DB_POOL_MAX_SIZE, UPDATE_QUEUE_SIZE) делятся между воркерами поровну, целые — не меньше 1
+    # на воркер. Лимиты на пользователя считаются в каждом воркере отдельно — автор, пишущий в чаты разных воркеров,
+    # получит их больше.
+    RESTART_DELAY_SECONDS = 2.0
+    READY_TIMEOUT_SECONDS = 60.0
+
+    def __init__(self, size: int = WORKER_PROCESSES, base_port: int = WORKER_BASE_PORT):
+        self.size, self.base_port = size, base_port
+        self.stopping = False
+        self.counters = {"forwarded": 0, "forward_failures": 0, "worker_restarts": 0}
+        self.forwarded_per_worker = [0] * size
+        self._processes: list[asyncio.subprocess.Process | None] = [None] * size
+        self._supervisors: list[asyncio.Task] = []
+        self._session: aiohttp.ClientSession | None = None
+
+    def url(self, index: int, path: str) -> str: return f"http://127.0.0.1:{self.base_port + index}{path}"
+
+    def _env(self, index: int) -> dict:
+        env = dict(os.environ, WORKER_INDEX=str(index))
+        env["TELEGRAM_GLOBAL_RATE"], env["GEMINI_RPM"] = str(TELEGRAM_GLOBAL_RATE / self.size), str(GEMINI_RPM / self.size)
+        for name, value in (("GEMINI_MAX_CONCURRENCY", GEMINI_MAX_CONCURRENCY), ("MEDIA_MEMORY_BUDGET_MB", MEDIA_MEMORY_BUDGET_MB),
+                            ("DB_POOL_MAX_SIZE", DB_POOL_MAX_SIZE), ("UPDATE_QUEUE_SIZE", UPDATE_QUEUE_SIZE)):
+            env[name] = str(max(1, value // self.size))
+        env["DB_POOL_MIN_SIZE"] = str(min(DB_POOL_MIN_SIZE, int(env["DB_POOL_MAX_SIZE"])))
+        return env
+
+    def _client(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            # Воркер отвечает сразу после постановки апдейта в очередь, долгий ответ — признак зависания
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        return self._session
+
+    def start(self) -> None:
+        self._supervisors = [asyncio.create_task(self._supervise(i), name=f"worker-supervisor-{i}") for i in range(self.size)]
+
+    async def _supervise(self, index: int) -> None:
+        while not self.stopping:
+            process = self._processes[index] = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=self._env(index))
+            logger.info(f"Воркер {index} запущен (pid {process.pid}, порт {self.base_port + index}).")
+            code = await process.wait()
+            if self.stopping: return
+            self.counters["worker_restarts"] += 1
+            logger.error(f"Воркер {index} завершился с кодом {code}, перезапуск через {self.RESTART_DELAY_SECONDS} с.")
+            await asyncio.sleep(self.RESTART_DELAY_SECONDS)
+
+    async def wait_ready(self) -> None:
+        # Вебхук ставится, когда воркеры уже слушают порты, иначе первые апдейты получат 503
+        deadline = time.monotonic() + self.READY_TIMEOUT_SECONDS
+        for index in range(self.size):
+            while await self.fetch(index, "/") is None:
+                if time.monotonic() > deadline:
+                    logger.warning(f"Воркер {index} не ответил за {self.READY_TIMEOUT_SECONDS:.0f} с, его апдейты будут получать 503 до запуска.")
+                    break
+                await asyncio.sleep(0.5)
+
+    async def forward(self, body: bytes, key: int) -> int:
+        index = key % self.size
+        try:
+            async with self._client().post(self.url(index, '/' + GEMINI_WEBHOOK_PATH.strip('/')), data=body,
+                                           headers={"Content-Type": "application/json"}) as response:
+                self.counters["forwarded"] += 1
+                self.forwarded_per_worker[index] += 1
+                return response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.counters["forward_failures"] += 1
+            logger.warning(f"Воркер {index} недоступен ({e!r}), Telegram повторит доставку апдейта.")
+            return 503
+
+    async def fetch(self, index: int, path: str) -> str | None:
+        try:
+            async with self._client().get(self.url(index, path)) as response:
+                return await response.text() if response.status == 200 else None
+        except (aiohttp.ClientError, asyncio.TimeoutError): return None
+
+    async def stop(self, timeout: float = WORKER_STOP_TIMEOUT) -> None:
+        # SIGTERM запускает в воркере штатную остановку: дообработка очереди и запись chat_data в БД
+        self.stopping = True
+        running = [process for process in self._processes if process and process.returncode is None]
+        for process in running: process.send_signal(signal.SIGTERM)
+        if running:
+            _, pending = await asyncio.wait([asyncio.create_task(process.wait()) for process in running], timeout=timeout)
+            if pending:
+                logger.warning(f"{len(pending)} воркеров не остановились за {timeout:.0f} с, принудительное завершение.")
+                for process in running:
+                    if process.returncode is None: process.kill()
+                await asyncio.gather(*pending, return_exceptions=True)
+        for task in self._supervisors: task.cancel()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+        if self._session: await self._session.close()
+
+    def stats(self) -> dict:
+        alive = sum(1 for process in self._processes if process and process.returncode is None)
+        return {"worker_processes": self.size, "workers_alive": alive, **self.counters, "forwarded_per_worker": self.forwarded_per_worker}
+
 # --- ЗАПУСК БОТА ---
 async def handle_health_check(request: aiohttp.web.Request) -> aiohttp.web.Response:
-    logger.info("Health check OK")
+    logger.debug("Health check OK")
     return aiohttp.web.Response(text="OK", status=200)
     
+async def handle_metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    return aiohttp.web.Response(text=METRICS.render(), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+async def handle_stats(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    return aiohttp.web.json_response({**request.app['dispatcher'].stats(), "duplicate_updates": request.app['deduplicator'].duplicates,
+                                      **request.app['bot_app'].bot_data['file_cache'].counters,
+                                      **request.app['bot_app'].bot_data['response_cache'].counters,
+                                      **request.app['bot_app'].bot_data['media_contexts'].counters,
+                                      **request.app['bot_app'].bot_data['context_caches'].counters,
+                                      **request.app['bot_app'].bot_data['token_budget'].stats(),
+                                      **request.app['bot_app'].bot_data['history_compactor'].counters,
+                                      "routes": request.app['bot_app'].bot_data['router'].stats(),
+                                      "file_uploads": request.app['bot_app'].bot_data['file_uploads'].stats(),
+                                      "admission": request.app['bot_app'].bot_data['admission'].stats(),
+                                      "chat_locks": request.app['bot_app'].bot_data['chat_locks'].stats(),
+                                      "outbound": request.app['bot_app'].bot_data['sender'].stats(),
+                                      "media_downloads": request.app['bot_app'].bot_data['media_downloader'].stats()})
+
 async def handle_telegram_webhook(request: aiohttp.web.Request) -> aiohttp.web.Response:
     application = request.app['bot_app']
     try:
         data = await request.json()
         update = Update.de_json(data, application.bot)
-        await application.process_update(update)
+        if not await request.app['deduplicator'].claim(update.update_id):
+            logger.info(f"Повторная доставка апдейта {update.update_id} проигнорирована.")
+            return aiohttp.web.Response(status=200)
+        # Ответ не ждет генерации: иначе Telegram держит соединение и повторяет доставку медленных апдейтов
+        if not request.app['dispatcher'].submit(update):
+            await request.app['deduplicator'].release(update.update_id)
+            return aiohttp.web.Response(status=503)
         return aiohttp.web.Response(status=200)
     except Exception as e:
         logger.error(f"Ошибка обработки вебхука: {e}", exc_info=True)
         return aiohttp.web.Response(status=500)
 
-async def run_web_server(application: Application, stop_event: asyncio.Event):
+async def handle_front_webhook(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    body = await request.read()
+    try: key = update_affinity_key(json.loads(body))
+    except (ValueError, TypeError, KeyError) as e:
+        logger.error(f"Ошибка разбора вебхука во фронт-процессе: {e}")
+        return aiohttp.web.Response(status=500)
+    return aiohttp.web.Response(status=await request.app['pool'].forward(body, key))
+
+async def handle_front_stats(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    pool = request.app['pool']
+    texts = await asyncio.gather(*(pool.fetch(index, '/stats') for index in range(pool.size)))
+    return aiohttp.web.json_response({**pool.stats(), "workers": [json.loads(text) if text else None for text in texts]})
+
+async def handle_front_metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    pool = request.app['pool']
+    texts = await asyncio.gather(*(pool.fetch(index, '/metrics') for index in range(pool.size)))
+    return aiohttp.web.Response(text=merge_worker_metrics(texts), content_type="text/plain", headers={"X-Content-Type-Options": "nosniff"})
+
+def create_web_app(application: Application, dispatcher: UpdateDispatcher, deduplicator: UpdateDeduplicator) -> aiohttp.web.Application:
     app = aiohttp.web.Application()
     app['bot_app'] = application
+    app['dispatcher'] = dispatcher
+    app['deduplicator'] = deduplicator
     app.router.add_post('/' + GEMINI_WEBHOOK_PATH.strip('/'), handle_telegram_webhook)
     app.router.add_get('/', handle_health_check) 
-    
+    app.router.add_get('/stats', handle_stats)
+    app.router.add_get('/metrics', handle_metrics)
+    METRICS.gauge("bot_gemini_requests_in_flight", "Запросы к Gemini, занявшие слот AdmissionController.", lambda: application.bot_data['admission'].active)
+    METRICS.gauge("bot_updates_in_progress", "Апдейты в обработке воркерами.", lambda: dispatcher.in_progress)
+    METRICS.gauge("bot_updates_pending", "Апдейты в очереди UpdateDispatcher.", lambda: dispatcher.pending)
+    METRICS.gauge("bot_processing_messages", "Размер processing_messages (сообщения в обработке).", lambda: len(application.bot_data.get('processing_messages', ())))
+    METRICS.gauge("bot_outbound_queue_depth", "Исходящие в Telegram, ждущие лимита.", lambda: len(application.bot_data['sender']._queue))
+    return app
+
+def create_front_app(pool: WorkerPool) -> aiohttp.web.Application:
+    app = aiohttp.web.Application()
+    app['pool'] = pool
+    app.router.add_post('/' + GEMINI_WEBHOOK_PATH.strip('/'), handle_front_webhook)
+    app.router.add_get('/', handle_health_check)
+    app.router.add_get('/stats', handle_front_stats)
+    app.router.add_get('/metrics', handle_front_metrics)
+    return app
+
+async def run_web_server(app: aiohttp.web.Application, stop_event: asyncio.Event, host: str = '0.0.0.0', port: int | None = None):
     runner = aiohttp.web.AppRunner(app)
     await runner.setup()
-    port = int(os.getenv("PORT", "10000"))
-    site = aiohttp.web.TCPSite(runner, '0.0.0.0', port)
+    port = port or int(os.getenv("PORT", "10000"))
+    site = aiohttp.web.TCPSite(runner, host, port)
     await site.start()
     logger.info(f"Веб-сервер запущен на порту {port}")
     await stop_event.wait()
     await runner.cleanup()
     
-async def main():
-    persistence = PostgresPersistence(DATABASE_URL) if DATABASE_URL else None
-    builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
-    if persistence: builder.persistence(persistence)
-    application = builder.build()
-    
-    await application.initialize()
-    
-    application.bot_data['gemini_client'] = genai.Client(api_key=GOOGLE_API_KEY)
-    
-    commands = [
-        BotCommand("start", "Инфо и начало работы"),
-        BotCommand("transcript", "Транскрипция медиа (ответом)"),
-        BotCommand("summarize", "Краткий пересказ (ответом)"),
-        BotCommand("keypoints", "Ключевые тезисы (ответом)"),
-        BotCommand("newtopic", "Сбросить контекст файлов"),
-        BotCommand("clear", "Очистить всю историю чата")
-    ]
+BOT_COMMANDS = [
+    BotCommand("start", "Инфо и начало работы"),
+    BotCommand("transcript", "Транскрипция медиа (ответом)"),
+    BotCommand("summarize", "Краткий пересказ (ответом)"),
+    BotCommand("keypoints", "Ключевые тезисы (ответом)"),
+    BotCommand("newtopic", "Сбросить контекст файлов"),
+    BotCommand("clear", "Очистить всю историю чата")
+]
+
+def setup_bot_data(application: Application, persistence: PostgresPersistence | None, gemini_client: genai.Client) -> None:
+    # Общие для main() и benchmarks/load_test.py компоненты; там клиент Gemini и persistence подменяются заглушками
+    application.bot_data['gemini_client'] = gemini_client
+    if FILE_CACHE_BACKEND == "postgres" and not persistence:
+        logger.warning("FILE_CACHE_BACKEND=postgres требует DATABASE_URL — кэш загрузок File API только в памяти.")
+    application.bot_data['context_caches'] = ContextCacheManager()
+    application.bot_data['token_budget'] = TokenBudget()
+    application.bot_data['history_compactor'] = HistoryCompactor()
+    application.bot_data['router'] = RequestRouter()
+    application.bot_data['sender'] = OutboundScheduler()
+    application.bot_data['chat_locks'] = ChatLockManager()
+    application.bot_data['admission'] = AdmissionController()
+    application.bot_data['file_uploads'] = FileUploadManager(admission=application.bot_data['admission'])
+    application.bot_data['media_downloader'] = MediaDownloader()
+    if RESPONSE_CACHE_BACKEND == "postgres" and not persistence:
+        logger.warning("RESPONSE_CACHE_BACKEND=postgres требует DATABASE_URL — кэш ответов только в памяти.")
+    if MEDIA_CONTEXT_BACKEND == "postgres" and not persistence:
+        logger.warning("MEDIA_CONTEXT_BACKEND=postgres требует DATABASE_URL — медиа-контексты только в памяти.")
+    application.bot_data['media_contexts'] = MediaContextStore(persistence if MEDIA_CONTEXT_BACKEND == "postgres" else None)
+    application.bot_data['response_cache'] = ResponseCache(persistence if RESPONSE_CACHE_BACKEND == "postgres" else None)
+    application.bot_data['file_cache'] = FileUploadCache(persistence if FILE_CACHE_BACKEND == "postgres" else None,
+                                                         application.bot_data['file_uploads'], application.bot_data['media_downloader'])
+    application.bot_data['coalescer'] = MessageCoalescer()
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if isinstance(context.error, ChatDataUnavailable) and isinstance(update, Update) and update.effective_message:
+        await context.bot_data['sender'].reply(update.effective_message, "⚠️ История чата временно недоступна, попробуйте еще раз через минуту.")
+        return
+    logger.error(f"Необработанная ошибка при обработке апдейта: {context.error}", exc_info=context.error)
+
+def add_handlers(application: Application) -> None:
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("clear", clear_command))
     application.add_handler(CommandHandler("transcript", transcript_command))
@@ -883,21 +3251,71 @@ async def main():
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & filters.Regex(YOUTUBE_REGEX), handle_youtube_url))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND & url_filter, handle_url))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_error_handler(error_handler)
+
+async def register_webhook(bot: Bot) -> None:
+    await bot.set_my_commands(BOT_COMMANDS)
+    webhook_url = f"{WEBHOOK_HOST.rstrip('/')}/{GEMINI_WEBHOOK_PATH.strip('/')}"
+    await bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Вебхук установлен на: {webhook_url}")
+
+async def run_front():
+    # Многопроцессный режим: этот процесс только держит вебхук и раздает апдейты воркерам (см. WorkerPool)
+    if DATABASE_URL and PERSISTENCE_STORAGE_MODE == "rows":
+        # Перенос blob-чатов в построчное хранение — здесь, один раз: воркеры его пропускают (см. _initialize_db)
+        await (await create_persistence(DATABASE_URL)).close()
+    pool = WorkerPool()
+    pool.start()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await pool.wait_ready()
+        async with Bot(TELEGRAM_BOT_TOKEN) as bot: await register_webhook(bot)
+        # Порт закрывается до остановки воркеров: новые апдейты Telegram доставит после рестарта
+        await run_web_server(create_front_app(pool), stop_event)
+    finally:
+        logger.info("Начало штатной остановки воркеров...")
+        await pool.stop()
+        logger.info("Фронт-процесс и воркеры остановлены.")
+
+async def main():
+    persistence = await create_persistence(DATABASE_URL)
+    builder = Application.builder().token(TELEGRAM_BOT_TOKEN)
+    if persistence: builder.persistence(persistence)
+    application = builder.build()
+    if persistence: persistence.evict_callback = lambda chat_id: unload_chat_data(application, chat_id)
+    
+    await application.initialize()
+    
+    setup_bot_data(application, persistence, genai.Client(api_key=GOOGLE_API_KEY))
+    add_handlers(application)
     
-    await application.bot.set_my_commands(commands)
+    dispatcher = UpdateDispatcher(application, coalescer=application.bot_data['coalescer'])
+    dispatcher.start()
+    if UPDATE_DEDUP_BACKEND == "postgres" and not persistence:
+        logger.warning("UPDATE_DEDUP_BACKEND=postgres требует DATABASE_URL — дедупликация апдейтов только в памяти.")
+    deduplicator = UpdateDeduplicator(persistence if UPDATE_DEDUP_BACKEND == "postgres" else None)
     
     stop_event = asyncio.Event()
     loop = asyncio.get_running_loop()
     for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop_event.set)
     try:
-        webhook_url = f"{WEBHOOK_HOST.rstrip('/')}/{GEMINI_WEBHOOK_PATH.strip('/')}"
-        await application.bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
-        logger.info(f"Вебхук установлен на: {webhook_url}")
-        await run_web_server(application, stop_event)
+        web_app = create_web_app(application, dispatcher, deduplicator)
+        if WORKER_INDEX is None:
+            await register_webhook(application.bot)
+            await run_web_server(web_app, stop_event)
+        else:
+            # Воркер многопроцессного режима: вебхук держит фронт-процесс, порт доступен только локально
+            await run_web_server(web_app, stop_event, host='127.0.0.1', port=WORKER_BASE_PORT + int(WORKER_INDEX))
     finally:
         logger.info("Начало штатной остановки...")
-        if persistence: persistence.close()
+        await dispatcher.stop()
+        await application.bot_data['media_downloader'].close()
+        if persistence:
+            await persistence.flush()
+            await persistence.close()
         logger.info("Приложение полностью остановлено.")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    asyncio.run(run_front() if WORKER_PROCESSES > 1 and WORKER_INDEX is None else main())
@@ -0,0 +1,9 @@
+# Общая настройка тестов: main.py читает обязательные переменные окружения при импорте
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+for var in ("TELEGRAM_BOT_TOKEN", "GOOGLE_API_KEY", "WEBHOOK_HOST", "GEMINI_WEBHOOK_PATH"):
+    os.environ.setdefault(var, "test")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("GEMINI_RPM", "0")
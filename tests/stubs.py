@@ -0,0 +1,72 @@
+# Заглушки Bot API и Gemini для тестов обработчиков без сети
+import itertools
+import json
+from types import SimpleNamespace
+
+from google.genai import types
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import main
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "bot", "username": "test_bot"}
+USER = {"id": 7, "is_bot": False, "first_name": "user"}
+
+class BotApiStub(BaseRequest):
+    # Отвечает на методы Bot API и запоминает их: sendMessage/editMessageText возвращают сообщение бота, прочие — True
+    read_timeout = None
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self._message_ids = itertools.count(10**6)
+
+    async def initialize(self): pass
+    async def shutdown(self): pass
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        name = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((name, params))
+        if name == "getMe": result = BOT_USER
+        elif name in ("sendMessage", "editMessageText"):
+            result = {"message_id": params.get("message_id") or next(self._message_ids), "date": 0, "text": params.get("text", ""),
+                      "chat": {"id": int(params["chat_id"]), "type": "private"}, "from": BOT_USER}
+        else: result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    def sent_texts(self) -> list[str]: return [params["text"] for name, params in self.calls if name == "sendMessage"]
+
+class FakeGeminiClient:
+    # client.aio.models.generate_content с фиксированным ответом; contents каждого вызова сохраняются
+    def __init__(self, answer: str = "ответ модели"):
+        self.answer, self.requests = answer, []
+        self.aio = SimpleNamespace(models=SimpleNamespace(generate_content=self.generate_content))
+
+    async def generate_content(self, model, contents, config=None):
+        self.requests.append(contents)
+        return types.GenerateContentResponse(candidates=[types.Candidate(content=types.Content(role="model", parts=[types.Part(text=self.answer)]),
+                                                                         finish_reason=types.FinishReason.STOP)])
+
+async def make_application(gemini_client=None, persistence=None) -> tuple[Application, BotApiStub]:
+    bot_api = BotApiStub()
+    builder = Application.builder().token("123:abc").request(bot_api)
+    if persistence: builder.persistence(persistence)
+    application = builder.build()
+    await application.initialize()
+    main.setup_bot_data(application, persistence, gemini_client or FakeGeminiClient())
+    main.add_handlers(application)
+    return application, bot_api
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+def message_dict(chat_id: int, text: str | None = None, **fields) -> dict:
+    message = {"message_id": next(_message_ids), "date": 0, "chat": {"id": chat_id, "type": "private"}, "from": USER, **fields}
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return message
+
+def make_update(application: Application, message: dict) -> Update:
+    return Update.de_json({"update_id": next(_update_ids), "message": message}, application.bot)
@@ -0,0 +1,101 @@
+# TokenBucket и AdmissionController: лимиты запросов, очередь слотов по чатам и повторы 429/503
+
+import asyncio
+
+import pytest
+from google.genai import errors as genai_errors
+
+import main
+
+class Clock:
+    def __init__(self): self.now = 1000.0
+    def __call__(self): return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "monotonic", clock)
+    return clock
+
+@pytest.fixture
+def slept(monkeypatch):
+    # asyncio.sleep в AdmissionController только записывает задержку
+    delays = []
+    async def sleep(delay, result=None):
+        delays.append(delay)
+        return result
+    monkeypatch.setattr(main.asyncio, "sleep", sleep)
+    return delays
+
+def api_error(code: int, retry_delay: str | None = None) -> genai_errors.APIError:
+    details = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": retry_delay}] if retry_delay else []
+    return genai_errors.APIError(code, {"error": {"code": code, "message": "error", "status": "UNAVAILABLE", "details": details}})
+
+def test_token_bucket_refill_and_pause(clock):
+    bucket = main.TokenBucket(rate=2, capacity=2)
+    bucket.take(); bucket.take()
+    assert bucket.wait_time() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.wait_time() == 0
+    clock.now += 10
+    assert bucket.is_full() and bucket.tokens == 2 # не больше capacity
+    bucket.pause(3) # после 429 — долг на 3 с
+    assert bucket.wait_time() == pytest.approx(3)
+
+def test_admit_throttles_then_rejects(clock, slept):
+    admission = main.AdmissionController(chat_rate=60, chat_burst=2, user_rate=0, max_wait=1.5)
+    async def scenario():
+        for _ in range(3): await admission.admit("chat") # два из запаса, третий ждет токен
+        with pytest.raises(main.RateLimitExceeded) as rejected: await admission.admit("chat")
+        await admission.admit("other chat") # у другого чата своя корзина
+        return rejected.value.retry_after
+    assert asyncio.run(scenario()) == pytest.approx(2)
+    assert slept == [pytest.approx(1)]
+    assert (admission.counters["admitted"], admission.counters["throttled"], admission.counters["rate_limited"]) == (4, 1, 1)
+
+def test_retry_uses_requested_delay_and_drains_global_bucket(clock, slept):
+    admission = main.AdmissionController(rpm=60, retry_attempts=3, retry_max_delay=30)
+    attempts = []
+    async def call():
+        attempts.append(len(attempts))
+        if len(attempts) == 1: raise api_error(429, "7s")
+        return "ok"
+    assert asyncio.run(admission.call(call)) == "ok"
+    assert attempts == [0, 1] and slept == [7.0]
+    assert admission.global_bucket.wait_time() == pytest.approx(7) # после 429 общая корзина пуста на время паузы
+    assert admission.counters["api_retries"] == 1
+
+def test_retry_gives_up(clock, slept):
+    admission = main.AdmissionController(rpm=0, retry_attempts=2, retry_max_delay=30)
+    async def unavailable(): raise api_error(503)
+    with pytest.raises(genai_errors.APIError): asyncio.run(admission.call(unavailable))
+    assert len(slept) == 2 and all(1 <= delay <= 30 for delay in slept)
+    assert admission.counters["api_retry_giveups"] == 1
+
+    slept.clear()
+    async def bad_request(): raise api_error(400)
+    with pytest.raises(genai_errors.APIError): asyncio.run(admission.call(bad_request))
+    async def long_quota_wait(): raise api_error(429, "120s") # дольше retry_max_delay — не ждем
+    with pytest.raises(genai_errors.APIError): asyncio.run(admission.call(long_quota_wait))
+    assert slept == []
+
+def test_slots_are_granted_round_robin_across_chats():
+    admission = main.AdmissionController(max_concurrency=1, rpm=0)
+    order = []
+    async def request(chat, n, hold):
+        async with admission.slot(chat):
+            order.append(f"{chat}{n}")
+            await hold.wait()
+    async def scenario():
+        hold = asyncio.Event()
+        tasks = [asyncio.create_task(request("busy", 0, hold))]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(request("busy", n, hold)) for n in (1, 2, 3)]
+        tasks.append(asyncio.create_task(request("quiet", 1, hold)))
+        await asyncio.sleep(0)
+        assert admission.stats()["waiting"] == 4
+        hold.set()
+        await asyncio.gather(*tasks)
+    asyncio.run(scenario())
+    assert order == ["busy0", "busy1", "quiet1", "busy2", "busy3"]
+    assert admission.active == 0
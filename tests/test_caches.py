@@ -0,0 +1,140 @@
+# Кэши с TTL и LRU: загрузки в File API (FileUploadCache) и готовые ответы утилитарных команд (ResponseCache)
+
+import asyncio
+import hashlib
+import io
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import psycopg2
+import pytest
+from google.genai import types
+
+import main
+
+class Clock:
+    def __init__(self): self.now = 1_700_000_000.0
+    def __call__(self): return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(main.time, "time", clock)
+    return clock
+
+class FakeDownloader:
+    spool_bytes = 1024
+    def __init__(self, contents: dict[str, bytes]):
+        self.contents, self.downloads = contents, []
+    @asynccontextmanager
+    async def reserve(self, size_bytes):
+        yield
+    async def download(self, media_file):
+        self.downloads.append(media_file.file_id)
+        data = self.contents[media_file.file_id]
+        return io.BytesIO(data), hashlib.sha256(data).hexdigest(), len(data)
+
+class FakeUploader:
+    def __init__(self): self.uploads = []
+    async def upload(self, client, file_obj, size_bytes, mime_type, file_name, queue_key=None):
+        await asyncio.sleep(0.01)
+        self.uploads.append(file_name)
+        return f"files/{len(self.uploads)}", True
+    async def wait_active(self, client, uploaded_file, uploaded, size_bytes, mime_type, file_name):
+        return types.Part(file_data=types.FileData(file_uri=f"https://files/{uploaded_file}", mime_type=mime_type))
+
+def media(file_id: str, unique_id: str):
+    async def get_file(): return SimpleNamespace(file_id=file_id, file_size=None)
+    return SimpleNamespace(file_unique_id=unique_id, file_size=10, get_file=get_file)
+
+def file_cache(contents: dict[str, bytes], **kwargs) -> main.FileUploadCache:
+    return main.FileUploadCache(uploader=FakeUploader(), downloader=FakeDownloader(contents), **kwargs)
+
+def get_uri(cache: main.FileUploadCache, media_obj) -> str:
+    return asyncio.run(cache.get_part(None, media_obj, "video/mp4", "video.mp4")).file_data.file_uri
+
+def test_file_cache_reuses_uploads_by_id_and_by_content(clock):
+    cache = file_cache({"a": b"same", "b": b"same", "c": b"other"})
+    first = get_uri(cache, media("a", "A"))
+    assert get_uri(cache, media("a", "A")) == first # /summarize, затем /keypoints: без скачивания и загрузки
+    assert get_uri(cache, media("b", "B")) == first # пересланная копия: скачана, но не загружена
+    assert get_uri(cache, media("c", "C")) != first
+    assert cache.downloader.downloads == ["a", "b", "c"] and len(cache.uploader.uploads) == 2
+    assert cache.counters == {"file_cache_id_hits": 1, "file_cache_hash_hits": 1, "file_cache_uploads": 2}
+
+def test_file_cache_uploads_concurrent_requests_once(clock):
+    cache = file_cache({"a": b"data"})
+    async def scenario():
+        return await asyncio.gather(*(cache.get_part(None, media("a", "A"), "video/mp4", "video.mp4") for _ in range(3)))
+    parts = asyncio.run(scenario())
+    assert len({part.file_data.file_uri for part in parts}) == 1 and len(cache.uploader.uploads) == 1
+
+def test_file_cache_expires_and_evicts(clock):
+    cache = file_cache({"a": b"1", "b": b"2", "c": b"3"}, max_size=4, ttl=100) # по два ключа на файл: uid и sha256
+    get_uri(cache, media("a", "A"))
+    clock.now += 101
+    get_uri(cache, media("a", "A")) # запись истекла — файл загружается заново
+    assert len(cache.uploader.uploads) == 2
+    get_uri(cache, media("b", "B"))
+    get_uri(cache, media("a", "A")) # A свежее B
+    get_uri(cache, media("c", "C")) # вытесняет самые старые ключи: хэш A и uid B
+    assert list(cache._entries) == [f"sha256:{hashlib.sha256(b'2').hexdigest()}", "uid:A", "uid:C", f"sha256:{hashlib.sha256(b'3').hexdigest()}"]
+    get_uri(cache, media("b", "B")) # по uid промах, но по хэшу содержимого файл еще в кэше
+    assert len(cache.uploader.uploads) == 4 and cache.counters["file_cache_hash_hits"] == 1
+
+class ResponseStore:
+    # Таблица response_cache в памяти; с broken=True чтение и запись падают, как при обрыве соединения
+    db_errors = (psycopg2.Error,)
+    def __init__(self): self.rows, self.broken = {}, False
+    async def get_cached_response(self, key):
+        if self.broken: raise psycopg2.OperationalError("connection lost")
+        row = self.rows.get(key)
+        return row if row and row[1] > main.time.time() else None
+    async def put_cached_response(self, key, response, expires_at):
+        if self.broken: raise psycopg2.OperationalError("connection lost")
+        self.rows[key] = (response, expires_at)
+    async def prune_cached_responses(self): pass
+
+def generator(calls: list, text: str = "ответ", cacheable: bool = True):
+    async def generate():
+        calls.append(text)
+        await asyncio.sleep(0.01)
+        return text, cacheable
+    return generate
+
+def test_response_cache_generates_once_and_skips_incomplete(clock):
+    cache, calls = main.ResponseCache(), []
+    key = cache.make_key("Summarize  this", "yt:abc")
+    assert key == cache.make_key("summarize this", "yt:abc") != cache.make_key("summarize this", "yt:xyz")
+    async def scenario():
+        texts = await asyncio.gather(*(cache.get_or_generate(key, generator(calls)) for _ in range(3)))
+        blocked = [await cache.get_or_generate("blocked", generator(calls, "ошибка", cacheable=False)) for _ in range(2)]
+        return texts, blocked
+    texts, blocked = asyncio.run(scenario())
+    assert texts == ["ответ"] * 3 and blocked == ["ошибка"] * 2
+    assert calls == ["ответ", "ошибка", "ошибка"] # неполный ответ не кэшируется
+    assert cache.counters == {"response_cache_hits": 2, "response_cache_misses": 3}
+
+def test_response_cache_ttl_and_lru(clock):
+    cache, calls = main.ResponseCache(max_size=2, ttl=100), []
+    async def ask(key): return await cache.get_or_generate(key, generator(calls, key))
+    async def scenario():
+        for key in ("a", "b", "a", "c"): await ask(key) # "c" вытесняет "b" — "a" использовали позже
+        await ask("a")
+        await ask("b")
+        clock.now += 101
+        await ask("b")
+    asyncio.run(scenario())
+    assert calls == ["a", "b", "c", "b", "b"]
+
+def test_response_cache_shared_through_persistence_and_survives_db_errors(clock):
+    store = ResponseStore()
+    first, second, calls = main.ResponseCache(store), main.ResponseCache(store), []
+    async def scenario():
+        await first.get_or_generate("k", generator(calls))
+        shared = await second.get_or_generate("k", generator(calls)) # другая реплика: в памяти пусто, в БД есть
+        store.broken = True
+        degraded = await main.ResponseCache(store).get_or_generate("k", generator(calls, "без БД"))
+        return shared, degraded
+    assert asyncio.run(scenario()) == ("ответ", "без БД")
+    assert calls == ["ответ", "без БД"]
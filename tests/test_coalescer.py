@@ -0,0 +1,57 @@
+# MessageCoalescer вместе с UpdateDispatcher: серия сообщений автора склеивается, пока паузы короче окна
+
+import asyncio
+import itertools
+
+from telegram import Update
+
+import main
+
+CHAT_ID = 42
+_update_ids = itertools.count(1)
+
+def text_update(text: str, user_id: int = 7, **fields) -> Update:
+    update_id = next(_update_ids)
+    message = {"message_id": update_id, "date": 0, "text": text, "chat": {"id": CHAT_ID, "type": "group"},
+               "from": {"id": user_id, "is_bot": False, "first_name": "u"}, **fields}
+    if text.startswith("/"): message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return Update.de_json({"update_id": update_id, "message": message}, None)
+
+class RecordingApplication:
+    # process_update как у обработчика: забирает присоединенные сообщения через coalescer.pop
+    def __init__(self, coalescer: main.MessageCoalescer):
+        self.coalescer, self.batches = coalescer, []
+    async def process_update(self, update: Update) -> None:
+        self.batches.append([update.message.text, *(message.text for message in self.coalescer.pop(update))])
+
+def run_arrivals(arrivals: list[tuple[float, Update]], window_ms: int = 60, max_ms: int = 1000, max_messages: int = 10) -> list[list[str]]:
+    # arrivals: (задержка перед отправкой в секундах, апдейт)
+    async def scenario():
+        coalescer = main.MessageCoalescer(window_ms=window_ms, max_ms=max_ms, max_messages=max_messages)
+        application = RecordingApplication(coalescer)
+        dispatcher = main.UpdateDispatcher(application, workers=1, coalescer=coalescer)
+        dispatcher.start()
+        for delay, update in arrivals:
+            await asyncio.sleep(delay)
+            assert dispatcher.submit(update)
+        await dispatcher.stop(timeout=5)
+        return application.batches
+    return asyncio.run(scenario())
+
+def test_burst_within_window_is_one_request_and_gap_starts_a_new_one():
+    batches = run_arrivals([(0, text_update("раз")), (0.01, text_update("два")), (0.02, text_update("три")), (0.2, text_update("потом"))])
+    assert batches == [["раз", "два", "три"], ["потом"]]
+
+def test_other_author_reply_or_command_breaks_the_series():
+    batches = run_arrivals([(0, text_update("вопрос")), (0.01, text_update("чужое", user_id=8)), (0.01, text_update("еще")),
+                            (0.1, text_update("ответ", reply_to_message={"message_id": 1, "date": 0, "chat": {"id": CHAT_ID, "type": "group"}})),
+                            (0.1, text_update("/start"))])
+    assert batches == [["вопрос"], ["чужое"], ["еще"], ["ответ"], ["/start"]]
+
+def test_series_is_capped_by_max_wait_and_max_messages():
+    steady = [(0.03, text_update(f"m{i}")) for i in range(8)]
+    by_time = run_arrivals(steady, window_ms=60, max_ms=100)
+    assert len(by_time) > 1 and sum(len(batch) for batch in by_time) == 8
+    assert len(by_time[0]) <= 5 # за ~100 мс при сообщении раз в 30 мс
+    by_count = run_arrivals([(0, text_update(f"n{i}")) for i in range(5)], max_messages=2)
+    assert by_count == [["n0", "n1"], ["n2", "n3"], ["n4"]]
@@ -0,0 +1,31 @@
+# ContextCacheManager: кэш контекста — оптимизация, при любой его ошибке запрос уходит целиком
+
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+from google.genai import errors as genai_errors
+from google.genai import types
+
+import main
+
+def api_error(code: int, message: str, status: str) -> genai_errors.APIError:
+    return genai_errors.APIError(code, {"error": {"code": code, "message": message, "status": status}})
+
+def test_transport_error_on_cache_create_falls_back_to_full_request():
+    async def create(**kwargs): raise httpx.ConnectTimeout("timed out")
+    client = SimpleNamespace(aio=SimpleNamespace(caches=SimpleNamespace(create=create)))
+    manager = main.ContextCacheManager(mode="system")
+    new_content = types.Content(role="user", parts=[types.Part(text="привет")])
+    contents, config = asyncio.run(manager.prepare(client, {}, "custom", [], [], new_content))
+    assert contents == [new_content] and config.cached_content is None
+    assert manager.counters["context_cache_failures"] == 1
+
+def test_only_missing_cache_errors_trigger_uncached_retry():
+    manager = main.ContextCacheManager(mode="system")
+    config = main.build_generate_config([], "cachedContents/abc")
+    assert manager.is_cache_error(config, api_error(403, "CachedContent not found (or permission denied)", "PERMISSION_DENIED"))
+    assert manager.is_cache_error(config, api_error(404, "cachedContents/abc not found", "NOT_FOUND"))
+    assert not manager.is_cache_error(config, api_error(400, "Request contains an invalid argument; cached tokens exceed the limit", "INVALID_ARGUMENT"))
+    assert not manager.is_cache_error(config, api_error(403, "API key not valid", "PERMISSION_DENIED"))
+    assert not manager.is_cache_error(main.build_generate_config([]), api_error(404, "CachedContent not found", "NOT_FOUND"))
@@ -0,0 +1,59 @@
+# UpdateDeduplicator: повторная доставка апдейта не запускает обработку второй раз
+
+import asyncio
+
+import psycopg2
+
+import main
+
+class ClaimStore:
+    # Таблица processed_updates в памяти; prune_updates ждет сигнала и падает, как при обрыве соединения
+    db_errors = (psycopg2.Error,)
+
+    def __init__(self):
+        self.claimed, self.prune_started, self.prune_release = set(), asyncio.Event(), asyncio.Event()
+
+    async def claim_update(self, update_id):
+        if update_id in self.claimed: return False
+        self.claimed.add(update_id)
+        return True
+
+    async def release_update(self, update_id): self.claimed.discard(update_id)
+
+    async def prune_updates(self, ttl_seconds):
+        self.prune_started.set()
+        await self.prune_release.wait()
+        raise psycopg2.OperationalError("connection lost")
+
+def test_claim_release_and_redelivery():
+    async def scenario():
+        deduplicator = main.UpdateDeduplicator(ClaimStore())
+        first, repeat = await deduplicator.claim(1), await deduplicator.claim(1)
+        await deduplicator.release(1) # очередь переполнена — повтор должен пройти
+        after_release = await deduplicator.claim(1)
+        # Другая реплика уже взяла апдейт: в памяти его нет, но БД отказывает
+        other = main.UpdateDeduplicator(deduplicator.persistence)
+        return first, repeat, after_release, await other.claim(1), deduplicator.duplicates + other.duplicates
+    assert asyncio.run(scenario()) == (True, False, True, False, 2)
+
+def test_in_memory_window_is_bounded():
+    async def scenario():
+        deduplicator = main.UpdateDeduplicator(max_size=2)
+        for update_id in (1, 2, 3): await deduplicator.claim(update_id)
+        return list(deduplicator._seen), await deduplicator.claim(1)
+    assert asyncio.run(scenario()) == ([2, 3], True)
+
+def test_prune_task_is_kept_and_its_error_handled():
+    async def scenario():
+        store = ClaimStore()
+        deduplicator = main.UpdateDeduplicator(store)
+        await deduplicator.claim(1)
+        await store.prune_started.wait()
+        running = len(deduplicator._background)
+        tasks = set(deduplicator._background)
+        store.prune_release.set()
+        await asyncio.wait(tasks)
+        await asyncio.sleep(0) # done-колбэки
+        assert all(task.exception() is None for task in tasks)
+        return running, len(deduplicator._background)
+    assert asyncio.run(scenario()) == (1, 0)
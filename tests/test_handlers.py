@@ -0,0 +1,53 @@
+# Обработчики команд и сообщений целиком: Bot API и Gemini заменены заглушками из stubs.py
+
+import asyncio
+
+import main
+
+from stubs import FakeGeminiClient, make_application, make_update, message_dict
+
+CHAT_ID = 42
+YOUTUBE_URL = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
+
+def test_repeated_summarize_is_answered_from_response_cache():
+    async def scenario():
+        gemini = FakeGeminiClient("краткое содержание")
+        application, bot_api = await make_application(gemini)
+        video = message_dict(CHAT_ID, YOUTUBE_URL)
+        for _ in range(2):
+            await application.process_update(make_update(application, message_dict(CHAT_ID, "/summarize", reply_to_message=video)))
+        return gemini.requests, bot_api.sent_texts()
+    requests, replies = asyncio.run(scenario())
+    assert len(requests) == 1
+    assert sum("краткое содержание" in text for text in replies) == 2
+
+def photo_message(caption: str | None = None, **fields) -> dict:
+    # Фото больше TELEGRAM_FILE_LIMIT_MB: бот его не скачивает и отвечает на подпись
+    photo = {"file_id": "photo", "file_unique_id": "photo", "width": 10, "height": 10, "file_size": (main.TELEGRAM_FILE_LIMIT_MB + 1) * 1024 * 1024}
+    return message_dict(CHAT_ID, photo=[photo], **({"caption": caption} if caption else {}), **fields)
+
+def request_text(contents) -> str:
+    return "\n".join(part.text for content in contents for part in content.parts if part.text)
+
+def test_oversized_photo_caption_is_answered():
+    async def scenario():
+        gemini = FakeGeminiClient()
+        application, bot_api = await make_application(gemini)
+        await application.process_update(make_update(application, photo_message("что на фото?")))
+        return gemini.requests, bot_api.sent_texts()
+    requests, replies = asyncio.run(scenario())
+    assert len(requests) == 1 and "что на фото?" in request_text(requests[0])
+    assert any("ответ модели" in text for text in replies)
+
+def test_coalesced_series_without_loadable_photos_is_answered():
+    async def scenario():
+        gemini = FakeGeminiClient()
+        application, bot_api = await make_application(gemini)
+        lead = make_update(application, photo_message("первое", media_group_id="album"))
+        followers = [make_update(application, photo_message("второе", media_group_id="album")).message]
+        application.bot_data['coalescer'].attach(lead, followers)
+        await application.process_update(lead)
+        return gemini.requests, bot_api.sent_texts()
+    requests, replies = asyncio.run(scenario())
+    assert len(requests) == 1 and "первое\nвторое" in request_text(requests[0])
+    assert any("ответ модели" in text for text in replies)
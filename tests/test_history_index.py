@@ -0,0 +1,73 @@
+# HistoryIndex.window против прежнего линейного прохода по истории с конца на случайных историях
+
+import random
+
+import main
+
+def linear_window(history: list, budget: float, summary: dict | None = None) -> list[tuple[dict, float]]:
+    # Прежний отбор: сводка, если помещается, затем записи с конца, пока хватает бюджета
+    selected = []
+    if summary:
+        content, tokens = main.history_entry_to_content(summary)
+        if content is not None and tokens <= budget:
+            selected.append((summary, tokens))
+            budget -= tokens
+    tail, used = [], 0.0
+    for entry in reversed(history):
+        content, tokens = main.history_entry_to_content(entry)
+        if content is None: continue
+        if used + tokens > budget: break
+        tail.append((entry, tokens))
+        used += tokens
+    return selected + tail[::-1]
+
+def indexed_window(index: main.HistoryIndex, history: list, budget: float, summary: dict | None = None) -> list[tuple[dict, float]]:
+    return [(entry, tokens) for entry, _, tokens in index.window(history, budget, summary)]
+
+def random_entry(rng: random.Random, seq: int) -> dict:
+    role = rng.choice(["user", "user", "model", "model", "tool"]) # записи без текста в окно не попадают
+    text = rng.choice(["", "да", "Короткий ответ.", "def f(x): return x * 2", "длинный абзац текста " * rng.randint(5, 60)])
+    return {"role": role, "parts": [{"type": "text", "content": text}] if text else [], "seq": seq, "user_id": 1, "user_name": "u"}
+
+def assert_same(index, history, budget, summary=None):
+    assert indexed_window(index, history, budget, summary) == linear_window(history, budget, summary)
+
+def test_window_matches_linear_selection_on_random_histories():
+    for seed in range(20):
+        rng = random.Random(seed)
+        index, chat_data, seq, summary = main.HistoryIndex(), {"history": []}, 0, None
+        max_items = rng.randint(3, 40)
+        for _ in range(200):
+            action = rng.random()
+            if action < 0.7: # ход как в add_to_history: дописать и обрезать до max_items
+                seq += 1
+                history = chat_data["history"]
+                history.append(random_entry(rng, seq))
+                index.appended(history)
+                if len(history) > max_items:
+                    chat_data["history"] = history[-max_items:]
+                    index.trimmed(chat_data["history"], len(history) - max_items)
+            elif action < 0.8 and chat_data["history"]: # сводка заменяет начало истории, как в HistoryCompactor
+                history = chat_data["history"]
+                removed = rng.randint(1, len(history))
+                summary = {"role": "summary", "parts": [{"type": "text", "content": "сводка " * rng.randint(1, 100)}], "seq": history[removed - 1]["seq"]}
+                chat_data["history"] = history[removed:]
+                index.trimmed(chat_data["history"], removed)
+            elif action < 0.85: # /clear или загрузка из БД — новый список
+                chat_data["history"] = [dict(entry) for entry in chat_data["history"]] if rng.random() < 0.5 else []
+                summary = None
+            budget = rng.choice([0, 1, 10, 100, 1000, 5000, rng.uniform(0, 3000)])
+            assert_same(index, chat_data["history"], budget, summary)
+
+def test_window_edge_cases():
+    index = main.HistoryIndex()
+    assert index.window([], 1000) == []
+    assert index.window([], 1000, {"role": "summary", "parts": [], "seq": 1}) == []
+    oversized = [{"role": "user", "parts": [{"type": "text", "content": "слово " * 10_000}], "seq": 1}]
+    assert index.window(oversized, 100) == []
+    assert_same(index, oversized, 100)
+    summary = {"role": "summary", "parts": [{"type": "text", "content": "сводка"}], "seq": 0}
+    assert indexed_window(index, oversized, 100, summary)[0][0] is summary
+    assert_same(index, oversized, 100, summary)
+    _, tokens = main.history_entry_to_content(oversized[0])
+    assert_same(index, oversized, tokens + 1, summary) # сводка помещается, а запись уже нет
@@ -0,0 +1,79 @@
+# OutboundScheduler: порядок отправки по приоритету, RetryAfter и «печатает...» вне лимита сообщений
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import RetryAfter
+
+import main
+
+PRIVATE = SimpleNamespace(id=1, type="private")
+OTHER = SimpleNamespace(id=2, type="private")
+
+def scheduler(private_rate: float = 20) -> main.OutboundScheduler:
+    sender = main.OutboundScheduler(global_rate=1000, private_rate=private_rate)
+    sender.chat_limits["private"] = (private_rate, 1) # запас в одно сообщение, чтобы очередь возникала сразу
+    return sender
+
+def test_first_chunks_go_before_continuations():
+    sent = []
+    async def send(label):
+        sent.append(label)
+    async def scenario():
+        sender = scheduler()
+        await sender.run(PRIVATE, lambda: send("busy"))
+        # Токен чата потрачен: все ниже ждут в очереди и выходят по приоритету, внутри приоритета — по порядку
+        await asyncio.gather(sender.run(PRIVATE, lambda: send("edit"), sender.PRIORITY_NEXT),
+                             sender.run(PRIVATE, lambda: send("reply1"), sender.PRIORITY_FIRST),
+                             sender.run(PRIVATE, lambda: send("reply2"), sender.PRIORITY_FIRST))
+        return sender.stats()
+    stats = asyncio.run(scenario())
+    assert sent == ["busy", "reply1", "reply2", "edit"]
+    assert stats["sent"] == 4 and stats["queue_depth"] == 0
+
+def test_retry_after_pauses_chat_and_keeps_queue_position():
+    sent, attempts = [], []
+    async def flood_limited():
+        attempts.append("first")
+        await asyncio.sleep(0.01) # запрос в полете: второй ответ успевает встать в очередь
+        if len(attempts) == 1: raise RetryAfter(0.2)
+        sent.append("first")
+    async def send(label):
+        sent.append(label)
+    async def scenario():
+        sender = scheduler()
+        loop = asyncio.get_running_loop()
+        first = asyncio.create_task(sender.run(PRIVATE, flood_limited, sender.PRIORITY_FIRST))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(sender.run(PRIVATE, lambda: send("second"), sender.PRIORITY_FIRST))
+        started = loop.time()
+        await asyncio.sleep(0.05)
+        await sender.run(OTHER, lambda: send("other chat")) # пауза касается только своего чата
+        await asyncio.gather(first, second)
+        return loop.time() - started, sender.counters
+    elapsed, counters = asyncio.run(scenario())
+    assert sent == ["other chat", "first", "second"]
+    assert elapsed >= 0.15 and counters["retry_after"] == 1
+
+def test_retry_after_gives_up_after_max_retries():
+    async def always_limited(): raise RetryAfter(0.01)
+    sender = scheduler(private_rate=1000)
+    with pytest.raises(RetryAfter): asyncio.run(sender.run(PRIVATE, always_limited))
+    assert sender.counters["retry_after"] == sender.MAX_RETRIES + 1
+
+def test_chat_action_does_not_spend_message_tokens():
+    actions = []
+    async def send_chat_action(chat_id, action): actions.append((chat_id, action))
+    bot = SimpleNamespace(send_chat_action=send_chat_action)
+    async def scenario():
+        sender = scheduler(private_rate=0.5)
+        await sender.chat_action(bot, PRIVATE, "typing")
+        await sender.chat_action(bot, PRIVATE, "typing") # чаще CHAT_ACTION_INTERVAL — пропускается
+        assert sender.can_send_now(PRIVATE) # токен для ответа на месте
+        await sender.run(PRIVATE, lambda: asyncio.sleep(0))
+        await sender.chat_action(bot, PRIVATE, "upload_photo") # токена нет — действие пропускается, а не ждет
+        return sender.counters
+    counters = asyncio.run(scenario())
+    assert actions == [(1, "typing")]
+    assert counters["chat_actions_sent"] == 1 and counters["chat_actions_skipped"] == 2
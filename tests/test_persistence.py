@@ -0,0 +1,141 @@
+# Построчное хранение истории (PERSISTENCE_STORAGE_MODE=rows) на эмуляции таблиц в памяти, без Postgres.
+# Запуск из корня репозитория: python -m pytest -q tests
+
+import asyncio
+
+import psycopg2
+
+import main
+from stubs import FakeGeminiClient, make_application, make_update, message_dict
+
+CHAT_ID = 42
+
+class RowsPersistence(main.PostgresPersistence):
+    # Выполняет ровно те инструкции, что строит _chat_rows_statements, над словарями вместо таблиц
+    def __init__(self):
+        self.meta, self.history, self.fail_writes = {}, {}, False
+        super().__init__("memory", storage_mode="rows", write_delay=60)
+
+    def _connect_with_retry(self, retries=5, delay=5): pass
+    async def close(self): self._cancel_flush_task()
+
+    async def _write(self, statements):
+        if self.fail_writes: raise psycopg2.OperationalError("connection lost")
+        for query, params_list in statements:
+            for params in params_list:
+                if query.startswith("DELETE FROM chat_history WHERE chat_id = %s AND seq < %s"):
+                    self.history = {key: entry for key, entry in self.history.items() if not (key[0] == params[0] and key[1] < params[1])}
+                elif query.startswith("DELETE FROM chat_history"):
+                    self.history = {key: entry for key, entry in self.history.items() if key[0] != params[0]}
+                elif query.startswith("INSERT INTO chat_history"): self.history[(params[0], params[1])] = params[2]
+                elif query.startswith("INSERT INTO chat_meta"): self.meta[params[0]] = params[1]
+
+    async def _load_chat(self, chat_id):
+        if chat_id not in self.meta: return None
+        return self._decode_chat_rows(self.meta[chat_id], [entry for (cid, _), entry in sorted(self.history.items()) if cid == chat_id])
+
+def add_turn(chat_data: dict, text: str) -> None:
+    # Нумерация как в add_to_history
+    seq = chat_data.get("history_seq", 0) + 1
+    chat_data["history_seq"] = seq
+    chat_data.setdefault("history", []).append({"role": "user", "parts": [{"type": "text", "content": text}], "seq": seq})
+
+def texts(data: dict) -> list[str]:
+    return [entry["parts"][0]["content"] for entry in data.get("history", [])]
+
+def run_clear_scenario(failed_flush: bool) -> tuple[list[str], list[str]]:
+    async def scenario():
+        persistence = RowsPersistence()
+        chat_data = {}
+        await persistence.refresh_chat_data(CHAT_ID, chat_data)
+        for i in range(3): add_turn(chat_data, f"old{i}")
+        await persistence.save_chat_data(CHAT_ID, chat_data)
+        await persistence.flush()
+
+        main.clear_chat_data(chat_data) # то, что делает /clear
+        await persistence.save_chat_data(CHAT_ID, chat_data)
+        if failed_flush:
+            persistence.fail_writes = True
+            await persistence.flush() # запись вернулась в очередь
+            persistence.fail_writes = False
+        for i in range(4):
+            add_turn(chat_data, f"new{i}")
+            await persistence.save_chat_data(CHAT_ID, chat_data)
+        await persistence.flush()
+        await persistence.close()
+
+        reloaded = RowsPersistence()
+        reloaded.meta, reloaded.history = persistence.meta, persistence.history
+        fresh = {}
+        await reloaded.refresh_chat_data(CHAT_ID, fresh)
+        await reloaded.close()
+        return texts(chat_data), texts(fresh)
+    return asyncio.run(scenario())
+
+def test_clear_then_delayed_flush_does_not_resurrect_history():
+    in_memory, reloaded = run_clear_scenario(failed_flush=False)
+    assert in_memory == reloaded == ["new0", "new1", "new2", "new3"]
+
+def test_clear_then_failed_flush_does_not_resurrect_history():
+    in_memory, reloaded = run_clear_scenario(failed_flush=True)
+    assert in_memory == reloaded == ["new0", "new1", "new2", "new3"]
+
+class FailingLoadPersistence(RowsPersistence):
+    async def _load_chat(self, chat_id):
+        raise psycopg2.OperationalError("connection lost")
+
+def test_failed_load_aborts_update_without_writing():
+    async def scenario():
+        persistence = FailingLoadPersistence()
+        persistence.meta[CHAT_ID] = persistence.serializer.dumps({"history_seq": 1})
+        persistence.history[(CHAT_ID, 1)] = persistence.serializer.dumps({"role": "user", "parts": [], "seq": 1})
+        stored = (dict(persistence.meta), dict(persistence.history))
+        gemini = FakeGeminiClient()
+        application, bot_api = await make_application(gemini, persistence)
+        await application.process_update(make_update(application, message_dict(CHAT_ID, "привет")))
+        await persistence.flush()
+        await persistence.close()
+        return gemini.requests, bot_api.sent_texts(), stored, (persistence.meta, persistence.history)
+    requests, replies, stored, after = asyncio.run(scenario())
+    assert requests == [] # обработчик не запускался
+    assert len(replies) == 1 and "временно недоступна" in replies[0]
+    assert after == stored
+
+def test_migration_skips_corrupt_compressed_blobs():
+    persistence = RowsPersistence()
+    serializer = persistence.serializer
+    valid = serializer.dumps({"history": [{"role": "user", "parts": [{"type": "text", "content": "x" * 2000}]}]})
+    corrupt = {"zlib": bytes((serializer.FORMAT_VERSION, serializer.COMPRESSION_CODES["zlib"])) + b"not zlib",
+               "zstd": bytes((serializer.FORMAT_VERSION, serializer.COMPRESSION_CODES["zstd"])) + b"\x28\xb5\x2f\xfd" + b"not zstd"}
+    for chat_id, (name, blob) in enumerate(corrupt.items(), 1):
+        assert persistence._migration_statements(f"chat_data_{chat_id}", blob) is None, name
+    assert persistence._migration_statements(f"chat_data_{CHAT_ID}", valid)[0] == CHAT_ID
+
+def test_drop_during_write_does_not_restore_persisted_seq():
+    async def scenario():
+        persistence = RowsPersistence()
+        chat_data = {}
+        await persistence.refresh_chat_data(CHAT_ID, chat_data)
+        for i in range(3): add_turn(chat_data, f"old{i}")
+        write_started, write_release = asyncio.Event(), asyncio.Event()
+        plain_write = persistence._write
+        async def slow_write(statements):
+            write_started.set()
+            await write_release.wait()
+            await plain_write(statements)
+        persistence._write = slow_write
+        await persistence.save_chat_data(CHAT_ID, chat_data)
+        flush = asyncio.create_task(persistence.flush())
+        await write_started.wait()
+        persistence._write = plain_write
+        await persistence.drop_chat_data(CHAT_ID) # строки чата удалены, пока запись еще в полете
+        write_release.set()
+        await flush
+        # Следующая запись без перезагрузки чата должна переписать историю целиком
+        add_turn(chat_data, "new")
+        statements = persistence._chat_rows_statements(CHAT_ID, chat_data)
+        await persistence.close()
+        return persistence._persisted_seq.get(CHAT_ID), statements[0][0]
+    persisted_seq, first_statement = asyncio.run(scenario())
+    assert persisted_seq is None
+    assert first_statement == "DELETE FROM chat_history WHERE chat_id = %s;"